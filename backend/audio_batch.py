@@ -0,0 +1,228 @@
+# Batch reprocessing of archived recordings.
+# Every recording in a directory (recursively) or listed in a manifest is
+# analyzed in a process pool started once, and its families are written to
+# <output_dir>/<relative path>.json (the same JSON audio_process.py prints).
+#
+#   python audio_batch.py <directory | manifest.txt> <output_dir> [--workers N] [--stream]
+#                         [--param MAD_FACTOR=2.5 ...] [--force]
+#
+# Runs are resumable: every finished file is appended to
+# <output_dir>/batch_log.ndjson, and a file is skipped when its output exists
+# and was made from the same input (size, mtime) with the same parameters.
+# A summary (families per file, failures, throughput) is written to
+# <output_dir>/batch_summary.json.
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import soundfile as sf
+
+import audio_process as ap
+from audio_process import log
+
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.ogg', '.aiff', '.aif')
+BATCH_LOG_NAME = 'batch_log.ndjson'
+BATCH_SUMMARY_NAME = 'batch_summary.json'
+
+################################################################################
+# Inputs and outputs
+################################################################################
+
+def find_inputs(source):
+    """
+    Recordings to process: every audio file under a directory, or the paths
+    listed in a manifest file (one per line, relative to the manifest,
+    '#' starts a comment). Returns (root, sorted absolute paths).
+    """
+    if os.path.isdir(source):
+        root = os.path.abspath(source)
+        paths = []
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    paths.append(os.path.join(dirpath, name))
+        return root, sorted(paths)
+
+    base = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                paths.append(os.path.normpath(os.path.join(base, line)))
+    root = os.path.commonpath([os.path.dirname(p) for p in paths]) if paths else base
+    return root, sorted(set(paths))
+
+def output_path(input_path, root, output_dir):
+    return os.path.join(output_dir, os.path.relpath(input_path, root) + '.json')
+
+def parameters_digest(parameters):
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+def input_signature(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def read_batch_log(output_dir):
+    """
+    Latest batch_log.ndjson entry per input file.
+    """
+    entries = {}
+    path = os.path.join(output_dir, BATCH_LOG_NAME)
+    if not os.path.exists(path):
+        return entries
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by an interrupted run
+            entries[entry['file']] = entry
+    return entries
+
+def is_up_to_date(entry, input_path, out_path, params_digest):
+    return (entry is not None and entry.get('ok') and entry.get('parameters') == params_digest
+            and entry.get('input') == input_signature(input_path) and os.path.exists(out_path))
+
+################################################################################
+# Worker side
+################################################################################
+
+def _init_worker(parameters):
+    for name, value in parameters.items():
+        setattr(ap, name, value)
+    # files are processed in parallel already, and the outputs are the cache
+    ap.DETECTION_WORKERS = 1
+    ap.RESULT_CACHE = False
+    # a whole archive would only cycle through the size-capped audio store
+    ap.AUDIO_STORE = False
+
+def _process_file(input_path, out_path, stream):
+    t0 = time.perf_counter()
+    result = {'file': input_path, 'output': out_path, 'input': input_signature(input_path)}
+    try:
+        result['audio_sec'] = sf.info(input_path).duration
+        families_json = ap.analyze_file_json(input_path, stream=stream, use_cache=False)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        tmp_path = out_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(families_json)
+        os.replace(tmp_path, out_path)
+        result['families'] = len(json.loads(families_json))
+        result['ok'] = True
+    except Exception as e:
+        log(f"Batch: {input_path} failed: {e!r}")
+        result['ok'] = False
+        result['error'] = str(e)
+    result['seconds'] = time.perf_counter() - t0
+    ap.flush_log()
+    return result
+
+################################################################################
+# Parent side
+################################################################################
+
+def run_batch(source, output_dir, workers=None, stream=False, parameters=None, force=False):
+    """
+    Process every recording of 'source' (directory or manifest) into
+    output_dir, skipping up-to-date outputs unless 'force'.
+
+    parameters: TUNABLE PARAMETER overrides, e.g. {'MAD_FACTOR': 2.5}.
+    Returns the summary dict (also written to batch_summary.json).
+    """
+    parameters = dict(parameters or {})
+    for name in parameters:
+        if not hasattr(ap, name):
+            raise ValueError(f"Unknown parameter: {name}")
+    effective = ap.tunable_parameters()
+    effective.update({name: value for name, value in parameters.items() if name in effective})
+    params_digest = parameters_digest(effective)
+
+    root, inputs = find_inputs(source)
+    os.makedirs(output_dir, exist_ok=True)
+    previous = read_batch_log(output_dir)
+
+    todo = []
+    up_to_date = []
+    for input_path in inputs:
+        out_path = output_path(input_path, root, output_dir)
+        if not force and is_up_to_date(previous.get(input_path), input_path, out_path, params_digest):
+            up_to_date.append(previous[input_path])
+        else:
+            todo.append((input_path, out_path))
+    skipped = len(up_to_date)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(todo) or 1))
+    sys.stderr.write(f"{len(inputs)} recordings, {skipped} up to date, {len(todo)} to process on {workers} workers\n")
+    log(f"Batch {source} -> {output_dir}: {len(todo)} to process, {skipped} skipped, parameters {effective}")
+
+    results = []
+    wall0 = time.perf_counter()
+    with open(os.path.join(output_dir, BATCH_LOG_NAME), 'a') as batch_log, \
+         ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(parameters,)) as pool:
+        futures = [pool.submit(_process_file, input_path, out_path, stream) for input_path, out_path in todo]
+        for done, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            result['parameters'] = params_digest
+            # one line per finished file, so an interrupted run resumes here
+            batch_log.write(json.dumps(result) + "\n")
+            batch_log.flush()
+            results.append(result)
+            status = f"{result['families']} families" if result['ok'] else f"FAILED: {result['error']}"
+            sys.stderr.write(f"[{done}/{len(todo)}] {os.path.relpath(result['file'], root)}: {status}\n")
+    wall_sec = time.perf_counter() - wall0
+
+    succeeded = [r for r in results if r['ok']]
+    audio_sec = sum(r.get('audio_sec', 0.0) for r in succeeded)
+    summary = {
+        'source': os.path.abspath(source),
+        'parameters': effective,
+        'recordings': len(inputs),
+        'skipped': skipped,
+        'processed': len(succeeded),
+        'failed': [{'file': r['file'], 'error': r['error']} for r in results if not r['ok']],
+        # families per file, including the ones already up to date
+        'families': {os.path.relpath(r['file'], root): r['families'] for r in up_to_date + succeeded},
+        'workers': workers,
+        'wall_sec': wall_sec,
+        'audio_sec': audio_sec,
+        'files_per_sec': len(results) / wall_sec if wall_sec > 0 else None,
+        'audio_sec_per_sec': audio_sec / wall_sec if wall_sec > 0 else None,
+    }
+    with open(os.path.join(output_dir, BATCH_SUMMARY_NAME), 'w') as f:
+        json.dump(summary, f, indent=2)
+    log(f"Batch done: {len(succeeded)} processed, {len(summary['failed'])} failed, {skipped} skipped in {wall_sec:.1f} s")
+    return summary
+
+def parse_parameter(text):
+    """
+    'NAME=VALUE' -> (NAME, VALUE), VALUE parsed as JSON when possible.
+    """
+    name, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got {text}")
+    try:
+        return name.strip(), json.loads(value)
+    except ValueError:
+        return name.strip(), value
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reprocess a directory or manifest of recordings")
+    parser.add_argument('source', help="directory of recordings, or a manifest file with one path per line")
+    parser.add_argument('output_dir')
+    parser.add_argument('--workers', type=int, help="processes (default: all cores)")
+    parser.add_argument('--stream', action='store_true', help="analyze block by block in bounded memory")
+    parser.add_argument('--param', type=parse_parameter, action='append', default=[],
+                        help="override a TUNABLE PARAMETER of audio_process.py, e.g. MAD_FACTOR=2.5")
+    parser.add_argument('--force', action='store_true', help="reprocess up-to-date recordings too")
+    args = parser.parse_args()
+
+    summary = run_batch(args.source, args.output_dir, workers=args.workers, stream=args.stream,
+                        parameters=dict(args.param), force=args.force)
+    sys.stderr.write(f"{summary['processed']} processed, {len(summary['failed'])} failed, "
+                     f"{summary['skipped']} skipped in {summary['wall_sec']:.1f} s\n")
+    sys.exit(1 if summary['failed'] else 0)
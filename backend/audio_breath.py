@@ -0,0 +1,367 @@
+# Breath-cycle segmentation of multi-channel lung recordings.
+# A low-rate breath envelope (frame RMS, each channel scaled by its median
+# level, averaged over channels and median-smoothed so crackles and heart
+# beats don't show) is split into sound and pause intervals with a
+# hysteresis threshold between the envelope's floor and loud levels, in dB so
+# a faint expiration still counts as sound. Sound stretches are cut into
+# single phases at deep dips and where the level steps (an inspiration often
+# runs straight into a quieter expiration), and the phases of every breath
+# (the pieces between two pauses) alternate inspiration / expiration, the
+# louder set being inspiration (vesicular breath sounds are louder and
+# longer breathing in); a breath heard as a single piece is an inspiration
+# unless it is clearly quieter than the typical inspiration.
+#
+# audio_process.py uses the segments to restrict detection and family
+# processing to BREATH_PHASES and tags each family with the phase of its
+# first arrival.
+#
+#   python audio_breath.py recording.wav [--output segments.json]
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+################################################################################
+# TUNABLE PARAMETERS
+################################################################################
+
+# !!! TUNABLE PARAMETER: frame length (ms) of the breath envelope
+BREATH_FRAME_MS = 50.0
+# !!! TUNABLE PARAMETER: rolling median (ms) over the envelope frames
+BREATH_SMOOTH_MS = 350.0  # longer than a crackle or heart sound, shorter than a phase
+# !!! TUNABLE PARAMETER: sound starts above floor + this fraction of (loud - floor), in dB
+BREATH_ON_FRACTION = 0.3
+# !!! TUNABLE PARAMETER: sound ends below floor + this fraction of (loud - floor), in dB
+BREATH_OFF_FRACTION = 0.2
+# !!! TUNABLE PARAMETER: dips at least this deep (fraction of loud - floor, in dB) split two phases
+BREATH_SPLIT_PROMINENCE = 0.25
+# !!! TUNABLE PARAMETER: a level step of at least this many dB inside a sound stretch splits two phases
+BREATH_SPLIT_DB = 3.0  # expiration is typically 4-10 dB below inspiration
+# !!! TUNABLE PARAMETER: shortest inspiration/expiration (ms), shorter sounds count as pause
+BREATH_MIN_PHASE_MS = 400.0
+# !!! TUNABLE PARAMETER: shortest pause (ms), shorter gaps are a phase change
+BREATH_MIN_PAUSE_MS = 250.0
+# !!! TUNABLE PARAMETER: a lone sound stretch quieter than this fraction of the typical inspiration is an expiration
+BREATH_EXPIRATION_LEVEL = 0.75
+
+# Envelope percentiles taken as the floor (pauses) and loud (breathing) levels
+FLOOR_PERCENTILE = 5
+LOUD_PERCENTILE = 90
+# A level step must be this many times the level spread (std, dB) of either side
+STEP_CONTRAST = 1.0
+# Envelope values are clipped here before taking dB (digital silence)
+LEVEL_EPSILON = 1e-6
+
+PHASES = ('pause', 'inspiration', 'expiration')
+PAUSE, INSPIRATION, EXPIRATION = range(len(PHASES))
+
+SEGMENT_COLUMNS = ('start_ms', 'end_ms', 'phase')
+
+def segmentation_parameters():
+    """
+    The TUNABLE PARAMETERS above, which change the segments (and with them
+    the families when detection is gated).
+    """
+    return {name: globals()[name] for name in (
+        'BREATH_FRAME_MS', 'BREATH_SMOOTH_MS', 'BREATH_ON_FRACTION', 'BREATH_OFF_FRACTION',
+        'BREATH_SPLIT_PROMINENCE', 'BREATH_SPLIT_DB', 'BREATH_MIN_PHASE_MS', 'BREATH_MIN_PAUSE_MS',
+        'BREATH_EXPIRATION_LEVEL',
+    )}
+
+################################################################################
+# Envelope
+################################################################################
+
+def frame_samples(sr, frame_ms=None):
+    frame_ms = BREATH_FRAME_MS if frame_ms is None else frame_ms
+    return max(1, int(round(sr * frame_ms / 1000.0)))
+
+def breath_envelope(audio_data, sr, frame_ms=None, smooth_ms=None):
+    """
+    Breath envelope of audio_data (channels, n_samples): one value per
+    frame_samples(sr) samples (a trailing partial frame is dropped).
+
+    Each channel's frame RMS is divided by its median, so quiet and loud
+    stethoscopes weigh the same, the channels are averaged and a rolling
+    median of smooth_ms removes short loud events. The frames are reduced
+    in place (einsum over a (frames, frame) view), without a full-length
+    temporary.
+    """
+    from scipy import signal  # medfilt, only needed here
+    smooth_ms = BREATH_SMOOTH_MS if smooth_ms is None else smooth_ms
+    frame = frame_samples(sr, frame_ms)
+    num_channels, n = audio_data.shape
+    n_frames = n // frame
+    envelope = np.zeros(n_frames)
+    if n_frames == 0 or num_channels == 0:
+        return envelope
+    for channel in audio_data:
+        frames = np.ascontiguousarray(channel[:n_frames * frame]).reshape(n_frames, frame)
+        rms = np.sqrt(np.einsum('ij,ij->i', frames, frames, dtype=np.float64) / frame)
+        level = np.median(rms)
+        envelope += rms / level if level > 0 else rms
+    envelope /= num_channels
+    kernel = max(1, int(round(smooth_ms / (frame * 1000.0 / sr))))
+    kernel += 1 - kernel % 2  # medfilt wants an odd length
+    if kernel > 1:
+        envelope = signal.medfilt(envelope, kernel)
+    return envelope
+
+################################################################################
+# Segmentation
+################################################################################
+
+def _hysteresis(envelope, on, off):
+    """
+    Frames in a sound stretch: switched on at >= on, off below 'off'.
+    """
+    events = np.where(envelope >= on, 1, np.where(envelope < off, -1, 0))
+    last_event = np.maximum.accumulate(np.where(events != 0, np.arange(len(envelope)), 0))
+    return events[last_event] == 1
+
+def _level_splits(level, min_frames, min_step_db):
+    """
+    Change points of one sound stretch's level (dB per frame) by binary
+    segmentation: the split that best fits a level before and a level
+    after (least squares, from cumulative sums) is kept when both sides
+    last min_frames and their mean levels differ by min_step_db, then
+    each side is split again. Returns the sorted split frames.
+    """
+    splits = []
+    pending = [(0, len(level))]
+    while pending:
+        start, stop = pending.pop()
+        m = stop - start
+        if m < 2 * min_frames:
+            continue
+        x = level[start:stop]
+        sums = np.concatenate(([0.0], np.cumsum(x)))
+        squares = np.concatenate(([0.0], np.cumsum(x * x)))
+        k = np.arange(min_frames, m - min_frames + 1)
+        left = sums[k] / k
+        right = (sums[m] - sums[k]) / (m - k)
+        # between-sides sum of squares, the SSE drop of splitting at k
+        gain = k * (m - k) / m * (left - right) ** 2
+        best = int(np.argmax(gain))
+        kb = k[best]
+        step = abs(left[best] - right[best])
+        # a step between two levels, not a swell or a fading edge: the
+        # sides vary less than they differ
+        spread = max(np.sqrt(max(0.0, squares[kb] / kb - left[best] ** 2)),
+                     np.sqrt(max(0.0, (squares[m] - squares[kb]) / (m - kb) - right[best] ** 2)))
+        if step < min_step_db or step < STEP_CONTRAST * spread:
+            continue
+        split = start + int(kb)
+        splits.append(split)
+        pending += [(start, split), (split, stop)]
+    return sorted(splits)
+
+def _label_breath(loudness, typical):
+    """
+    Phases of one breath's consecutive sound pieces: alternating, the
+    louder set being inspiration. A lone piece is an inspiration unless it
+    is clearly quieter than the 'typical' inspiration (an expiration heard
+    on its own, its inspiration having been cut off by a pause).
+    """
+    k = len(loudness)
+    parity = 0
+    if k == 1 and loudness[0] < BREATH_EXPIRATION_LEVEL * typical:
+        parity = 1
+    elif k > 1:
+        even = loudness[0::2].mean() - loudness[1::2].mean()
+        parity = 0 if even >= 0 else 1
+    return np.where((np.arange(k) + parity) % 2 == 0, INSPIRATION, EXPIRATION)
+
+def segment_breath(envelope, sr, n_samples, frame_ms=None):
+    """
+    Split a recording of n_samples into inspiration, expiration and pause
+    intervals from its breath_envelope.
+
+    Levels are compared in dB, so a faint expiration (often a third of the
+    inspiration's level) still sits well above the pause floor:
+      1) sound stretches: hysteresis between the floor and loud levels,
+         cut at deep dips
+      2) each stretch is cut where its level steps (_level_splits), so an
+         inspiration running straight into its expiration gives two phases
+      3) pieces too short to be a phase become pause, gaps too short to be
+         a pause become a phase change
+      4) the pieces of every breath (between two pauses) alternate
+         inspiration / expiration, see _label_breath
+
+    Returns a dict of SEGMENT_COLUMNS arrays: start_ms, end_ms (the
+    intervals tile the whole recording, in order) and phase (index into
+    PHASES).
+    """
+    from scipy import signal  # find_peaks, only needed here
+    frame = frame_samples(sr, frame_ms)
+    frame_ms = frame * 1000.0 / sr
+    duration_ms = n_samples * 1000.0 / sr
+    n_frames = len(envelope)
+
+    level = 20.0 * np.log10(np.maximum(envelope, LEVEL_EPSILON))
+    floor, loud = (np.percentile(level, [FLOOR_PERCENTILE, LOUD_PERCENTILE]) if n_frames else (0.0, 0.0))
+    span = loud - floor
+    if span <= 0:
+        # no breathing to follow
+        return {'start_ms': np.array([0.0]), 'end_ms': np.array([duration_ms]), 'phase': np.array([PAUSE], dtype=np.int8)}
+
+    # 1) sound stretches, cut at deep dips
+    active = _hysteresis(level, floor + BREATH_ON_FRACTION * span, floor + BREATH_OFF_FRACTION * span)
+    edges = np.diff(np.concatenate(([0], active.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+    dips, _ = signal.find_peaks(-level, prominence=BREATH_SPLIT_PROMINENCE * span)
+    dips = dips[active[dips]]
+
+    # 2) level steps inside the stretches
+    min_frames = max(1, int(np.ceil(BREATH_MIN_PHASE_MS / frame_ms)))
+    steps = [a + np.array(_level_splits(level[a:b], min_frames, BREATH_SPLIT_DB), dtype=np.int64)
+             for a, b in zip(starts, stops)]
+    cuts = np.unique(np.concatenate([dips] + steps))
+    starts = np.sort(np.concatenate((starts, cuts)))
+    stops = np.sort(np.concatenate((stops, cuts)))
+
+    # 3) too short to be a phase: pause
+    long_enough = (stops - starts) * frame_ms >= BREATH_MIN_PHASE_MS
+    starts, stops = starts[long_enough], stops[long_enough]
+
+    #    gaps too short to be a pause: the phase changes halfway
+    short_gap = (starts[1:] - stops[:-1]) * frame_ms < BREATH_MIN_PAUSE_MS
+    middle = (stops[:-1] + starts[1:]) // 2
+    stops[:-1] = np.where(short_gap, middle, stops[:-1])
+    starts[1:] = np.where(short_gap, middle, starts[1:])
+
+    # 4) phases, breath by breath; the typical inspiration is the median of
+    #    every breath's loudest piece
+    loudness = np.array([envelope[a:b].mean() for a, b in zip(starts, stops)])
+    phases = np.zeros(len(starts), dtype=np.int8)
+    breath_starts = np.concatenate(([0], np.flatnonzero(starts[1:] > stops[:-1]) + 1))
+    breaths = list(zip(breath_starts, np.append(breath_starts[1:], len(starts))))
+    typical = np.median([loudness[a:b].max() for a, b in breaths]) if len(starts) else 0.0
+    for a, b in breaths:
+        phases[a:b] = _label_breath(loudness[a:b], typical)
+
+    # 5) tile the recording, pauses in between; the last frame runs to the end
+    bounds_ms = np.minimum(np.stack([starts, stops], axis=1) * frame_ms, duration_ms)
+    if len(stops) and stops[-1] == n_frames:
+        bounds_ms[-1, 1] = duration_ms
+    rows = []
+    position = 0.0
+    for (start_ms, end_ms), phase in zip(bounds_ms, phases):
+        if start_ms > position:
+            rows.append((position, start_ms, PAUSE))
+        rows.append((start_ms, end_ms, phase))
+        position = end_ms
+    if position < duration_ms or not rows:
+        rows.append((position, duration_ms, PAUSE))
+    start_ms, end_ms, phase = zip(*rows)
+    return {'start_ms': np.array(start_ms), 'end_ms': np.array(end_ms), 'phase': np.array(phase, dtype=np.int8)}
+
+def segment_recording(audio_data, sr):
+    """
+    segment_breath of audio_data (channels, n_samples).
+    """
+    return segment_breath(breath_envelope(audio_data, sr), sr, audio_data.shape[1])
+
+################################################################################
+# Gating and tagging
+################################################################################
+
+def phase_codes(phases):
+    """
+    PHASES indices of 'phases' (a phase name or a list of them).
+    """
+    if isinstance(phases, str):
+        phases = (phases,)
+    for phase in phases:
+        if phase not in PHASES:
+            raise ValueError(f"Unknown breath phase: {phase}, expected one of {PHASES}")
+    return [PHASES.index(phase) for phase in phases]
+
+def phase_ranges(segments, phases, sr, n_samples):
+    """
+    Sample ranges [start, stop) covered by 'phases', shape (k, 2), sorted,
+    adjacent intervals merged.
+    """
+    keep = np.isin(segments['phase'], phase_codes(phases))
+    starts = np.round(segments['start_ms'][keep] * sr / 1000.0).astype(np.int64)
+    stops = np.minimum(n_samples, np.round(segments['end_ms'][keep] * sr / 1000.0).astype(np.int64))
+    if len(starts) > 1:
+        joined = np.concatenate(([False], starts[1:] <= stops[:-1]))
+        first = np.flatnonzero(~joined)
+        stops = np.append(stops[first[1:] - 1], stops[-1])
+        starts = starts[first]
+    ranges = np.stack([starts, stops], axis=1).reshape(-1, 2)
+    return ranges[ranges[:, 1] > ranges[:, 0]]
+
+def phase_at(segments, times_ms):
+    """
+    Phase name at every time (ms).
+    """
+    index = np.searchsorted(segments['start_ms'], np.asarray(times_ms, dtype=np.float64), side='right') - 1
+    return [PHASES[segments['phase'][i]] for i in np.clip(index, 0, len(segments['phase']) - 1)]
+
+def tag_family(family, phase):
+    """
+    Add 'phase' to every entry of a family (in place), returns the family.
+    """
+    for entry in family:
+        entry['phase'] = phase
+    return family
+
+def family_phase(family, segments):
+    """
+    Phase of a family: where its first arrival falls.
+    """
+    return phase_at(segments, [min(entry['time'] for entry in family)])[0]
+
+################################################################################
+# Reporting
+################################################################################
+
+def segments_to_list(segments):
+    """
+    One { phase, start_ms, end_ms } dict per interval.
+    """
+    return [{'phase': PHASES[phase], 'start_ms': start_ms, 'end_ms': end_ms}
+            for start_ms, end_ms, phase in zip(segments['start_ms'].tolist(), segments['end_ms'].tolist(),
+                                               segments['phase'].tolist())]
+
+def breath_summary(segments, families=None):
+    """
+    Per phase: interval count and total seconds, plus breaths (inspirations)
+    per minute. With families, also how many fell in each phase (their
+    'phase' tag, or family_phase for untagged ones).
+    """
+    seconds = (segments['end_ms'] - segments['start_ms']) / 1000.0
+    summary = {'phases': {}}
+    for code, phase in enumerate(PHASES):
+        in_phase = segments['phase'] == code
+        summary['phases'][phase] = {'count': int(in_phase.sum()), 'seconds': float(seconds[in_phase].sum())}
+    total = float(seconds.sum())
+    summary['breaths_per_min'] = summary['phases']['inspiration']['count'] * 60.0 / total if total else 0.0
+    if families is not None:
+        counts = {phase: 0 for phase in PHASES}
+        for family in families:
+            if family:
+                counts[family[0]['phase'] if 'phase' in family[0] else family_phase(family, segments)] += 1
+        summary['families'] = counts
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split a recording into inspiration, expiration and pauses")
+    parser.add_argument('input_file')
+    parser.add_argument('--output', help="write the segments JSON here instead of stdout")
+    args = parser.parse_args()
+
+    from audio_process import load_audio
+    audio_data, sample_rate = load_audio(args.input_file)
+    segments = segment_recording(audio_data, sample_rate)
+    text = json.dumps({'segments': segments_to_list(segments), 'summary': breath_summary(segments)})
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
@@ -0,0 +1,192 @@
+# Source localization of crackle families from their arrival time differences.
+# Every family gives, per channel, the spike time and the cross-correlation
+# delay to the family's leader, so each channel's arrival time is
+# time + delay. A crackle starting at p at time t0 reaches sensor c at
+# t0 + |p - sensor_c| / SOUND_SPEED_CM_PER_MS; the position (and t0) that fit
+# a family's arrivals best in the least-squares sense is its estimated origin.
+#
+# All families are solved together: a coarse grid search over the sensor
+# area (three matrix products for every family x grid point), then ever
+# finer 5x5 grids around each family's best point, without a per-family loop.
+#
+#   python audio_localize.py families.json [--output locations.json]
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+################################################################################
+# TUNABLE PARAMETERS
+################################################################################
+
+# !!! TUNABLE PARAMETER: (x, y) in cm of each channel's stethoscope, channel order
+SENSOR_POSITIONS_CM = (
+    (-7.0, 12.0), (7.0, 12.0),    # 0 top left,    1 top right
+    (-7.0, 0.0), (7.0, 0.0),      # 2 middle left, 3 middle right
+    (-7.0, -12.0), (7.0, -12.0),  # 4 bottom left, 5 bottom right
+)  # as laid out in LungVisualization, x to the right and y up
+# !!! TUNABLE PARAMETER: speed of sound through the chest, cm per ms
+SOUND_SPEED_CM_PER_MS = 3.0  # lung parenchyma is ~25-75 m/s, far slower than soft tissue
+# !!! TUNABLE PARAMETER: spacing (cm) of the coarse search grid
+LOCALIZE_GRID_CM = 1.0
+# !!! TUNABLE PARAMETER: how far (cm) outside the sensors a source is searched
+LOCALIZE_MARGIN_CM = 5.0
+# !!! TUNABLE PARAMETER: spacing (cm) the best point is refined down to
+LOCALIZE_RESOLUTION_CM = 0.05
+
+# Channels needed to solve for x, y and the emission time
+MIN_LOCALIZE_CHANNELS = 3
+
+LOCATION_COLUMNS = ('x_cm', 'y_cm', 'emission_ms', 'residual_ms', 'channels')
+
+################################################################################
+# Arrivals
+################################################################################
+
+def family_arrivals(families, num_channels=None):
+    """
+    (n_families, num_channels) arrival times in ms (time + delay), NaN for
+    channels a family doesn't have. num_channels defaults to the number of
+    sensor positions.
+    """
+    from audio_process import families_to_columns
+    if num_channels is None:
+        num_channels = len(SENSOR_POSITIONS_CM)
+    columns = families_to_columns(families)
+    arrivals = np.full((len(families), num_channels), np.nan)
+    on_sensor = columns['channel'] < num_channels
+    arrivals[columns['family_id'][on_sensor], columns['channel'][on_sensor]] = \
+        (columns['time'] + columns['delay'])[on_sensor]
+    return arrivals
+
+################################################################################
+# Solver
+################################################################################
+
+def _travel_times(points, positions, speed):
+    """
+    Travel time (ms) from every point (..., 2) to every sensor (c, 2): (..., c).
+    """
+    dx = points[..., 0, None] - positions[:, 0]
+    dy = points[..., 1, None] - positions[:, 1]
+    return np.sqrt(dx * dx + dy * dy) / speed
+
+def search_grid(positions, step, margin):
+    """
+    (g, 2) grid points covering the sensors' bounding box plus margin.
+    """
+    lo = positions.min(axis=0) - margin
+    hi = positions.max(axis=0) + margin
+    xs = np.arange(lo[0], hi[0] + step / 2, step)
+    ys = np.arange(lo[1], hi[1] + step / 2, step)
+    return np.stack(np.meshgrid(xs, ys, indexing='ij'), axis=-1).reshape(-1, 2)
+
+def localize(arrivals, positions=None, speed=None, grid_step=None, margin=None, resolution=None):
+    """
+    Least-squares source position of every row of arrivals (n_families,
+    channels), NaN = channel missing.
+
+    For a candidate point the best emission time is the mean of
+    (arrival - travel time) over the family's channels, and the fit error is
+    the sum of squared deviations from it. Over a grid this is
+        sum(t^2) - 2 t.a + sum(a^2) - (sum(t) - sum(a))^2 / n
+    (t: centered arrivals, a: travel times), i.e. three matrix products for
+    all families and grid points at once. The best grid point is then
+    refined on 5x5 grids around it, halving the spacing every round until
+    it is below 'resolution'.
+
+    Returns a dict of LOCATION_COLUMNS arrays: position (cm), emission time
+    (ms, same clock as the arrivals), RMS residual (ms) and channels used.
+    Families with fewer than MIN_LOCALIZE_CHANNELS channels get NaN.
+    """
+    positions = np.asarray(SENSOR_POSITIONS_CM if positions is None else positions, dtype=np.float64)
+    speed = SOUND_SPEED_CM_PER_MS if speed is None else speed
+    grid_step = LOCALIZE_GRID_CM if grid_step is None else grid_step
+    margin = LOCALIZE_MARGIN_CM if margin is None else margin
+    resolution = LOCALIZE_RESOLUTION_CM if resolution is None else resolution
+
+    arrivals = np.asarray(arrivals, dtype=np.float64)[:, :len(positions)]
+    n_families = arrivals.shape[0]
+    present = ~np.isnan(arrivals)
+    counts = present.sum(axis=1)
+    solvable = counts >= MIN_LOCALIZE_CHANNELS
+    result = {name: np.full(n_families, np.nan) for name in LOCATION_COLUMNS}
+    result['channels'] = counts
+    if not solvable.any():
+        return result
+
+    mask = present[solvable].astype(np.float64)
+    n = counts[solvable].astype(np.float64)
+    # centered, so the squares don't swamp millisecond differences
+    offset = np.nanmean(arrivals[solvable], axis=1)
+    t = np.where(present[solvable], arrivals[solvable] - offset[:, None], 0.0)
+
+    # 1) coarse grid, all families x grid points
+    grid = search_grid(positions, grid_step, margin)
+    a = _travel_times(grid, positions, speed)
+    sum_t = t.sum(axis=1)
+    sum_a = mask @ a.T
+    sse = ((t * t).sum(axis=1)[:, None] - 2.0 * (t @ a.T) + mask @ (a * a).T
+           - (sum_t[:, None] - sum_a) ** 2 / n[:, None])
+    best = grid[np.argmin(sse, axis=1)]
+
+    # 2) finer grids around each family's best point, each spanning the
+    #    previous spacing on both sides
+    rows = np.arange(len(best))
+    step = grid_step
+    while True:
+        step /= 2.0
+        fine = np.arange(-2, 3) * step
+        candidates = best[:, None, :] + np.stack(np.meshgrid(fine, fine, indexing='ij'), axis=-1).reshape(-1, 2)
+        deviations = t[:, None, :] - _travel_times(candidates, positions, speed)   # (f, 25, c)
+        emission = (deviations * mask[:, None, :]).sum(axis=2) / n[:, None]
+        sse = (((deviations - emission[..., None]) ** 2) * mask[:, None, :]).sum(axis=2)
+        k = np.argmin(sse, axis=1)
+        best = candidates[rows, k]
+        if step <= resolution:
+            break
+
+    result['x_cm'][solvable] = best[:, 0]
+    result['y_cm'][solvable] = best[:, 1]
+    result['emission_ms'][solvable] = emission[rows, k] + offset
+    result['residual_ms'][solvable] = np.sqrt(np.maximum(sse[rows, k], 0.0) / n)
+    return result
+
+def localize_families(families, **kwargs):
+    """
+    localize() on the families' arrivals (see family_arrivals).
+    """
+    if not families:
+        return {name: np.zeros(0) for name in LOCATION_COLUMNS}
+    return localize(family_arrivals(families), **kwargs)
+
+def locations_to_list(locations):
+    """
+    One { x_cm, y_cm, emission_ms, residual_ms, channels } dict per family,
+    None for unknown values (JSON has no NaN).
+    """
+    rows = []
+    for values in zip(*(locations[name].tolist() for name in LOCATION_COLUMNS)):
+        rows.append({name: (None if isinstance(v, float) and v != v else v)
+                     for name, v in zip(LOCATION_COLUMNS, values)})
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate where each crackle family originated")
+    parser.add_argument('families', help="families JSON as printed by audio_process.py, '-' for stdin")
+    parser.add_argument('--output', help="write the locations JSON here instead of stdout")
+    args = parser.parse_args()
+
+    if args.families == '-':
+        families = json.load(sys.stdin)
+    else:
+        with open(args.families, 'r') as f:
+            families = json.load(f)
+    text = json.dumps(locations_to_list(localize_families(families)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
@@ -0,0 +1,138 @@
+# Optional instrumentation for the audio_process.py pipeline.
+# Inside a `with recording(...) as recorder:` block, every `with stage(name):`
+# records its wall time, CPU time and peak allocation (tracemalloc, which sees
+# numpy arrays too). Outside one, stage() returns a shared no-op context
+# manager, so instrumented code costs one function call per stage.
+#
+# A finished recording is a JSON-ready dict: returned in the worker's reply
+# ('metrics': true in the job) and/or appended as one line to METRICS_FILE.
+
+import json
+import os
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# NDJSON file every recording is appended to, None = don't write one
+METRICS_FILE = os.environ.get('AUDIO_METRICS_FILE')
+
+_active = None
+_NO_STAGE = nullcontext()
+
+class MetricsRecorder:
+    """
+    Collects one record: totals for the whole run plus one entry per stage.
+    Nested stages are allowed (e.g. one 'family' per family inside
+    'cross_correlation'); an outer stage's peak includes its inner ones.
+    """
+
+    def __init__(self, trace_memory=True, **info):
+        self.info = info
+        self.trace_memory = trace_memory
+        self.stages = []
+        self._stack = []
+        self._started_tracing = False
+        self.totals = {}
+
+    def __enter__(self):
+        global _active
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._previous = _active
+        _active = self
+        self._wall0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        self.totals = {
+            'wall_sec': time.perf_counter() - self._wall0,
+            'cpu_sec': time.process_time() - self._cpu0,
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+        if self.trace_memory:
+            peak = max([tracemalloc.get_traced_memory()[1]] + [s['peak_bytes'] for s in self.stages])
+            self.totals['peak_bytes'] = peak
+            if self._started_tracing:
+                tracemalloc.stop()
+        _active = self._previous
+        return False
+
+    @contextmanager
+    def stage(self, name, **fields):
+        entry = {'stage': name}
+        entry.update(fields)
+        if self._stack:
+            entry['parent'] = self._stack[-1]['stage']
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                # the parent's peak so far, before the counter is reset for this stage
+                self._stack[-1]['_peak'] = max(self._stack[-1].get('_peak', 0), peak)
+            tracemalloc.reset_peak()
+            entry['_start'] = current
+        self._stack.append(entry)
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+        try:
+            yield entry
+        finally:
+            entry['wall_sec'] = time.perf_counter() - wall0
+            entry['cpu_sec'] = time.process_time() - cpu0
+            self._stack.pop()
+            if self.trace_memory:
+                peak = max(entry.pop('_peak', 0), tracemalloc.get_traced_memory()[1])
+                entry['peak_bytes'] = peak
+                # allocated on top of what was live when the stage started
+                entry['peak_alloc_bytes'] = peak - entry.pop('_start')
+                if self._stack:
+                    self._stack[-1]['_peak'] = max(self._stack[-1].get('_peak', 0), peak)
+                tracemalloc.reset_peak()
+            self.stages.append(entry)
+
+    def to_dict(self):
+        record = dict(self.info)
+        record.update(self.totals)
+        record['stages'] = self.stages
+        return record
+
+def stage(name, **fields):
+    """
+    Context manager timing one stage of the active recording, a no-op when
+    nothing is being recorded.
+    """
+    if _active is None:
+        return _NO_STAGE
+    return _active.stage(name, **fields)
+
+def annotate(**fields):
+    """
+    Add fields to the innermost running stage of the active recording,
+    a no-op when nothing is being recorded.
+    """
+    if _active is not None and _active._stack:
+        _active._stack[-1].update(fields)
+
+def recording(enabled=True, **info):
+    """
+    MetricsRecorder for the with-block, or a no-op context giving None.
+    info (e.g. file=...) is copied into the record.
+    """
+    if not enabled:
+        return nullcontext(None)
+    return MetricsRecorder(**info)
+
+def write_record(record, path=None):
+    """
+    Append record as one JSON line to path (default METRICS_FILE).
+    """
+    path = path or METRICS_FILE
+    if not path:
+        return
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + "\n")
@@ -0,0 +1,155 @@
+# Parallel spike detection and family processing for audio_process.py.
+# The decoded (channels, samples) array is copied once into shared memory and
+# detect_block_spikes runs in a process pool, one task per channel x time
+# chunk, so every core works on the same recording without pickling audio.
+# The merged spike table is identical to detect_all_spikes.
+# Families are cross-correlated concurrently in a thread or process pool
+# (iter_processed_families), yielded in the same order as the serial loop.
+
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import audio_process as ap
+from audio_process import log
+from audio_stream import STREAM_HALO_SEC, detect_block_spikes
+
+################################################################################
+# TUNABLE PARAMETERS
+################################################################################
+
+# !!! TUNABLE PARAMETER: below this many samples (all channels together) detection runs serially
+PARALLEL_MIN_SAMPLES = 48000 * 6 * 5  # ~5 s of 6-channel audio, pool start-up isn't worth it below
+# !!! TUNABLE PARAMETER: shortest time chunk (seconds) handed to one task
+PARALLEL_MIN_CHUNK_SEC = 5.0
+
+# Detection settings copied into every worker, so they match the parent even
+# when workers are spawned (fresh interpreter) rather than forked
+_TUNABLES = ('LOCAL_WINDOW_SIZE', 'LOCAL_WINDOW_STEP', 'THRESHOLD_ENGINE', 'LEAN_DETECTION', 'MAD_FACTOR',
+             'PEAK_PROMINENCE')
+# Same for family processing
+_FAMILY_TUNABLES = ('SLICE_DURATION_SEC', 'MAX_LAG_MS')
+
+################################################################################
+# Worker side
+################################################################################
+
+_shared_audio = None
+_shared_memory = None
+
+def _init_worker(shm_name, shape, dtype, tunables):
+    global _shared_audio, _shared_memory
+    _shared_memory = shared_memory.SharedMemory(name=shm_name)
+    _shared_audio = np.ndarray(shape, dtype=dtype, buffer=_shared_memory.buf)
+    for name, value in tunables.items():
+        setattr(ap, name, value)
+
+def _detect_task(task):
+    ch, core_start, core_end, sr = task
+    n_frames = _shared_audio.shape[1]
+    spikes, _, _ = detect_block_spikes(
+        lambda start, stop: _shared_audio[:, start:stop],
+        n_frames, sr, core_start, core_end, halo=int(STREAM_HALO_SEC * sr), channels=[ch]
+    )
+    # pool processes don't run atexit handlers
+    ap.flush_log()
+    return spikes
+
+def _init_family_worker(tunables):
+    for name, value in tunables.items():
+        setattr(ap, name, value)
+
+def _family_task(task):
+    family_idx, cluster_family, segment, sr, start_sample = task
+    final_info = ap._process_family(family_idx, cluster_family, segment, sr, start_sample)
+    ap.flush_log()
+    return final_info
+
+################################################################################
+# Parent side
+################################################################################
+
+def detect_all_spikes_parallel(audio_data, sample_rate, workers=None):
+    """
+    Parallel detect_all_spikes: same spike table, sorted by time.
+
+    workers: process count (default: os.cpu_count()). Small inputs and
+    workers <= 1 fall back to the serial detect_all_spikes.
+    """
+    num_channels, n_samples = audio_data.shape
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or audio_data.size < PARALLEL_MIN_SAMPLES:
+        return ap.detect_all_spikes(audio_data, sample_rate)
+
+    # split time so there are at least as many tasks as workers
+    min_chunk = max(1, int(PARALLEL_MIN_CHUNK_SEC * sample_rate))
+    n_chunks = max(1, min(math.ceil(workers / num_channels), n_samples // min_chunk))
+    chunk_len = math.ceil(n_samples / n_chunks)
+    tasks = [(ch, start, min(n_samples, start + chunk_len), sample_rate)
+             for ch in range(num_channels)
+             for start in range(0, n_samples, chunk_len)]
+    log(f"Parallel detection: {len(tasks)} tasks ({num_channels} channels x {n_chunks} chunks) on {workers} workers")
+
+    shm = shared_memory.SharedMemory(create=True, size=audio_data.nbytes)
+    try:
+        shared = np.ndarray(audio_data.shape, dtype=audio_data.dtype, buffer=shm.buf)
+        shared[:] = audio_data
+        tunables = {name: getattr(ap, name) for name in _TUNABLES}
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=_init_worker,
+                                 initargs=(shm.name, audio_data.shape, audio_data.dtype, tunables)) as pool:
+            results = list(pool.map(_detect_task, tasks))
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+
+    # same order as the serial channel-by-channel table after its stable time sort
+    all_spikes = ap.spike_table(spike for spikes in results for spike in spikes)
+    log(f"Using local threshold find_peaks, found {len(all_spikes)} total spikes across {num_channels} channels.")
+    return all_spikes
+
+def family_segment(cluster_family, audio_data, sr):
+    """
+    (start_sample, stop_sample) of the audio compute_waveforms reads for
+    one family, so a process only needs that slice.
+    """
+    half = int(sr * ap.SLICE_DURATION_SEC) // 2
+    centers = [int((t_ms/1000)*sr) for _, t_ms in cluster_family]
+    return max(0, min(centers) - half), min(audio_data.shape[1], max(centers) + half)
+
+def iter_processed_families(crackle_families, audio_data, sample_rate, workers=None, executor='thread'):
+    """
+    process_family for every family on a pool of 'workers' threads or
+    processes (default: os.cpu_count()), yielding the results in family
+    order, each as soon as it and the ones before it are done.
+
+    Threads share audio_data; processes get only the slice each family's
+    waveforms are cut from. Per-family metrics stages aren't recorded here,
+    the caller's 'cross_correlation' stage covers the whole pool.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(crackle_families)))
+    log(f"Processing {len(crackle_families)} families on {workers} {executor} workers")
+
+    if executor == 'thread':
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            yield from pool.map(
+                lambda item: ap._process_family(item[0], item[1], audio_data, sample_rate, 0),
+                enumerate(crackle_families)
+            )
+    elif executor == 'process':
+        def tasks():
+            for family_idx, cluster_family in enumerate(crackle_families):
+                start, stop = family_segment(cluster_family, audio_data, sample_rate)
+                yield family_idx, cluster_family, np.array(audio_data[:, start:stop]), sample_rate, start
+        tunables = {name: getattr(ap, name) for name in _FAMILY_TUNABLES}
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_family_worker,
+                                 initargs=(tunables,)) as pool:
+            yield from pool.map(_family_task, tasks(), chunksize=max(1, len(crackle_families) // (4 * workers)))
+    else:
+        raise ValueError(f"Unknown executor: {executor}, expected 'thread' or 'process'")
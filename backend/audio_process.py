@@ -1,17 +1,42 @@
 # import libraries required for receiving audio data and doing audio data processing and manipulation
-#!pip install librosa soundfile numpy scipy matplotlib
+#!pip install soundfile numpy scipy   (librosa only for formats libsndfile can't read)
 #pip install -r requirements.txt
 
 import json
-import librosa
+import importlib.util
 import soundfile as sf
 import numpy as np
-from scipy.io import wavfile
-import matplotlib.pyplot as plt
 from collections import defaultdict
-from scipy import signal
+from numpy.lib.stride_tricks import sliding_window_view
 import sys
 import os
+import atexit
+import threading
+
+def lazy_import(name):
+    """
+    Module that is only really imported when one of its attributes is first
+    used, so entry points that never reach the analysis (e.g. a result cache
+    hit) don't pay for it.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# scipy.signal alone takes ~1 s to import (it pulls in scipy.stats)
+signal = lazy_import('scipy.signal')
+sp_fft = lazy_import('scipy.fft')
+
+import audio_metrics
+import audio_store
+import result_cache
+from audio_metrics import annotate, stage
 
 ################################################################################
 # Logging setup
@@ -19,9 +44,34 @@ import os
 
 # Setup logging to a file instead of stdout
 log_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'audio_process.log')
+# Bytes of log messages kept in memory before they're written out
+LOG_BUFFER_BYTES = 64 * 1024
+_log_handle = None
+# families can be processed on several threads (FAMILY_EXECUTOR)
+_log_lock = threading.Lock()
+
 def log(message):
-    with open(log_file, 'a') as f:
-        f.write(f"{message}\n")
+    # the file is opened once and written through a buffer, flushed when
+    # full, by flush_log() (after every worker job) and at exit
+    global _log_handle
+    with _log_lock:
+        if _log_handle is None:
+            _log_handle = open(log_file, 'a', buffering=LOG_BUFFER_BYTES)
+        _log_handle.write(f"{message}\n")
+
+def flush_log():
+    with _log_lock:
+        if _log_handle is not None:
+            _log_handle.flush()
+
+def _reset_log_lock():
+    # another thread may have held it when the process forked
+    global _log_lock
+    _log_lock = threading.Lock()
+
+atexit.register(flush_log)
+# a forked child (audio_parallel) must not inherit, and later repeat, unwritten messages
+os.register_at_fork(before=flush_log, after_in_child=_reset_log_lock)
 
 ################################################################################
 # TUNABLE PARAMETERS
@@ -31,6 +81,22 @@ def log(message):
 LOCAL_WINDOW_SIZE = 2000  # we can optimize this for quickness, it is computationally intense
 # !!! TUNABLE PARAMETER: evaluate rolling window every 'step' samples
 LOCAL_WINDOW_STEP = 48    # coarser step for faster processing(also can optimize)
+# !!! TUNABLE PARAMETER: rolling median+MAD engine, 'sorted' (vectorized) or 'loop' (original)
+THRESHOLD_ENGINE = 'sorted'  # both give identical thresholds, 'sorted' is ~10x faster
+# !!! TUNABLE PARAMETER: skip blocks that can't hold a spike before full-rate thresholding
+PRESCREEN = True  # same spikes as without it (see detect_spikes_prescreened)
+# !!! TUNABLE PARAMETER: block size (samples) of the pre-screen's max |x| envelope
+PRESCREEN_BLOCK = 256
+# !!! TUNABLE PARAMETER: keep thresholds per step in the signal's dtype and mask |x| in place
+LEAN_DETECTION = True  # same spikes, no full-length median/MAD/threshold/mask arrays
+# Samples find_peaks gets at once in lean detection (it works on a float64 copy)
+FIND_PEAKS_CHUNK = 1 << 16
+# !!! TUNABLE PARAMETER: processes used for spike detection, None = all cores, 1 = serial
+DETECTION_WORKERS = 1  # >1 runs audio_parallel.detect_all_spikes_parallel
+# !!! TUNABLE PARAMETER: families cross-correlated at once, None = all cores, 1 = serial
+FAMILY_WORKERS = 1  # >1 runs audio_parallel.iter_processed_families, same families in the same order
+# !!! TUNABLE PARAMETER: pool used for concurrent families, 'thread' or 'process'
+FAMILY_EXECUTOR = 'thread'  # scipy's FFTs release the GIL; 'process' also overlaps the Python parts
 # !!! TUNABLE PARAMETER: factor multiplied by MAD
 MAD_FACTOR = 3.0  
 # !!! TUNABLE PARAMETER: optional global peak prominence used with find_peaks
@@ -39,14 +105,37 @@ PEAK_PROMINENCE = 0.02  # lenient
 FAMILY_RANGE_MS = 60  
 # !!! TUNABLE PARAMETER: min fraction of channels that must be in a cluster (0.3 => 30%)
 CLUSTER_CHANNEL_FRACTION = 0.3  
+# !!! TUNABLE PARAMETER: respiratory phases analyzed (audio_breath.PHASES), None = whole recording
+BREATH_PHASES = None  # set, families are tagged with their phase; all three phases = tag only
 # !!! TUNABLE PARAMETER: time slice (seconds) for cross-correlation around each spike
 SLICE_DURATION_SEC = 0.18  
+# !!! TUNABLE PARAMETER: max |delay| (ms) searched between channels, None = every lag in the slice
+MAX_LAG_MS = None  # sound crossing the chest takes a few ms; <= 1.6 ms at 48 kHz uses direct dot products
+# !!! TUNABLE PARAMETER: reuse results of files already analyzed with the same parameters (result_cache.py)
+RESULT_CACHE = True
+# !!! TUNABLE PARAMETER: keep decoded recordings and their rolling median/MAD in audio_store.py
+AUDIO_STORE = True  # later analyses memory-map them instead of decoding/recomputing
+
+# Parameters that change the families, part of the result cache key.
+# THRESHOLD_ENGINE, DETECTION_WORKERS, FAMILY_WORKERS, FAMILY_EXECUTOR, PRESCREEN, LEAN_DETECTION and
+# AUDIO_STORE are left out, they give identical results.
+RESULT_PARAMETERS = ('LOCAL_WINDOW_SIZE', 'LOCAL_WINDOW_STEP', 'MAD_FACTOR', 'PEAK_PROMINENCE',
+                     'FAMILY_RANGE_MS', 'CLUSTER_CHANNEL_FRACTION', 'SLICE_DURATION_SEC', 'MAX_LAG_MS',
+                     'BREATH_PHASES')
+
+def tunable_parameters():
+    parameters = {name: globals()[name] for name in RESULT_PARAMETERS}
+    if BREATH_PHASES is not None:
+        # the segmentation decides which spans are analyzed
+        import audio_breath
+        parameters.update(audio_breath.segmentation_parameters())
+    return parameters
 
 ################################################################################
 # Rolling median / MAD utilities
 ################################################################################
 
-def rolling_median_mad(signal_1d, window_size, step):
+def rolling_median_mad(signal_1d, window_size, step, start=0, stop=None, held=True):
     """
     Compute the rolling median and rolling MAD (Median Absolute Deviation)
     over a window of 'window_size' samples, but only do so every 'step' samples
@@ -57,142 +146,680 @@ def rolling_median_mad(signal_1d, window_size, step):
 
     * window_size (e.g., 2000)
     * step (e.g., 48)
+    * start, stop: only return samples [start, stop) (the same values as
+      the whole-signal arrays), evaluating just the anchors they need
+    * held=False: return one value per anchor (every 'step' samples from
+      (start // step) * step) instead of holding them over every sample
     """
     n = len(signal_1d)
-    medians = np.zeros(n)
-    mads = np.zeros(n)
+    if stop is None:
+        stop = n
+    first = (start // step) * step
+    if held:
+        medians = np.zeros(stop - start)
+        mads = np.zeros(stop - start)
+    else:
+        medians = np.zeros(len(range(first, stop, step)))
+        mads = np.zeros(len(medians))
     half_win = window_size // 2
     
-    i = 0
-    while i < n:
-        start = max(0, i - half_win)
-        end = min(n, i + half_win)
-        segment = signal_1d[start:end]
+    i = first
+    while i < stop:
+        seg_start = max(0, i - half_win)
+        seg_end = min(n, i + half_win)
+        segment = signal_1d[seg_start:seg_end]
         med = np.median(segment)
         mad = np.median(np.abs(segment - med))
         
-        # fill up to the next 'step' or end of array
-        fill_end = min(n, i + step)
-        medians[i:fill_end] = med
-        mads[i:fill_end] = mad
+        if held:
+            # fill up to the next 'step' or end of array
+            fill_start = max(i, start)
+            fill_end = min(stop, i + step)
+            medians[fill_start - start:fill_end - start] = med
+            mads[fill_start - start:fill_end - start] = mad
+        else:
+            medians[(i - first) // step] = med
+            mads[(i - first) // step] = mad
         i += step
 
     log("finished rolling mad with window={} and step={}".format(window_size, step))
     return medians, mads
 
-def detect_spikes_local_threshold(signal_1d, sr, window_size=2000, step=48, factor=3.0, peak_prominence=0.0):
+def _sorted_rows_kth_deviation(rows, med, k):
     """
-    Uses a rolling local threshold (median + factor*MAD) computed every 'step'
-    samples to mask out regions of the signal below that threshold, then uses
-    find_peaks to locate local maxima above that threshold.
+    k-th (0-indexed) smallest |rows - med| for every row of 'rows', where
+    each row is sorted ascending and split in half around its median.
 
-    Returns spike_times in milliseconds.
+    Deviations grow outwards from the middle, so they form two ascending
+    sequences (left half read backwards, right half read forwards) and the
+    k-th smallest of their union is found with a vectorized binary search
+    on how many values come from the left half.
+    """
+    num_rows, win = rows.shape
+    half_win = win // 2
+    r = np.arange(num_rows)
+
+    def left(j):
+        return np.abs(rows[r, half_win - 1 - j] - med)
+
+    def right(j):
+        return np.abs(rows[r, half_win + j] - med)
+
+    lo = np.full(num_rows, max(0, k + 1 - (win - half_win)))
+    hi = np.full(num_rows, min(k + 1, half_win))
+    while np.any(lo < hi):
+        active = lo < hi
+        mid = (lo + hi) // 2
+        take_right = k + 1 - mid
+        # left[mid] < right[take_right-1] => take more from the left half
+        more_left = left(np.minimum(mid, half_win - 1)) < right(np.maximum(take_right - 1, 0))
+        more_left &= (mid < half_win) & (take_right > 0)
+        lo = np.where(active & more_left, mid + 1, lo)
+        hi = np.where(active & ~more_left, mid, hi)
+    take_right = k + 1 - lo
+    last_left = left(np.maximum(lo - 1, 0))
+    last_right = right(np.maximum(take_right - 1, 0))
+    last_left = np.where(lo > 0, last_left, last_right)
+    last_right = np.where(take_right > 0, last_right, last_left)
+    return np.maximum(last_left, last_right)
+
+def rolling_median_mad_sorted(signal_nd, window_size, step, block_bytes=8 << 20, start=0, stop=None, held=True):
+    """
+    Same result as rolling_median_mad (bit-for-bit), computed without a
+    per-step Python loop.
+
+    Every full window evaluated at the 'step' anchors is sorted in blocks
+    through a strided view (numpy's SIMD sort), the median is read off the
+    middle of each sorted row, and the MAD is found by a vectorized binary
+    search over the two sorted halves (|x - median| is ascending on either
+    side of the median). Only the few truncated windows at both edges go
+    through np.median.
+
+    Accepts a single channel (n,) or all channels at once (channels, n) and
+    returns median_array, mad_array with the same shape as the input, or
+    only samples [start, stop) of them, or one value per anchor with
+    held=False (as in rolling_median_mad).
+    """
+    data = np.asarray(signal_nd)
+    squeeze = data.ndim == 1
+    data = np.atleast_2d(data)
+    num_ch, n = data.shape
+    if stop is None:
+        stop = n
+    half_win = window_size // 2
+    win = 2 * half_win
+    first = (start // step) * step
+    anchors = np.arange(first, stop, step)
+    med_at = np.zeros((num_ch, len(anchors)), dtype=data.dtype)
+    mad_at = np.zeros((num_ch, len(anchors)), dtype=data.dtype)
+
+    # anchors whose window [i-half_win, i+half_win) lies fully inside the signal
+    full = (anchors >= half_win) & (anchors + half_win <= n) & (win > 0)
+    edge_idx = np.flatnonzero(~full)
+    full_idx = np.flatnonzero(full)
+
+    for a_idx in edge_idx:
+        i = anchors[a_idx]
+        segment = data[:, max(0, i - half_win):min(n, i + half_win)]
+        med = np.median(segment, axis=1)
+        med_at[:, a_idx] = med
+        mad_at[:, a_idx] = np.median(np.abs(segment - med[:, None]), axis=1)
+
+    if len(full_idx) > 0:
+        windows = sliding_window_view(data, win, axis=1)
+        block = max(1, block_bytes // (win * data.itemsize * num_ch))
+        k_lo, k_hi = half_win - 1, half_win
+        for b in range(0, len(full_idx), block):
+            idx = full_idx[b:b + block]
+            starts = anchors[idx] - half_win
+            rows = np.sort(windows[:, starts, :], axis=-1).reshape(-1, win)
+            med = (rows[:, k_lo] + rows[:, k_hi]) / 2
+            mad = (_sorted_rows_kth_deviation(rows, med, k_lo) +
+                   _sorted_rows_kth_deviation(rows, med, k_hi)) / 2
+            med_at[:, idx] = med.reshape(num_ch, -1)
+            mad_at[:, idx] = mad.reshape(num_ch, -1)
+
+    if held:
+        # hold each anchor value until the next anchor, as rolling_median_mad does
+        medians = np.repeat(med_at.astype(np.float64), step, axis=1)[:, start - first:stop - first]
+        mads = np.repeat(mad_at.astype(np.float64), step, axis=1)[:, start - first:stop - first]
+    else:
+        medians = med_at.astype(np.float64)
+        mads = mad_at.astype(np.float64)
+
+    log("finished sorted rolling mad with window={} and step={}".format(window_size, step))
+    if squeeze:
+        return medians[0], mads[0]
+    return medians, mads
+
+ROLLING_MEDIAN_MAD_ENGINES = {
+    'loop': rolling_median_mad,
+    'sorted': rolling_median_mad_sorted,
+}
+
+def step_threshold(medians, mads, factor, dtype):
+    """
+    median + factor*MAD per anchor (float64, as the held arrays give it),
+    as 'dtype' for comparing with |x| of that dtype. Values are rounded up
+    to the next representable one: no 'dtype' value lies strictly between
+    the two, so x < threshold picks the same samples as in float64.
+    """
+    threshold = medians + (factor*mads)
+    lean = threshold.astype(dtype)
+    low = lean < threshold
+    lean[low] = np.nextafter(lean[low], np.array(np.inf, dtype=lean.dtype))
+    return lean
+
+def mask_below_threshold(abs_signal, threshold, offset, step, block_rows=4096):
+    """
+    Set the samples of abs_signal (contiguous) below the threshold of their
+    step to 0, in place. threshold holds one value per anchor; abs_signal[0]
+    lies 'offset' samples after the first one. Whole steps are compared as
+    rows of a (steps, step) view against the broadcast thresholds.
+    """
+    n = len(abs_signal)
+    pos = anchor = 0
+    if offset:
+        head = abs_signal[:min(n, step - offset)]
+        head[head < threshold[0]] = 0.0
+        pos, anchor = len(head), 1
+    rows = (n - pos) // step
+    body = abs_signal[pos:pos + rows*step].reshape(rows, step)
+    for r in range(0, rows, block_rows):
+        part = body[r:r + block_rows]
+        np.copyto(part, 0.0, where=part < threshold[anchor + r:anchor + r + len(part), None])
+    tail = abs_signal[pos + rows*step:]
+    if len(tail):
+        tail[tail < threshold[anchor + rows]] = 0.0
+
+def find_peaks_chunked(masked_signal, prominence, chunk=None):
+    """
+    signal.find_peaks(masked_signal, prominence=prominence)[0], found
+    'chunk' samples at a time so only a chunk is ever copied to float64.
+    Chunks end on a masked (0) sample and the next one starts on it: a
+    prominence is measured down to the lowest point before a higher peak,
+    which is 0 whether or not the search is cut there (as for the
+    pre-screen's regions), and a 0 is never a peak.
+    """
+    chunk = max(2, FIND_PEAKS_CHUNK if chunk is None else chunk)
+    n = len(masked_signal)
+    peaks = [np.zeros(0, dtype=np.intp)]
+    start = 0
+    while start < n:
+        stop = min(n, start + chunk)
+        while stop < n and masked_signal[stop - 1] != 0:
+            zeros = np.flatnonzero(masked_signal[stop:stop + chunk] == 0)
+            stop = stop + zeros[0] + 1 if len(zeros) else min(n, stop + chunk)
+        chunk_peaks, _ = signal.find_peaks(masked_signal[start:stop], prominence=prominence)
+        peaks.append(chunk_peaks + start)
+        start = n if stop == n else stop - 1
+    return np.concatenate(peaks)
+
+def masked_local_threshold(signal_1d, window_size=2000, step=48, factor=3.0, engine='loop', lean=False):
+    """
+    |signal_1d| with every sample below the rolling local threshold
+    (median + factor*MAD, computed every 'step' samples) set to 0.
+
+    'engine' picks the rolling median/MAD implementation, one of
+    ROLLING_MEDIAN_MAD_ENGINES ('loop' or 'sorted', identical output).
+    lean: keep one threshold per step in |signal_1d|'s dtype and mask
+    |signal_1d| in place (step_threshold, mask_below_threshold) instead of
+    holding median, MAD, threshold and a masked copy at float64 per sample.
+    Same output.
     """
     abs_signal = np.abs(signal_1d)
     
     # 1) Compute rolling median + MAD with coarser stepping
-    medians, mads = rolling_median_mad(abs_signal, window_size=window_size, step=step)
+    rolling_fn = ROLLING_MEDIAN_MAD_ENGINES[engine]
+    if lean:
+        medians, mads = rolling_fn(abs_signal, window_size=window_size, step=step, held=False)
+        mask_below_threshold(abs_signal, step_threshold(medians, mads, factor, abs_signal.dtype), 0, step)
+        return abs_signal
+    medians, mads = rolling_fn(abs_signal, window_size=window_size, step=step)
     local_threshold = medians + (factor*mads)
     
     # 2) Mask signal below local threshold
     masked_signal = abs_signal.copy()
     below_mask = masked_signal < local_threshold
     masked_signal[below_mask] = 0.0
+    return masked_signal
+
+def detect_spikes_local_threshold(signal_1d, sr, window_size=2000, step=48, factor=3.0, peak_prominence=0.0,
+                                  engine='loop', lean=False):
+    """
+    Uses a rolling local threshold (median + factor*MAD) computed every 'step'
+    samples to mask out regions of the signal below that threshold, then uses
+    find_peaks to locate local maxima above that threshold.
+
+    'engine' picks the rolling median/MAD implementation, one of
+    ROLLING_MEDIAN_MAD_ENGINES ('loop' or 'sorted', identical output).
+    lean: see masked_local_threshold; find_peaks then runs chunk by chunk
+    (find_peaks_chunked). Same spikes, a fraction of the memory.
+
+    Returns spike_times in milliseconds.
+    """
+    masked_signal = masked_local_threshold(signal_1d, window_size=window_size, step=step,
+                                           factor=factor, engine=engine, lean=lean)
     
     # 3) find_peaks on masked signal with optional global peak_prominence
-    peaks, props = signal.find_peaks(masked_signal, prominence=peak_prominence)
+    if lean:
+        peaks = find_peaks_chunked(masked_signal, peak_prominence)
+    else:
+        peaks, props = signal.find_peaks(masked_signal, prominence=peak_prominence)
     spike_times_ms = (peaks / sr) * 1000.0
     return spike_times_ms
 
+def block_max_envelope(abs_signal, block):
+    """
+    max |x| of every 'block' samples (the last block may be shorter).
+    """
+    return np.maximum.reduceat(abs_signal, np.arange(0, len(abs_signal), block))
+
+def candidate_regions(abs_signal, block, min_height, min_gap):
+    """
+    Pre-screen pass: [start, stop) sample ranges covering every block whose
+    max |x| reaches min_height, padded by one block on each side. Ranges
+    less than min_gap samples apart are merged: every range costs its own
+    threshold and find_peaks calls, short gaps aren't worth skipping.
+
+    Returns an int array of shape (n_regions, 2).
+    """
+    n = len(abs_signal)
+    hot = (block_max_envelope(abs_signal, block) >= min_height).astype(np.int8)
+    edges = np.diff(np.concatenate(([0], hot, [0])))
+    starts = np.maximum(0, (np.flatnonzero(edges == 1) - 1) * block)
+    stops = np.minimum(n, (np.flatnonzero(edges == -1) + 1) * block)
+    if len(starts) > 1:
+        keep = np.concatenate(([True], starts[1:] - stops[:-1] > min_gap))
+        kept = np.flatnonzero(keep)
+        stops = np.append(stops[kept[1:] - 1], stops[-1])
+        starts = starts[kept]
+    return np.stack([starts, stops], axis=1)
+
+def masked_region(abs_signal, start, stop, window_size, step, factor, engine, rolling=None, lean=False):
+    """
+    masked_local_threshold(...)[start:stop] of the whole channel, with the
+    rolling median/MAD only evaluated at the anchors [start, stop) needs.
+
+    rolling: optional (2, n_anchors) array of the channel's median and MAD
+    at every 'step' anchor, NaN where not known yet. Known anchors are used
+    instead of being recomputed, computed ones are filled in.
+    lean: thresholds stay per anchor, see masked_local_threshold.
+    """
+    first = start // step
+    last = -(-stop // step)
+    known = rolling is not None and not np.isnan(rolling[:, first:last]).any()
+    if lean:
+        if known:
+            medians, mads = rolling[:, first:last]
+        else:
+            rolling_fn = ROLLING_MEDIAN_MAD_ENGINES[engine]
+            medians, mads = rolling_fn(abs_signal, window_size=window_size, step=step, start=start, stop=stop,
+                                       held=False)
+            if rolling is not None:
+                rolling[0, first:last] = medians
+                rolling[1, first:last] = mads
+        masked_signal = abs_signal[start:stop].copy()
+        mask_below_threshold(masked_signal, step_threshold(medians, mads, factor, abs_signal.dtype),
+                             start - first*step, step)
+        return masked_signal
+    if known:
+        # hold each anchor value until the next anchor, as the engines do
+        medians, mads = np.repeat(rolling[:, first:last], step, axis=1)[:, start - first*step:stop - first*step]
+    else:
+        rolling_fn = ROLLING_MEDIAN_MAD_ENGINES[engine]
+        medians, mads = rolling_fn(abs_signal, window_size=window_size, step=step, start=start, stop=stop)
+        if rolling is not None:
+            held = np.maximum(np.arange(first, last) * step - start, 0)
+            rolling[0, first:last] = medians[held]
+            rolling[1, first:last] = mads[held]
+    local_threshold = medians + (factor*mads)
+    masked_signal = abs_signal[start:stop].copy()
+    masked_signal[masked_signal < local_threshold] = 0.0
+    return masked_signal
+
+def intersect_ranges(a, b):
+    """
+    Intersection of two sorted lists of disjoint [start, stop) ranges,
+    shape (k, 2) each.
+    """
+    out = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start = max(a[i][0], b[j][0])
+        stop = min(a[i][1], b[j][1])
+        if start < stop:
+            out.append((start, stop))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return np.array(out, dtype=np.int64).reshape(-1, 2)
+
+def in_ranges(samples, ranges):
+    """
+    Which of the sample indices fall in one of the sorted disjoint
+    [start, stop) ranges.
+    """
+    index = np.searchsorted(ranges[:, 0], samples, side='right') - 1
+    inside = index >= 0
+    inside[inside] = samples[inside] < ranges[index[inside], 1]
+    return inside
+
+def detect_spikes_prescreened(signal_1d, sr, window_size=2000, step=48, factor=3.0, peak_prominence=0.0,
+                              engine='loop', block=256, rolling=None, lean=False, ranges=None):
+    """
+    detect_spikes_local_threshold in two passes, with the same result.
+
+    1) Pre-screen: a peak of prominence p in the masked signal is at least
+       p high, so only blocks whose max |x| reaches peak_prominence can
+       hold a spike (candidate_regions).
+    2) The rolling median/MAD threshold and find_peaks run at full rate on
+       those regions only. A region is grown until both of its ends are
+       masked out (0): a prominence is measured down to the lowest point
+       before a higher peak, which is then 0 whether or not the search is
+       cut at the region's ends, so prominences match the whole-channel ones.
+
+    With block=None or peak_prominence <= 0 nothing is skipped and the
+    whole channel is processed. rolling: stored median/MAD anchors, see
+    masked_region. lean: see detect_spikes_local_threshold.
+
+    ranges: only keep spikes in these sorted [start, stop) sample ranges
+    (e.g. audio_breath.phase_ranges). Regions are cut to them before the
+    threshold is computed, then grown as usual, so the spikes are the
+    whole-channel ones that fall in the ranges.
+
+    Returns (spike_times_ms, samples_processed).
+    """
+    n = len(signal_1d)
+    abs_signal = np.abs(signal_1d)
+    if block is None or peak_prominence <= 0:
+        regions = np.array([[0, n]] if n > 0 else [], dtype=np.int64).reshape(-1, 2)
+    else:
+        regions = candidate_regions(abs_signal, block, peak_prominence, window_size)
+    if ranges is not None:
+        regions = intersect_ranges(regions, ranges)
+    # without pre-screen blocks, regions cut by 'ranges' grow a window at a time
+    grow = block if block is not None else window_size
+    peaks = [np.zeros(0, dtype=np.int64)]
+    processed = 0
+    covered = 0
+    for start, stop in regions:
+        while True:
+            masked_signal = masked_region(abs_signal, start, stop, window_size, step, factor, engine, rolling,
+                                          lean)
+            grow_left = start > 0 and masked_signal[0] != 0
+            grow_right = stop < n and masked_signal[-1] != 0
+            if not (grow_left or grow_right):
+                break
+            if grow_left:
+                start = max(0, start - grow)
+            if grow_right:
+                stop = min(n, stop + grow)
+        if lean:
+            region_peaks = find_peaks_chunked(masked_signal, peak_prominence)
+        else:
+            region_peaks, _ = signal.find_peaks(masked_signal, prominence=peak_prominence)
+        peaks.append(region_peaks + start)
+        processed += max(0, stop - max(start, covered))
+        covered = max(covered, stop)
+
+    # grown regions can overlap, a peak found twice is the same peak
+    peaks = np.unique(np.concatenate(peaks))
+    if ranges is not None:
+        # growing may have reached past the ranges
+        peaks = peaks[in_ranges(peaks, ranges)]
+    spike_times_ms = (peaks / sr) * 1000.0
+    return spike_times_ms, processed
+
 ################################################################################
-# Main code
+# Loading
 ################################################################################
 
-# Process input file from command line argument
-input_file = sys.argv[1]
+def raw_capture_options(raw):
+    """
+    Full { channels, sample_rate, sample_bytes } of a raw capture from the
+    (possibly partial) dict a job or the CLI gives, raw_capture.py's
+    defaults filling the rest.
+    """
+    import raw_capture
+    options = {'channels': raw_capture.RAW_CHANNELS, 'sample_rate': raw_capture.RAW_SAMPLE_RATE,
+               'sample_bytes': raw_capture.RAW_SAMPLE_BYTES}
+    for name, value in raw.items():
+        if name not in options:
+            raise ValueError(f"Unknown raw capture option: {name}, expected one of {tuple(options)}")
+        if value is not None:
+            options[name] = int(value)
+    return options
 
-# Load audio file and log shape for debugging
-audio_data, sample_rate = librosa.load(input_file, sr=None, mono=False)
-log(f"Loaded audio data with shape: {audio_data.shape}, type: {type(audio_data)}")
+def input_digest(input_file, raw=None):
+    """
+    Key of input_file in the audio store and result cache: the sha256 of its
+    bytes, combined with the decoding options for a raw capture (the same
+    bytes read as 2 or 6 channels are different recordings).
+    """
+    digest = result_cache.file_digest(input_file)
+    if raw is None:
+        return digest
+    return audio_store.composite_digest('raw', [digest, json.dumps(raw_capture_options(raw), sort_keys=True)])
+
+def recording_info(input_file, raw=None):
+    """
+    (duration_sec, sample_rate, num_channels) of a recording from its header
+    (or size, for a raw capture), without decoding it.
+    """
+    if raw is not None:
+        from raw_capture import capture_frames
+        options = raw_capture_options(raw)
+        frames = capture_frames(input_file, options['channels'], options['sample_bytes'])
+        return frames / options['sample_rate'], options['sample_rate'], options['channels']
+    info = sf.info(input_file)
+    return info.frames / info.samplerate, info.samplerate, info.channels
 
-# Check if the loaded data is a 1D array, which means it's a single channel
-# In this case, reshape it to have shape (1, n_samples) to make it compatible with multi-channel code
-if audio_data.ndim == 1:
-    log(f"Reshaping 1D array of length {len(audio_data)} to 2D array with 1 channel")
-    audio_data = np.reshape(audio_data, (1, -1))
-    log(f"New shape: {audio_data.shape}")
+def load_audio(input_file, raw=None):
+    """
+    Load a (multi-channel) audio file at its native sample rate. With raw
+    (a dict of raw_capture_options) input_file is a headerless 24-bit I2S
+    capture, decoded by raw_capture.py.
+
+    Returns audio_data with shape (num_channels, n_samples) and sample_rate.
+    """
+    if raw is not None:
+        from raw_capture import load_raw_capture
+        audio_data, sample_rate = load_raw_capture(input_file, **raw_capture_options(raw))
+        log(f"Loaded raw capture with shape: {audio_data.shape}, sample rate: {sample_rate}")
+        return audio_data, sample_rate
+    try:
+        # what librosa.load(sr=None, mono=False) does for these files, without importing librosa
+        with sf.SoundFile(input_file) as sound_file:
+            sample_rate = sound_file.samplerate
+            audio_data = sound_file.read(dtype='float32', always_2d=False).T
+    except RuntimeError:
+        # e.g. mp3 with an old libsndfile: librosa falls back to audioread
+        import librosa
+        audio_data, sample_rate = librosa.load(input_file, sr=None, mono=False)
+    log(f"Loaded audio data with shape: {audio_data.shape}, type: {type(audio_data)}")
 
-num_channels = audio_data.shape[0]
-n_samples = audio_data.shape[1]
+    # Check if the loaded data is a 1D array, which means it's a single channel
+    # In this case, reshape it to have shape (1, n_samples) to make it compatible with multi-channel code
+    if audio_data.ndim == 1:
+        log(f"Reshaping 1D array of length {len(audio_data)} to 2D array with 1 channel")
+        audio_data = np.reshape(audio_data, (1, -1))
+        log(f"New shape: {audio_data.shape}")
 
-###############################################################################
-# 1) Use local threshold + find_peaks for spike detection in each channel
-###############################################################################
-
-all_spikes = []
-for ch in range(num_channels):
-    channel_data = audio_data[ch]
-    times_ms = detect_spikes_local_threshold(
-        signal_1d=channel_data,
-        sr=sample_rate,
-        window_size=LOCAL_WINDOW_SIZE,
-        step=LOCAL_WINDOW_STEP,
-        factor=MAD_FACTOR,
-        peak_prominence=PEAK_PROMINENCE
-    )
-    for t_ms in times_ms:
-        all_spikes.append((ch, t_ms))
-
-# Sort all spikes by ascending time
-all_spikes.sort(key=lambda x: x[1])
-log(f"Using local threshold find_peaks, found {len(all_spikes)} total spikes across {num_channels} channels.")
+    return audio_data, sample_rate
+
+def load_audio_stored(input_file, digest=None, raw=None):
+    """
+    load_audio through the audio store (audio_store.py): a recording decoded
+    before is memory-mapped from its .npy, a new one is decoded and stored.
+    digest: input_digest of input_file, when already known.
+
+    Returns (audio_data, sample_rate, digest), digest being None when
+    AUDIO_STORE is off.
+    """
+    if not AUDIO_STORE:
+        audio_data, sample_rate = load_audio(input_file, raw)
+        return audio_data, sample_rate, None
+    if digest is None:
+        digest = input_digest(input_file, raw)
+    stored = audio_store.get_audio(digest)
+    if stored is not None:
+        audio_data, meta = stored
+        log(f"Audio store hit for {input_file}: {audio_data.shape} memory-mapped")
+        return audio_data, meta['sample_rate'], digest
+    audio_data, sample_rate = load_audio(input_file, raw)
+    audio_store.put_audio(digest, audio_data, sample_rate, source=os.path.basename(input_file))
+    log(f"Stored decoded {input_file}: {audio_store.stats()}")
+    return audio_data, sample_rate, digest
+
+def load_combined_stored(input_paths):
+    """
+    combine_wav.load_combined through the audio store, keyed on the inputs'
+    digests in channel order. Returns (audio_data, sample_rate, digest).
+    """
+    from combine_wav import load_combined
+    if not AUDIO_STORE:
+        audio_data, sample_rate = load_combined(input_paths)
+        return audio_data, sample_rate, None
+    digest = audio_store.composite_digest('combine', [result_cache.file_digest(p) for p in input_paths])
+    stored = audio_store.get_audio(digest)
+    if stored is not None:
+        audio_data, meta = stored
+        log(f"Audio store hit for {len(input_paths)} combined files: {audio_data.shape} memory-mapped")
+        return audio_data, meta['sample_rate'], digest
+    audio_data, sample_rate = load_combined(input_paths)
+    audio_store.put_audio(digest, audio_data, sample_rate, sources=[os.path.basename(p) for p in input_paths])
+    log(f"Stored combined {len(input_paths)} files: {audio_store.stats()}")
+    return audio_data, sample_rate, digest
 
 ################################################################################
-# 2) Clustering spikes into families
+# 1) Use local threshold + find_peaks for spike detection in each channel
 ################################################################################
 
-from collections import defaultdict
+# A spike table is a structured array with one row per spike, sorted by time
+# (then channel), so clustering and refinement run on whole columns at once.
+SPIKE_DTYPE = np.dtype([('channel', np.int64), ('time_ms', np.float64)])
 
-clusters = defaultdict(list)
-cluster_id = 0
+def spike_table(spikes):
+    """
+    Spike table from an iterable of (channel, time_ms), sorted by time and
+    channel.
+    """
+    table = np.array(list(spikes), dtype=SPIKE_DTYPE)
+    return table[np.lexsort((table['channel'], table['time_ms']))]
 
-if len(all_spikes) > 0:
-    clusters[cluster_id].append(all_spikes[0])
-    
-    for i in range(1, len(all_spikes)):
-        ch_i, t_i = all_spikes[i]
-        _, prev_t = clusters[cluster_id][-1]
-        # If gap bigger than FAMILY_RANGE_MS => new cluster
-        if (t_i - prev_t) > FAMILY_RANGE_MS:
-            cluster_id += 1
-        clusters[cluster_id].append((ch_i, t_i))
+def detect_all_spikes(audio_data, sample_rate, rolling=None, ranges=None):
+    """
+    Run detect_spikes_local_threshold on every channel.
+
+    rolling: optional (2, num_channels, n_anchors) median/MAD anchors for
+    LOCAL_WINDOW_SIZE/STEP, NaN where unknown, reused and filled in (see
+    stored_rolling).
+    ranges: only detect in these sample ranges, see detect_spikes_prescreened.
+
+    Returns a spike table (SPIKE_DTYPE) sorted by ascending time, channel
+    order on ties.
+    """
+    num_channels = audio_data.shape[0]
+    channels = []
+    times = []
+    processed = 0
+    for ch in range(num_channels):
+        channel_data = audio_data[ch]
+        if PRESCREEN or rolling is not None or ranges is not None:
+            times_ms, channel_processed = detect_spikes_prescreened(
+                signal_1d=channel_data,
+                sr=sample_rate,
+                window_size=LOCAL_WINDOW_SIZE,
+                step=LOCAL_WINDOW_STEP,
+                factor=MAD_FACTOR,
+                peak_prominence=PEAK_PROMINENCE,
+                engine=THRESHOLD_ENGINE,
+                block=PRESCREEN_BLOCK if PRESCREEN else None,
+                rolling=None if rolling is None else rolling[:, ch],
+                lean=LEAN_DETECTION,
+                ranges=ranges
+            )
+            processed += channel_processed
+        else:
+            times_ms = detect_spikes_local_threshold(
+                signal_1d=channel_data,
+                sr=sample_rate,
+                window_size=LOCAL_WINDOW_SIZE,
+                step=LOCAL_WINDOW_STEP,
+                factor=MAD_FACTOR,
+                peak_prominence=PEAK_PROMINENCE,
+                engine=THRESHOLD_ENGINE,
+                lean=LEAN_DETECTION
+            )
+        channels.append(np.full(len(times_ms), ch, dtype=np.int64))
+        times.append(times_ms)
+
+    if (PRESCREEN or ranges is not None) and audio_data.size > 0:
+        skipped = 1.0 - processed / audio_data.size
+        log(f"Pre-screen skipped {100.0 * skipped:.1f}% of the samples (max |x| below {PEAK_PROMINENCE}"
+            f"{'' if ranges is None else ' or outside ' + str(BREATH_PHASES)})")
+        annotate(prescreen_skipped=float(skipped))
 
+    all_spikes = np.empty(sum(len(t) for t in times), dtype=SPIKE_DTYPE)
+    if num_channels > 0:
+        all_spikes['channel'] = np.concatenate(channels)
+        all_spikes['time_ms'] = np.concatenate(times)
+    # Sort all spikes by ascending time (stable, so channel order on ties)
+    all_spikes = all_spikes[np.argsort(all_spikes['time_ms'], kind='stable')]
+    log(f"Using local threshold find_peaks, found {len(all_spikes)} total spikes across {num_channels} channels.")
+    return all_spikes
 
-log(f"Found {len(clusters)} initial clusters (based on {FAMILY_RANGE_MS} ms gap).")
+################################################################################
+# 2) Clustering spikes into families
+################################################################################
+
+def cluster_spikes(all_spikes, num_channels):
+    """
+    Group time-sorted spikes into clusters separated by gaps larger than
+    FAMILY_RANGE_MS, then drop clusters that don't span enough channels.
+
+    all_spikes: spike table from detect_all_spikes.
+    Returns an int array of shape (n_clusters, 2), the [start, stop) rows of
+    all_spikes in each kept cluster.
+    """
+    times = all_spikes['time_ms']
+    n = len(times)
+    # a new cluster starts at the first spike and after every gap bigger than FAMILY_RANGE_MS
+    starts = np.flatnonzero(np.diff(times) > FAMILY_RANGE_MS) + 1
+    if n > 0:
+        starts = np.concatenate(([0], starts))
+    stops = np.append(starts[1:], n)[:len(starts)]
+    log(f"Found {len(starts)} initial clusters (based on {FAMILY_RANGE_MS} ms gap).")
 
-# Filter out clusters that aren't on enough channels
-filtered_clusters = []
-channel_req = max(2, int(num_channels * CLUSTER_CHANNEL_FRACTION))
-for c_id, clist in clusters.items():
-    unique_chs = set(x[0] for x in clist)
-    if len(unique_chs) >= channel_req:
-        filtered_clusters.append(clist)
+    # Filter out clusters that aren't on enough channels
+    channel_req = max(2, int(num_channels * CLUSTER_CHANNEL_FRACTION))
+    cluster_ids = np.repeat(np.arange(len(starts)), stops - starts)
+    pairs = np.unique(cluster_ids * num_channels + all_spikes['channel'])
+    unique_chs = np.bincount(pairs // num_channels, minlength=len(starts))
+    keep = unique_chs >= channel_req
+    filtered_clusters = np.stack([starts[keep], stops[keep]], axis=1)
 
-log(f"After filtering, {len(filtered_clusters)} clusters remain.")
+    log(f"After filtering, {len(filtered_clusters)} clusters remain.")
+    return filtered_clusters
 
 ################################################################################
 # 3) Refining each cluster: pick the single max amplitude spike per channel
 ################################################################################
 
-def refine_cluster(cluster_spikes, audio_data, sr):
+def refine_cluster(cluster_spikes, audio_data, sr, start_sample=0):
     """
     For each channel in cluster_spikes, pick the spike with 
     the highest amplitude in that channel. Return a sorted 
     list (by channel) of (channel, time_ms).
+
+    start_sample: recording sample index of audio_data[:, 0], for when only
+    a segment of the recording is in memory (streaming mode).
     """
     ch_max = {}
     for (ch, t_ms) in cluster_spikes:
-        idx = int((t_ms/1000.0)*sr)
+        idx = int((t_ms/1000.0)*sr) - start_sample
         if idx < audio_data.shape[1]:
             amp = abs(audio_data[ch, idx])
             if ch not in ch_max or amp > ch_max[ch][0]:
@@ -201,13 +828,42 @@ def refine_cluster(cluster_spikes, audio_data, sr):
     refined.sort(key=lambda x: x[0])
     return refined
 
-crackle_families = []
+def refine_clusters(all_spikes, filtered_clusters, audio_data, sr):
+    """
+    refine_cluster for every filtered cluster at once: per cluster and
+    channel, the spike with the highest |amplitude| (the earliest one on ties).
+
+    Returns the crackle families, each a list of (channel, time_ms) sorted
+    by channel.
+    """
+    lengths = filtered_clusters[:, 1] - filtered_clusters[:, 0]
+    cluster_ids = np.repeat(np.arange(len(filtered_clusters)), lengths)
+    # row of every spike in the kept clusters
+    offsets = np.cumsum(lengths) - lengths
+    rows = np.arange(lengths.sum()) + np.repeat(filtered_clusters[:, 0] - offsets, lengths)
+    channels = all_spikes['channel'][rows]
+    times = all_spikes['time_ms'][rows]
+    idx = ((times/1000.0)*sr).astype(np.int64)
+
+    valid = idx < audio_data.shape[1]
+    cluster_ids, channels, times, idx, rows = \
+        cluster_ids[valid], channels[valid], times[valid], idx[valid], rows[valid]
+    amps = np.abs(audio_data[channels, idx])
+
+    # per (cluster, channel): highest amplitude first, then earliest
+    order = np.lexsort((rows, -amps, channels, cluster_ids))
+    cluster_ids, channels, times = cluster_ids[order], channels[order], times[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (cluster_ids[1:] != cluster_ids[:-1]) | (channels[1:] != channels[:-1])
+    cluster_ids, channels, times = cluster_ids[first], channels[first], times[first]
 
-for clist in filtered_clusters:
-    refined = refine_cluster(clist, audio_data, sample_rate)
-    crackle_families.append(refined)
+    bounds = np.searchsorted(cluster_ids, np.arange(len(filtered_clusters) + 1))
+    channels = channels.tolist()
+    times = times.tolist()
+    crackle_families = [list(zip(channels[lo:hi], times[lo:hi])) for lo, hi in zip(bounds[:-1], bounds[1:])]
 
-log(f"Found {len(crackle_families)} crackle families after refinement.")
+    log(f"Found {len(crackle_families)} crackle families after refinement.")
+    return crackle_families
 
 ################################################################################
 # 4) Pairwise cross-correlation approach
@@ -217,9 +873,10 @@ log(f"Found {len(crackle_families)} crackle families after refinement.")
 #    * Recompute final delays/transmissions wrt that leader
 ################################################################################
 
-def compute_waveforms(cluster_family, audio_data, sr):
+def compute_waveforms(cluster_family, audio_data, sr, start_sample=0):
     """
     Extract waveforms around each channel's spike in cluster_family
+    start_sample: recording sample index of audio_data[:, 0] (see refine_cluster)
     Returns: waveforms dict => channel -> 1D waveform
     """
     slice_len = int(sr * SLICE_DURATION_SEC)  # e.g. 180ms
@@ -227,23 +884,164 @@ def compute_waveforms(cluster_family, audio_data, sr):
     for (ch, t_ms) in cluster_family:
         center = int((t_ms/1000)*sr)
         start = max(0, center - slice_len//2)
-        end = min(audio_data.shape[1], center + slice_len//2)
-        wave = audio_data[ch, start:end]
+        end = min(start_sample + audio_data.shape[1], center + slice_len//2)
+        wave = audio_data[ch, start - start_sample:end - start_sample]
         waveforms[ch] = wave
     return waveforms
 
-def compute_pairwise_data(waveforms, sr):
+# Widest lag window (in lags) evaluated with direct dot products, above this
+# the batched FFT is cheaper. Measured with benchmark.py --lag-bounds on 6
+# channels, 0.18 s slices: direct is ~45% cheaper at 97 lags, ~25% at 145,
+# break-even around 200
+DIRECT_LAG_SEARCH_MAX = 160
+
+def max_lag_samples(sr):
+    """
+    MAX_LAG_MS in samples, or None when the lag search is unbounded.
+    """
+    if MAX_LAG_MS is None:
+        return None
+    return int(round(MAX_LAG_MS / 1000.0 * sr))
+
+def _restrict_lags(cc, lags, sr):
+    """
+    Keep only the lags allowed by MAX_LAG_MS (per-pair fallback path).
+    """
+    max_lag = max_lag_samples(sr)
+    if max_lag is None:
+        return cc, lags
+    keep = np.abs(lags) <= max_lag
+    return cc[keep], lags[keep]
+
+def prepare_family_correlation(waveforms, sr):
+    """
+    Set up batched cross-correlation for one family.
+
+    Without MAX_LAG_MS, FFT every channel's waveform, and its time-reverse,
+    once for the whole family so all cross-correlations can be taken from
+    products of these spectra (the same transforms signal.correlate would
+    compute per pair).
+
+    With MAX_LAG_MS, only lags within +-MAX_LAG_MS are searched. Narrow lag
+    windows (up to DIRECT_LAG_SEARCH_MAX lags) are evaluated as direct dot
+    products between the stacked waveforms (see correlate_bounded), which
+    is cheaper than any FFT; wider ones still use the spectra and only
+    restrict the argmax.
+
+    Returns a dict used by correlate_pairs, or None when the family
+    can't use the batched path (unequal slice lengths at the recording
+    edges, very short slices, or sizes where signal.correlate would use
+    the direct method). Callers then fall back to per-pair correlation.
+    """
+    chans = list(waveforms.keys())
+    lengths = set(len(w) for w in waveforms.values())
+    if len(lengths) != 1:
+        return None
+    n = lengths.pop()
+    if n < 5:
+        return None
+    stacked = np.stack([waveforms[ch] for ch in chans])
+    corr = {
+        'row': {ch: i for i, ch in enumerate(chans)},
+        'n': n,
+        'cc': {},
+    }
+
+    max_lag = max_lag_samples(sr)
+    if max_lag is not None:
+        max_lag = min(max_lag, n - 1)
+        if 2*max_lag + 1 <= DIRECT_LAG_SEARCH_MAX:
+            corr['stacked'] = stacked
+            corr['lags'] = np.arange(-max_lag, max_lag + 1)
+            return corr
+
+    if signal.choose_conv_method(stacked[0], stacked[0][::-1], mode='full') != 'fft':
+        return None
+    nfft = sp_fft.next_fast_len(2*n - 1, real=True)
+    lags = signal.correlation_lags(n, n, mode='full')
+    corr['lag_slice'] = slice(None)
+    if max_lag is not None:
+        corr['lag_slice'] = slice(n - 1 - max_lag, n + max_lag)
+    corr['lags'] = lags[corr['lag_slice']]
+    corr['nfft'] = nfft
+    corr['spec'] = sp_fft.rfft(stacked, nfft, axis=-1)
+    corr['spec_rev'] = sp_fft.rfft(stacked[:, ::-1], nfft, axis=-1)
+    return corr
+
+def correlate_pairs(corr, pairs):
+    """
+    For each (ch_a, ch_b) in pairs return the cross-correlation of
+    waveforms[ch_b] against waveforms[ch_a] over corr['lags'].
+    """
+    if 'spec' in corr:
+        return [cc[corr['lag_slice']] for cc in correlate_from_spectra(corr, pairs)]
+    return correlate_bounded(corr, pairs)
+
+def correlate_from_spectra(corr, pairs):
+    """
+    For each (ch_a, ch_b) in pairs return
+    signal.correlate(waveforms[ch_b], waveforms[ch_a], mode='full'),
+    bit-identical to calling it directly. Missing pairs are computed in
+    one stacked inverse FFT and cached in corr for later passes.
+    """
+    missing = [p for p in dict.fromkeys(pairs) if p not in corr['cc']]
+    if missing:
+        rows_a = [corr['row'][a] for a, _ in missing]
+        rows_b = [corr['row'][b] for _, b in missing]
+        product = corr['spec'][rows_b] * corr['spec_rev'][rows_a]
+        cc = sp_fft.irfft(product, corr['nfft'], axis=-1)[:, :2*corr['n'] - 1]
+        for pair, cc_row in zip(missing, cc):
+            corr['cc'][pair] = cc_row
+    return [corr['cc'][p] for p in pairs]
+
+def correlate_bounded(corr, pairs):
+    """
+    Cross-correlation restricted to corr['lags'] (+-MAX_LAG_MS).
+
+    On first use every channel pair is evaluated at once: for each lag,
+    one (channels x samples) @ (samples x channels) product of the
+    overlapping parts of the stacked waveforms gives that lag's value
+    for all pairs, i.e. cc[a, b, lag] = sum_t w_a[t] * w_b[t + lag].
+    """
+    if 'cc_all' not in corr:
+        stacked = corr['stacked']
+        n = corr['n']
+        cc_all = np.empty((len(stacked), len(stacked), len(corr['lags'])), dtype=stacked.dtype)
+        for k, lag in enumerate(corr['lags']):
+            if lag >= 0:
+                cc_all[:, :, k] = stacked[:, :n - lag] @ stacked[:, lag:].T
+            else:
+                cc_all[:, :, k] = stacked[:, -lag:] @ stacked[:, :n + lag].T
+        corr['cc_all'] = cc_all
+    return [corr['cc_all'][corr['row'][a], corr['row'][b]] for a, b in pairs]
+
+def compute_pairwise_data(waveforms, sr, corr=None):
     """
     waveforms: channel -> 1D array
     We compute two things for each pair (ch1, ch2):
       - The cross-correlation peak value
       - The best alignment delay (ms)
 
+    corr: optional prepare_family_correlation result; when given, all
+    pairs are computed in one batch (see correlate_pairs) instead of one
+    signal.correlate call per pair.
+
     Returns a dict:
       pairwise_info[ch1][ch2] = (peak_value, delay_ms)
     """
     chans = list(waveforms.keys())
     pairwise_info = defaultdict(dict)
+    if corr is not None:
+        pairs = [(chans[i], chans[j]) for i in range(len(chans)) for j in range(i+1, len(chans))]
+        lags = corr['lags']
+        for (ch1, ch2), cc in zip(pairs, correlate_pairs(corr, pairs)):
+            idx = np.argmax(cc)
+            peak_val = cc[idx]  # max cross-corr
+            delay_ms = (lags[idx]/sr)*1000.0
+            pairwise_info[ch1][ch2] = (peak_val, delay_ms)
+            pairwise_info[ch2][ch1] = (peak_val, -delay_ms)
+        return pairwise_info
+
     for i in range(len(chans)):
         ch1 = chans[i]
         w1 = waveforms[ch1]
@@ -259,6 +1057,7 @@ def compute_pairwise_data(waveforms, sr):
             w2_trim = w2[:min_len]
             cc = signal.correlate(w2_trim, w1_trim, mode='full')
             lags = signal.correlation_lags(len(w1_trim), len(w2_trim), mode='full')
+            cc, lags = _restrict_lags(cc, lags, sr)
             idx = np.argmax(cc)
             peak_val = cc[idx]  # max cross-corr
             delay_samples = 0
@@ -295,14 +1094,20 @@ def select_leader_by_highest_transmission(cluster_family, pairwise_info):
             best_ch = ch
     return best_ch
 
-def compute_final_delays_transmissions(leader_ch, waveforms, cluster_family, sr):
+def compute_final_delays_transmissions(leader_ch, waveforms, cluster_family, sr, corr=None):
     """
     For the chosen leader_ch, compute each channel's final delay & 
     transmission_coefficient by cross-correlating that channel's 
     waveform with the leader's.
+    corr: optional prepare_family_correlation result, reusing the spectra
+    (and any leader pairs already correlated) from compute_pairwise_data.
+    With MAX_LAG_MS set, only lags within +-MAX_LAG_MS are considered.
     Return a list of dict => each dict has 
         { channel, delay, transmission_coefficient, time }
     """
+    if corr is not None:
+        return _final_delays_from_spectra(leader_ch, cluster_family, sr, corr)
+
     leader_wave = waveforms[leader_ch]
     leader_ac = signal.correlate(leader_wave, leader_wave, mode='full')
     leader_ac_peak = np.max(leader_ac) if len(leader_ac)>0 else 1e-9
@@ -331,6 +1136,7 @@ def compute_final_delays_transmissions(leader_ch, waveforms, cluster_family, sr)
             w_sub = w_ch[:min_len]
             cc = signal.correlate(w_sub, w_lead, mode='full')
             lags = signal.correlation_lags(len(w_lead), len(w_sub), mode='full')
+            cc, lags = _restrict_lags(cc, lags, sr)
             idx = np.argmax(cc)
             delay_ms = 0.0
             if idx < len(lags):
@@ -345,51 +1151,296 @@ def compute_final_delays_transmissions(leader_ch, waveforms, cluster_family, sr)
             })
     return results
 
+def _final_delays_from_spectra(leader_ch, cluster_family, sr, corr):
+    """
+    compute_final_delays_transmissions for the batched path: the leader's
+    autocorrelation and every channel-vs-leader correlation in one pass.
+    """
+    others = [ch for (ch, _) in cluster_family if ch != leader_ch]
+    pairs = [(leader_ch, leader_ch)] + [(leader_ch, ch) for ch in others]
+    cc_rows = correlate_pairs(corr, pairs)
+    leader_ac_peak = np.max(cc_rows[0])
+    cc_by_ch = dict(zip(others, cc_rows[1:]))
+    lags = corr['lags']
+
+    results = []
+    for (ch, t_ms) in cluster_family:
+        if ch == leader_ch:
+            results.append({
+                'channel': int(ch),
+                'delay': 0.0,
+                'transmission_coefficient': 1.0,
+                'time': float(t_ms)
+            })
+            continue
+        cc = cc_by_ch[ch]
+        idx = np.argmax(cc)
+        delay_ms = (lags[idx]/sr)*1000.0
+        trans = cc[idx]/leader_ac_peak if leader_ac_peak!=0 else 0.0
+        results.append({
+            'channel': int(ch),
+            'delay': float(delay_ms),
+            'transmission_coefficient': float(trans),
+            'time': float(t_ms)
+        })
+    return results
+
 ################################################################################
 # Process each refined cluster with cross-correlation, now choosing the leader
 # by highest cross-corr peak sum => "leader_by_transmission"
 ################################################################################
 
+def process_family(family_idx, cluster_family, audio_data, sample_rate, start_sample=0):
+    with stage('family', family=family_idx, channels=len(cluster_family)):
+        return _process_family(family_idx, cluster_family, audio_data, sample_rate, start_sample)
 
-cross_correlation_families = []
-
-for family_idx, cluster_family in enumerate(crackle_families):
+def _process_family(family_idx, cluster_family, audio_data, sample_rate, start_sample):
     log(f"Processing family {family_idx+1} with {len(cluster_family)} channels/spikes")
 
     # 1) Extract waveforms
-    waveforms = compute_waveforms(cluster_family, audio_data, sample_rate)
+    waveforms = compute_waveforms(cluster_family, audio_data, sample_rate, start_sample=start_sample)
 
-    # 2) Pairwise cross-correlation data (peak, delay)
-    pairwise_info = compute_pairwise_data(waveforms, sample_rate)
+    # 2) Pairwise cross-correlation data (peak, delay), FFT of each waveform computed once
+    corr = prepare_family_correlation(waveforms, sample_rate)
+    pairwise_info = compute_pairwise_data(waveforms, sample_rate, corr=corr)
 
     # 3) Choose leader by highest sum of cross-corr peaks
     leader_ch = select_leader_by_highest_transmission(cluster_family, pairwise_info)
     log(f"Family {family_idx+1}: chosen leader channel (highest xcorr sum) = {leader_ch}")
 
     # 4) Compute final delays & transmissions
-    final_info = compute_final_delays_transmissions(leader_ch, waveforms, cluster_family, sample_rate)
+    return compute_final_delays_transmissions(leader_ch, waveforms, cluster_family, sample_rate, corr=corr)
 
-    cross_correlation_families.append(final_info)
-
-# Log number of final families
-log(f"Generated {len(cross_correlation_families)} cross-correlation families")
+def make_dummy_family(max_indices, sample_rate):
+    """
+    Placeholder family used when nothing was detected, so the frontend
+    always has something to draw. Its entries carry 'placeholder': True
+    (is_dummy_family), so it is never taken for a detected crackle.
 
-# If no crackle families were found, create a dummy family for testing
-if len(cross_correlation_families) == 0:
+    max_indices: per channel, the sample index of the highest |amplitude|.
+    """
     log("No crackle families found, creating a dummy family for testing")
     dummy_family = []
-    for channel in range(num_channels):
-        # Find a high-amplitude point in each channel
-        max_index = np.argmax(np.abs(audio_data[channel]))
+    for channel, max_index in enumerate(max_indices):
+        # Place each channel at its high-amplitude point
         time_ms = float(max_index / sample_rate * 1000)
         dummy_family.append({
             'channel': int(channel),
             'delay': float(channel * 5.0),  # fake delay values
             'transmission_coefficient': 1.0 / (channel + 1.0),  # fake transmission coefficient
-            'time': time_ms
+            'time': time_ms,
+            'placeholder': True
         })
-    cross_correlation_families.append(dummy_family)
     log(f"Created dummy family with {len(dummy_family)} channels")
+    return dummy_family
+
+def is_dummy_family(family):
+    """
+    Whether a family is make_dummy_family's placeholder, not a detected
+    crackle: its entries are marked 'placeholder'.
+    """
+    return bool(family) and family[0].get('placeholder', False)
+
+################################################################################
+# Pipeline entry points
+################################################################################
+
+def analyze_audio(audio_data, sample_rate):
+    """
+    Run the full pipeline (detection, clustering, refinement and
+    cross-correlation) on audio_data of shape (num_channels, n_samples).
+
+    Returns the crackle families: a list of families, each a list of
+    { channel, delay, transmission_coefficient, time } dicts.
+    """
+    return list(iter_families(audio_data, sample_rate))
+
+def iter_families(audio_data, sample_rate, rolling=None):
+    """
+    analyze_audio as a generator: each family is yielded as soon as it has
+    been cross-correlated.
+
+    rolling: stored median/MAD anchors for serial detection, see
+    detect_all_spikes.
+
+    With BREATH_PHASES set, the recording is first split into breath
+    phases (audio_breath.py), spikes are only detected in the chosen ones
+    and every family gets a 'phase' entry.
+    """
+    num_channels = audio_data.shape[0]
+
+    segments = ranges = None
+    if BREATH_PHASES is not None:
+        import audio_breath
+        with stage('breath_segmentation'):
+            segments = audio_breath.segment_recording(audio_data, sample_rate)
+            ranges = audio_breath.phase_ranges(segments, BREATH_PHASES, sample_rate, audio_data.shape[1])
+        log(f"Breath segmentation: {audio_breath.breath_summary(segments)}, analyzing {BREATH_PHASES} "
+            f"({int(np.sum(ranges[:, 1] - ranges[:, 0]))} of {audio_data.shape[1]} samples)")
+
+    with stage('detection', channels=num_channels, samples=audio_data.shape[1]):
+        if DETECTION_WORKERS == 1:
+            all_spikes = detect_all_spikes(audio_data, sample_rate, rolling=rolling, ranges=ranges)
+        else:
+            # CPU time of the pool's processes isn't included
+            from audio_parallel import detect_all_spikes_parallel
+            all_spikes = detect_all_spikes_parallel(audio_data, sample_rate, workers=DETECTION_WORKERS)
+            if ranges is not None:
+                samples = np.rint(all_spikes['time_ms'] * sample_rate / 1000.0).astype(np.int64)
+                all_spikes = all_spikes[in_ranges(samples, ranges)]
+    with stage('clustering', spikes=len(all_spikes)):
+        filtered_clusters = cluster_spikes(all_spikes, num_channels)
+    with stage('refinement', clusters=len(filtered_clusters)):
+        crackle_families = refine_clusters(all_spikes, filtered_clusters, audio_data, sample_rate)
+
+    max_lag = max_lag_samples(sample_rate)
+    if max_lag is not None:
+        slice_len = 2 * (int(sample_rate * SLICE_DURATION_SEC) // 2)
+        full_lags = max(1, 2 * slice_len - 1)
+        searched = min(2 * max_lag + 1, full_lags)
+        method = 'direct dot products' if searched <= DIRECT_LAG_SEARCH_MAX else 'FFT'
+        log(f"Lag search bounded to +-{MAX_LAG_MS} ms: {searched} of {full_lags} lags per pair "
+            f"({100.0 * searched / full_lags:.1f}% of the full correlation), using {method}")
+
+    n_families = 0
+    with stage('cross_correlation', families=len(crackle_families)):
+        if FAMILY_WORKERS == 1 or len(crackle_families) < 2:
+            processed = (process_family(family_idx, cluster_family, audio_data, sample_rate)
+                         for family_idx, cluster_family in enumerate(crackle_families))
+        else:
+            from audio_parallel import iter_processed_families
+            processed = iter_processed_families(crackle_families, audio_data, sample_rate,
+                                                workers=FAMILY_WORKERS, executor=FAMILY_EXECUTOR)
+        for final_info in processed:
+            n_families += 1
+            if segments is not None:
+                audio_breath.tag_family(final_info, audio_breath.family_phase(final_info, segments))
+            yield final_info
+
+    # Log number of final families
+    log(f"Generated {n_families} cross-correlation families")
+
+    # If no crackle families were found, create a dummy family for testing
+    if n_families == 0:
+        max_indices = [np.argmax(np.abs(audio_data[channel])) for channel in range(num_channels)]
+        dummy_family = make_dummy_family(max_indices, sample_rate)
+        if segments is not None:
+            audio_breath.tag_family(dummy_family, audio_breath.family_phase(dummy_family, segments))
+        yield dummy_family
+
+def iter_stored_families(audio_data, sample_rate, digest):
+    """
+    iter_families reusing the rolling median/MAD anchors the audio store
+    keeps for this recording (digest) and LOCAL_WINDOW_SIZE/STEP, and
+    storing the ones it had to compute. Without a digest (AUDIO_STORE off)
+    it is plain iter_families.
+    """
+    if digest is None:
+        yield from iter_families(audio_data, sample_rate)
+        return
+    name = f"rolling_w{LOCAL_WINDOW_SIZE}_s{LOCAL_WINDOW_STEP}"
+    anchors_shape = (2, audio_data.shape[0], -(-audio_data.shape[1] // LOCAL_WINDOW_STEP))
+    rolling = audio_store.get_array(digest, name, mmap_mode=None)
+    if rolling is None or rolling.shape != anchors_shape:
+        rolling = np.full(anchors_shape, np.nan)
+    known_before = int(np.count_nonzero(~np.isnan(rolling[0])))
+
+    yield from iter_families(audio_data, sample_rate, rolling=rolling)
+
+    known = int(np.count_nonzero(~np.isnan(rolling[0])))
+    log(f"Rolling median/MAD {name}: {known_before} of {rolling[0].size} anchors stored, {known} after detection")
+    if known > known_before:
+        audio_store.put_array(digest, name, rolling)
+
+def analyze_file(input_file):
+    """
+    Load input_file and run analyze_audio on it.
+    """
+    return list(iter_file_families(input_file, use_cache=False))
+
+def _cache_lookup(input_file, digest):
+    """
+    (cache key, cached families JSON or None) for input_file, whose bytes
+    hash to digest.
+    """
+    with stage('cache_lookup') as entry:
+        key = result_cache.cache_key(digest, tunable_parameters())
+        cached = result_cache.get(key)
+        if entry is not None:
+            entry['hit'] = cached is not None
+    if cached is not None:
+        log(f"Result cache hit for {input_file}: {result_cache.stats()}")
+    return key, cached
+
+def _cache_store(input_file, key, families_json):
+    result_cache.put(key, families_json)
+    log(f"Result cache miss for {input_file}: {result_cache.stats()}")
+
+def iter_file_families(input_file, stream=False, use_cache=None, digest=None, raw=None):
+    """
+    Yield input_file's families one by one as they are computed, or all at
+    once from the result cache when the same file bytes were analyzed with
+    the same parameters. 'stream' analyzes block by block (audio_stream.py),
+    same results. digest: input_digest of input_file, when already known.
+    raw: input_file is a raw 24-bit capture, see load_audio.
+    """
+    if use_cache is None:
+        use_cache = RESULT_CACHE
+    if stream and raw is not None:
+        raise ValueError("Streaming analysis reads audio files, not raw captures")
+    if stream and BREATH_PHASES is not None:
+        raise ValueError("Breath phase gating segments the whole recording, it can't be streamed")
+    if digest is None and (use_cache or (AUDIO_STORE and not stream)):
+        digest = input_digest(input_file, raw)
+    if use_cache:
+        key, cached = _cache_lookup(input_file, digest)
+        if cached is not None:
+            yield from json.loads(cached)
+            return
+
+    if stream:
+        from audio_stream import iter_families_streaming
+        source = iter_families_streaming(input_file)
+    else:
+        with stage('load'):
+            audio_data, sample_rate, digest = load_audio_stored(input_file, digest, raw)
+        source = iter_stored_families(audio_data, sample_rate, digest)
+
+    families = []
+    for family in source:
+        families.append(family)
+        yield family
+
+    if use_cache:
+        _cache_store(input_file, key, families_to_json(families))
+
+def analyze_file_json(input_file, stream=False, use_cache=None, raw=None):
+    """
+    families_to_json of input_file's families, answered from the result
+    cache when the same file bytes were analyzed with the same parameters.
+    'stream' analyzes block by block (audio_stream.py), same results.
+    raw: input_file is a raw 24-bit capture, see load_audio.
+    """
+    if use_cache is None:
+        use_cache = RESULT_CACHE
+    if stream and raw is not None:
+        raise ValueError("Streaming analysis reads audio files, not raw captures")
+    if stream and BREATH_PHASES is not None:
+        raise ValueError("Breath phase gating segments the whole recording, it can't be streamed")
+    digest = None
+    if use_cache:
+        digest = input_digest(input_file, raw)
+        key, cached = _cache_lookup(input_file, digest)
+        if cached is not None:
+            return cached
+
+    families = list(iter_file_families(input_file, stream=stream, use_cache=False, digest=digest, raw=raw))
+    with stage('serialization'):
+        families_json = families_to_json(families)
+
+    if use_cache:
+        _cache_store(input_file, key, families_json)
+    return families_json
 
 ################################################################################
 # Convert numpy types to Python-native, then JSON-serialize
@@ -409,15 +1460,353 @@ def convert_numpy_types(obj):
     else:
         return obj
 
-cross_correlation_families_serializable = convert_numpy_types(cross_correlation_families)
+def families_to_json(cross_correlation_families):
+    cross_correlation_families_serializable = convert_numpy_types(cross_correlation_families)
+    try:
+        return json.dumps(cross_correlation_families_serializable)
+    except Exception as e:
+        log(f"Error serializing to JSON: {str(e)}")
+        # Return an empty array in case of error to avoid parsing issues
+        return "[]"
+
+################################################################################
+# Other output formats
+#  * 'ndjson': one JSON family per line, written as soon as it is computed
+#  * 'npz':    columnar typed arrays, one row per family entry
+################################################################################
+
+OUTPUT_FORMATS = ('json', 'ndjson', 'npz')
+FAMILY_COLUMNS = (
+    ('family_id', np.int32),
+    ('channel', np.int32),
+    ('delay', np.float64),
+    ('transmission_coefficient', np.float64),
+    ('time', np.float64),
+)
+
+def families_to_columns(cross_correlation_families):
+    """
+    Flatten families into one typed array per FAMILY_COLUMNS entry,
+    family_id being the family's index. Families tagged with a breath
+    phase (BREATH_PHASES) also get a 'phase' column, the index into
+    audio_breath.PHASES, and make_dummy_family's placeholder a
+    'placeholder' column.
+    """
+    entries = [(family_id, entry) for family_id, family in enumerate(cross_correlation_families)
+               for entry in family]
+    columns = {'family_id': np.fromiter((family_id for family_id, _ in entries), dtype=np.int32, count=len(entries))}
+    for name, dtype in FAMILY_COLUMNS[1:]:
+        columns[name] = np.fromiter((entry[name] for _, entry in entries), dtype=dtype, count=len(entries))
+    if entries and all('phase' in entry for _, entry in entries):
+        from audio_breath import PHASES
+        columns['phase'] = np.fromiter((PHASES.index(entry['phase']) for _, entry in entries), dtype=np.int8,
+                                       count=len(entries))
+    if any(entry.get('placeholder', False) for _, entry in entries):
+        columns['placeholder'] = np.fromiter((entry.get('placeholder', False) for _, entry in entries),
+                                             dtype=bool, count=len(entries))
+    return columns
+
+def columns_to_families(columns):
+    """
+    Inverse of families_to_columns.
+    """
+    families = []
+    family_ids = np.asarray(columns['family_id'])
+    bounds = np.flatnonzero(np.diff(family_ids)) + 1
+    for rows in np.split(np.arange(len(family_ids)), bounds) if len(family_ids) else []:
+        families.append([{name: columns[name][row].item() for name, _ in FAMILY_COLUMNS[1:]} for row in rows])
+    if 'phase' in columns:
+        from audio_breath import PHASES
+        for family, rows in zip(families, np.split(np.asarray(columns['phase']), bounds)):
+            for entry, phase in zip(family, rows.tolist()):
+                entry['phase'] = PHASES[phase]
+    if 'placeholder' in columns:
+        for family, rows in zip(families, np.split(np.asarray(columns['placeholder']), bounds)):
+            for entry, placeholder in zip(family, rows.tolist()):
+                if placeholder:
+                    entry['placeholder'] = True
+    return families
+
+def write_families_npz(cross_correlation_families, file):
+    """
+    Save the families' columns with np.savez to a path or binary file object.
+    """
+    np.savez(file, **families_to_columns(cross_correlation_families))
+
+def write_families_ndjson(cross_correlation_families, stream):
+    """
+    Write each family as one JSON line, flushing after every line so readers
+    get families while later ones are still being computed.
+    Returns the number of families written.
+    """
+    count = 0
+    for family in cross_correlation_families:
+        stream.write(json.dumps(convert_numpy_types(family)) + "\n")
+        stream.flush()
+        count += 1
+    return count
+
+################################################################################
+# Warm worker mode
+################################################################################
+
+def _families_reply(job, families, reply, send):
+    """
+    Put families (a list or a generator) into reply in the job's 'format':
+      - 'json' (default): reply['families'] is the list
+      - 'ndjson': every family is sent right away as its own line
+        { id, partial: true, family }, reply['count'] is the total
+      - 'npz': columns written to job['result_file'], reply['result_file']
+    """
+    output_format = job.get('format', 'json')
+    if output_format == 'json':
+        reply['families'] = convert_numpy_types(list(families))
+    elif output_format == 'ndjson':
+        count = 0
+        for family in families:
+            send({'id': reply['id'], 'partial': True, 'family': convert_numpy_types(family)})
+            count += 1
+        reply['count'] = count
+    elif output_format == 'npz':
+        write_families_npz(list(families), job['result_file'])
+        reply['result_file'] = job['result_file']
+    else:
+        raise ValueError(f"Unknown format: {output_format}, expected one of {OUTPUT_FORMATS}")
+
+def handle_job(job, send=None):
+    """
+    Execute one worker job and return its JSON-ready reply.
+
+    Jobs are dicts with an 'id' echoed back in the reply and an 'op':
+      - 'analyze': { file, stream, cache, metrics, format, raw } -> { id, ok, families, metrics }
+        'stream' analyzes block by block in bounded memory (audio_stream.py),
+        'raw': { channels, sample_rate, sample_bytes } reads 'file' as a raw
+        24-bit I2S capture (raw_capture.py), {} for the recorder's defaults,
+        'cache': false bypasses the result cache (default RESULT_CACHE),
+        'metrics': true adds per-stage timings and memory (audio_metrics.py)
+      - 'combine': { inputs, output, analyze, format } combines mono files. With
+        'output' the combined WAV is written there (combine_wav_files) and
+        analyzed if 'analyze' is set; without it the combined array goes
+        straight to analyze_audio, no temporary WAV.
+      'localize': true on 'analyze' and 'combine' adds reply['locations'],
+      the estimated origin of every family (audio_localize.py).
+      'breath': true on them adds reply['breath'] = { segments, summary },
+      the recording's inspiration/expiration/pause intervals and how many
+      families fell in each (audio_breath.py).
+      'session': SESSION_ID on them (with optional 'patient' and
+      'recorded_at', epoch seconds) appends the families to that session
+      of session_store.py and adds reply['session'] = { added, summary }.
+      - 'session_summary': { session }     -> { id, ok, session, recordings }
+      - 'sessions': { patient }            -> { id, ok, sessions }
+      - 'convert': { inputs, output, raw, subtype, preview } -> { id, ok, conversion }
+        writes 'inputs' (one file, or one mono file per channel) to 'output'
+        as WAV block by block, 'raw': { encoding, channels, sample_rate }
+        for headerless PCM; 'conversion' is format_converter.convert's
+        summary, with a 'preview' envelope of 'preview' points per channel.
+      - 'cache_stats':                     -> { id, ok, cache, store, sessions }
+      - 'ping':                            -> { id, ok }
+    'format' picks how families are returned, see _families_reply; with
+    'ndjson', send(message) is called for every family before the reply.
+    Failures are reported as { id, ok: false, error } instead of raising.
+    """
+    job_id = job.get('id')
+    try:
+        op = job.get('op', 'analyze')
+        reply = {'id': job_id, 'ok': True}
+        # detected families as they go by, for 'localize', 'breath' and 'session' (the
+        # placeholder from make_dummy_family is only sent back, never located or stored)
+        seen = [] if job.get('localize', False) or job.get('breath', False) or job.get('session') else None
+        # (audio_data, sample_rate) of the analyzed recording when at hand, for 'breath' and 'session'
+        analyzed_audio = None
+        # content digest of the analyzed recording when known, for 'session'
+        analyzed_digest = None
+        def families_seen(families):
+            for family in families:
+                if seen is not None and not is_dummy_family(family):
+                    seen.append(family)
+                yield family
+
+        if op == 'analyze':
+            want_metrics = job.get('metrics', False)
+            with audio_metrics.recording(want_metrics or bool(audio_metrics.METRICS_FILE),
+                                         file=job['file']) as recorder:
+                if job.get('format', 'json') == 'json':
+                    # straight from the cached JSON text on a hit
+                    reply['families'] = json.loads(analyze_file_json(
+                        job['file'], stream=job.get('stream', False), use_cache=job.get('cache'),
+                        raw=job.get('raw')
+                    ))
+                    if seen is not None:
+                        seen.extend(family for family in reply['families'] if not is_dummy_family(family))
+                else:
+                    _families_reply(job, families_seen(iter_file_families(
+                        job['file'], stream=job.get('stream', False), use_cache=job.get('cache'),
+                        raw=job.get('raw')
+                    )), reply, send)
+            if recorder is not None:
+                audio_metrics.write_record(recorder.to_dict())
+                if want_metrics:
+                    reply['metrics'] = recorder.to_dict()
+        elif op == 'combine':
+            from combine_wav import combine_wav_files
+            if 'output' not in job:
+                with stage('load'):
+                    audio_data, sample_rate, digest = load_combined_stored(job['inputs'])
+                analyzed_audio = audio_data, sample_rate
+                analyzed_digest = digest or audio_store.composite_digest(
+                    'combine', [result_cache.file_digest(path) for path in job['inputs']])
+                _families_reply(job, families_seen(iter_stored_families(audio_data, sample_rate, digest)),
+                                reply, send)
+            else:
+                if not combine_wav_files(job['output'], job['inputs']):
+                    raise RuntimeError("Failed to combine wav files")
+                if job.get('analyze', False):
+                    _families_reply(job, families_seen(iter_file_families(job['output'], use_cache=False)),
+                                    reply, send)
+        elif op == 'convert':
+            from format_converter import convert
+            with stage('conversion'):
+                reply['conversion'] = convert(job['inputs'], job['output'], raw=job.get('raw'),
+                                              subtype=job.get('subtype'), preview_points=job.get('preview'))
+        elif op == 'session_summary':
+            import session_store
+            reply['session'] = session_store.session_summary(job['session'])
+            if reply['session'] is None:
+                raise ValueError(f"Unknown session: {job['session']}")
+            reply['recordings'] = session_store.session_recordings(job['session'])
+        elif op == 'sessions':
+            import session_store
+            reply['sessions'] = session_store.list_sessions(job.get('patient'))
+        elif op == 'cache_stats':
+            import session_store
+            reply['cache'] = result_cache.stats()
+            reply['store'] = audio_store.stats()
+            reply['sessions'] = session_store.stats()
+        elif op != 'ping':
+            raise ValueError(f"Unknown op: {op}")
+        if seen is not None and job.get('localize', False):
+            import audio_localize
+            with stage('localization', families=len(seen)):
+                reply['locations'] = audio_localize.locations_to_list(audio_localize.localize_families(seen))
+        if seen is not None and job.get('breath', False):
+            import audio_breath
+            if analyzed_audio is None:
+                # the families may have come from the cache, the audio from the store is cheap
+                with stage('load'):
+                    if op == 'analyze':
+                        audio_data, sample_rate, analyzed_digest = load_audio_stored(job['file'], raw=job.get('raw'))
+                    else:
+                        audio_data, sample_rate, analyzed_digest = load_audio_stored(job['output'])
+                    analyzed_audio = audio_data, sample_rate
+            with stage('breath_segmentation'):
+                segments = audio_breath.segment_recording(*analyzed_audio)
+            reply['breath'] = {'segments': audio_breath.segments_to_list(segments),
+                               'summary': audio_breath.breath_summary(segments, seen)}
+        analyzed = op == 'analyze' or (op == 'combine' and ('output' not in job or job.get('analyze', False)))
+        if analyzed and job.get('session'):
+            import session_store
+            if analyzed_audio is not None:
+                audio_data, sample_rate = analyzed_audio
+                info = audio_data.shape[1] / sample_rate, sample_rate, audio_data.shape[0]
+                source = ', '.join(os.path.basename(path) for path in job['inputs']) if op == 'combine' \
+                    else os.path.basename(job['file'])
+            elif op == 'analyze':
+                info = recording_info(job['file'], job.get('raw'))
+                source = os.path.basename(job['file'])
+            else:
+                info = recording_info(job['output'])
+                source = os.path.basename(job['output'])
+            if analyzed_digest is None:
+                analyzed_digest = input_digest(job['file'], job.get('raw')) if op == 'analyze' \
+                    else input_digest(job['output'])
+            with stage('session_update', families=len(seen)):
+                added, summary = session_store.add_recording(
+                    job['session'], seen, info[0],
+                    digest=analyzed_digest, patient_id=job.get('patient'), source=source,
+                    sample_rate=info[1], channels=info[2], recorded_at=job.get('recorded_at')
+                )
+            reply['session'] = {'added': added, 'summary': summary}
+        return reply
+    except Exception as e:
+        log(f"Worker job {job_id} failed: {e!r}")
+        return {'id': job_id, 'ok': False, 'error': str(e)}
+    finally:
+        flush_log()
+
+def run_worker(job_stream, reply_stream):
+    """
+    Serve jobs until job_stream is closed: one JSON job per input line,
+    one JSON reply per output line (preceded by the job's partial lines
+    with the 'ndjson' format). Libraries stay imported between jobs,
+    so only the first request pays the start-up cost.
+    """
+    def send(message):
+        reply_stream.write(json.dumps(message) + "\n")
+        reply_stream.flush()
+
+    log(f"Worker {os.getpid()} ready")
+    for line in job_stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            reply = {'id': None, 'ok': False, 'error': f"Invalid job: {e}"}
+        else:
+            reply = handle_job(job, send)
+        send(reply)
+    log(f"Worker {os.getpid()} exiting")
+
+################################################################################
+# Main code
+################################################################################
+
+if __name__ == "__main__":
+    # audio_stream, audio_parallel, ... 'import audio_process': let them get
+    # this module instead of loading a second copy with its own tunables,
+    # log handle and fork/exit hooks
+    sys.modules.setdefault('audio_process', sys.modules['__main__'])
+    if len(sys.argv) > 1 and sys.argv[1] == '--worker':
+        # stdout carries the protocol, anything else printed goes to stderr
+        reply_stream = sys.stdout
+        sys.stdout = sys.stderr
+        run_worker(sys.stdin, reply_stream)
+    else:
+        import argparse
+        parser = argparse.ArgumentParser(description="Detect crackle families in a multi-channel recording")
+        parser.add_argument('input_file')
+        parser.add_argument('--stream', action='store_true',
+                            help="analyze block by block in bounded memory (long recordings)")
+        parser.add_argument('--format', choices=OUTPUT_FORMATS, default='json',
+                            help="json (default), ndjson (one family per line, as computed) or npz (columns)")
+        parser.add_argument('--raw', action='store_true',
+                            help="input_file is a headerless 24-bit I2S capture from the recorder")
+        parser.add_argument('--channels', type=int, help="raw capture: interleaved channels (default 2)")
+        parser.add_argument('--sample-rate', type=int, help="raw capture: sample rate (default 48000)")
+        parser.add_argument('--sample-bytes', type=int, choices=(3, 4),
+                            help="raw capture: 3 = packed (default), 4 = 24-bit in 32-bit slots")
+        parser.add_argument('--phases',
+                            help="only analyze these breath phases, e.g. inspiration,expiration (BREATH_PHASES)")
+        args = parser.parse_args()
+        if args.phases:
+            BREATH_PHASES = tuple(phase.strip() for phase in args.phases.split(','))
+        raw = None
+        if args.raw:
+            raw = {'channels': args.channels, 'sample_rate': args.sample_rate, 'sample_bytes': args.sample_bytes}
 
-try:
-    # Output JSON to stdout, and only JSON (no debugging info)
-    json_output = json.dumps(cross_correlation_families_serializable)
-    sys.stdout.write(json_output)
-except Exception as e:
-    log(f"Error serializing to JSON: {str(e)}")
-    # Return an empty array in case of error to avoid parsing issues
-    sys.stdout.write("[]")
+        with audio_metrics.recording(bool(audio_metrics.METRICS_FILE), file=args.input_file) as recorder:
+            if args.format == 'json':
+                # Output JSON to stdout, and only JSON (no debugging info)
+                sys.stdout.write(analyze_file_json(args.input_file, stream=args.stream, raw=raw))
+            elif args.format == 'ndjson':
+                write_families_ndjson(iter_file_families(args.input_file, stream=args.stream, raw=raw), sys.stdout)
+            else:
+                import io
+                buffer = io.BytesIO()
+                write_families_npz(list(iter_file_families(args.input_file, stream=args.stream, raw=raw)), buffer)
+                sys.stdout.buffer.write(buffer.getvalue())
+        if recorder is not None:
+            audio_metrics.write_record(recorder.to_dict())
 
 #Json format: [[{"channel": 0, "delay": 0.5208333333333334, "transmission_coefficient": 0.013458703644573689, "time": 1402.875}, {"channel": 1, "delay": -1.4375, "transmission_coefficient": 0.04195275157690048, "time": 1401.2708333333333}, {"channel": 2, "delay": -0.75, "transmission_coefficient": 0.06662089377641678, "time": 1396.6041666666667}, {"channel": 3, "delay": -0.6666666666666666, "transmission_coefficient": 0.07396621257066727, "time": 1399.125}, {"channel": 4, "delay": -0.7083333333333334, "transmission_coefficient": 0.05321120098233223, "time": 1397.0}, {"channel": 5, "delay": 0.0, "transmission_coefficient": 1.0, "time": 1378.2083333333333}], [{"channel": 0, "delay": -16.520833333333332, "transmission_coefficient": 0.018532052636146545, "time": 3202.1875}, {"channel": 1, "delay": -13.895833333333332, "transmission_coefficient": 0.019504187628626823, "time": 3200.1875},
\ No newline at end of file
@@ -0,0 +1,261 @@
+# Real-time (online) version of the audio_process.py pipeline.
+# Fixed-size multi-channel frames, e.g. the ESP32's 1024-sample I2S DMA
+# buffers, are written into a ring buffer. Every REALTIME_BLOCK_SEC of audio
+# is run through the same stages as the batch pipeline (local MAD threshold,
+# find_peaks, FAMILY_RANGE_MS clustering, refinement, leader cross-correlation)
+# and each crackle family is emitted as soon as its gap closes.
+# Work per frame is bounded by one block, so the latency stays bounded too:
+# about REALTIME_BLOCK_SEC + REALTIME_HALO_SEC + half a LOCAL_WINDOW_SIZE.
+#
+# replay_file feeds a WAV through the detector at real-time speed (or faster)
+# for testing without hardware:
+#   python audio_realtime.py <input_file> [speed]   (speed 0 = as fast as possible)
+
+import json
+import sys
+import time
+import numpy as np
+import soundfile as sf
+
+import audio_process as ap
+from audio_process import log
+from audio_stream import detect_block_spikes, finish_cluster, read_frames
+
+################################################################################
+# TUNABLE PARAMETERS
+################################################################################
+
+# !!! TUNABLE PARAMETER: samples per channel in one incoming frame
+REALTIME_FRAME_SIZE = 1024  # dma_buf_len in esp/esp-lung-detect/main/lung_detect.c
+# !!! TUNABLE PARAMETER: seconds of audio run through detection at a time
+REALTIME_BLOCK_SEC = 0.1  # smaller = lower latency, more threshold overhead per sample
+# !!! TUNABLE PARAMETER: initial context (seconds) on both sides of a block, see STREAM_HALO_SEC
+REALTIME_HALO_SEC = 0.05  # shorter than in streaming mode: it's recomputed for every block
+# !!! TUNABLE PARAMETER: seconds of audio kept in the ring buffer
+REALTIME_BUFFER_SEC = 10.0  # a cluster that would outlive it is closed early, see RealtimeDetector.push
+
+################################################################################
+# Ring buffer
+################################################################################
+
+class RingBuffer:
+    """
+    The last 'capacity' samples of a multi-channel stream, addressed by
+    absolute sample index since the stream started.
+    """
+
+    def __init__(self, num_channels, capacity, dtype=np.float32):
+        self.data = np.zeros((num_channels, capacity), dtype=dtype)
+        self.capacity = capacity
+        self.end = 0  # absolute index of the next sample written
+
+    @property
+    def start(self):
+        """Oldest absolute index still held."""
+        return max(0, self.end - self.capacity)
+
+    def write(self, frames):
+        """
+        Append frames of shape (channels, n), overwriting the oldest samples.
+        """
+        n = frames.shape[1]
+        if n > self.capacity:
+            frames = frames[:, n - self.capacity:]
+            self.end += n - self.capacity
+            n = self.capacity
+        pos = self.end % self.capacity
+        first = min(n, self.capacity - pos)
+        self.data[:, pos:pos + first] = frames[:, :first]
+        self.data[:, :n - first] = frames[:, first:]
+        self.end += n
+
+    def read(self, start, stop):
+        """
+        Copy of samples [start, stop), shape (channels, stop - start).
+        """
+        if start < self.start or stop > self.end:
+            raise IndexError(f"Samples [{start}, {stop}) not in ring buffer [{self.start}, {self.end})")
+        lo = start % self.capacity
+        hi = lo + (stop - start)
+        if hi <= self.capacity:
+            return self.data[:, lo:hi].copy()
+        return np.concatenate([self.data[:, lo:], self.data[:, :hi - self.capacity]], axis=1)
+
+################################################################################
+# Incremental detector
+################################################################################
+
+class RealtimeDetector:
+    """
+    Online crackle detector. push() frames as they arrive and get back the
+    families whose FAMILY_RANGE_MS gap closed; flush() at the end of the
+    stream. The families are the same ones analyze_file finds on the whole
+    recording (apart from its dummy family when nothing is found), unless
+    spikes keep a cluster open for longer than the ring buffer holds: it is
+    then closed on the spikes it has, and the later ones start a new one.
+    """
+
+    def __init__(self, num_channels, sample_rate, block_sec=None, buffer_sec=None):
+        if block_sec is None:
+            block_sec = REALTIME_BLOCK_SEC
+        if buffer_sec is None:
+            buffer_sec = REALTIME_BUFFER_SEC
+        self.num_channels = num_channels
+        self.sr = sample_rate
+        self.block_len = max(1, int(block_sec * sample_rate))
+        self.halo = int(REALTIME_HALO_SEC * sample_rate)
+        self.slice_half = int(sample_rate * ap.SLICE_DURATION_SEC) // 2
+        self.ring = RingBuffer(num_channels, int(buffer_sec * sample_rate))
+        self.channel_req = max(2, int(num_channels * ap.CLUSTER_CHANNEL_FRACTION))
+        self.core_start = 0  # first sample not yet run through detection
+        self.current = []  # open cluster of (ch, t_ms)
+        self.n_families = 0
+        self.closed_early = 0  # clusters closed because the ring buffer was about to drop their audio
+        # time (ms) of the last spike of each emitted family, for latency
+        self.family_end_ms = []
+
+    def push(self, frames):
+        """
+        Add frames of shape (channels, n). Returns the list of families
+        completed by them (usually empty).
+        """
+        frames = np.asarray(frames, dtype=np.float32)
+        families = []
+        if self.current and self.ring.end + frames.shape[1] - self.ring.capacity > self._current_start():
+            # writing the frames would overwrite audio the open cluster's
+            # slices need: close it while the ring still holds all of it
+            log(f"Realtime detector: cluster open since {self.current[0][1]:.1f} ms outlives the "
+                f"{self.ring.capacity / self.sr:g} s ring buffer, closing it early")
+            families.extend(self._close_current())
+            self.closed_early += 1
+        self.ring.write(frames)
+        families.extend(self._advance(final=False))
+        return families
+
+    def flush(self):
+        """
+        End of stream: detect the remaining audio and close the open cluster.
+        """
+        families = self._advance(final=True)
+        if self.current:
+            families.extend(self._close_current())
+        return families
+
+    def _current_start(self):
+        """First sample finish_cluster reads for the open cluster."""
+        return max(0, int((self.current[0][1] / 1000.0) * self.sr) - self.slice_half)
+
+    def _close_current(self):
+        cluster, self.current = self.current, []
+        if len(set(x[0] for x in cluster)) < self.channel_req:
+            return []
+        family = finish_cluster(self.ring.read, self.ring.end, self.sr, cluster, self.n_families)
+        self.n_families += 1
+        self.family_end_ms.append(cluster[-1][1])
+        return [family]
+
+    def _advance(self, final):
+        families = []
+        while self.core_start < self.ring.end:
+            core_end = min(self.ring.end, self.core_start + self.block_len)
+            if not final and core_end - self.core_start < self.block_len:
+                break
+            # a long loud stretch without a quiet sample keeps the right halo
+            # open; rather than overrunning the ring buffer, treat what has
+            # arrived as the end of the recording for this block
+            open_end = not final and self.ring.end - self.core_start < self.ring.capacity // 2
+            if not final and not open_end:
+                log(f"Realtime detector: no quiet sample after {self.core_start}, closing block early")
+            result = detect_block_spikes(self.ring.read, self.ring.end, self.sr,
+                                         self.core_start, core_end, self.halo, open_end=open_end)
+            if result is None:
+                break  # the halo needs frames that haven't arrived yet
+            block_spikes = result[0]
+
+            for spike in block_spikes:
+                # If gap bigger than FAMILY_RANGE_MS => the open cluster is complete
+                if self.current and (spike[1] - self.current[-1][1]) > ap.FAMILY_RANGE_MS:
+                    families.extend(self._close_current())
+                self.current.append(spike)
+            self.core_start = core_end
+
+            # no later spike can join the open cluster any more
+            if self.current and (core_end / self.sr) * 1000.0 - self.current[-1][1] > ap.FAMILY_RANGE_MS:
+                families.extend(self._close_current())
+        return families
+
+################################################################################
+# File replay driver
+################################################################################
+
+def replay_file(input_file, speed=1.0, frame_size=None, on_family=None):
+    """
+    Feed input_file through a RealtimeDetector in frame_size frames, paced
+    at 'speed' x real time (0 = as fast as possible).
+
+    on_family(family, latency_ms) is called for every emitted family, with
+    the stream time elapsed between the family's last spike and its emission
+    (at least FAMILY_RANGE_MS, the gap that closes it).
+    Returns (families, stats) where stats has the frame processing times.
+    """
+    if frame_size is None:
+        frame_size = REALTIME_FRAME_SIZE
+    families = []
+    push_times = []
+    latencies = []
+
+    with sf.SoundFile(input_file) as sound_file:
+        sr = sound_file.samplerate
+        n_frames = sound_file.frames
+        detector = RealtimeDetector(sound_file.channels, sr)
+        log(f"Replaying {input_file}: {sound_file.channels} channels, {n_frames} frames at {sr} Hz, speed {speed}")
+
+        def emit(new_families):
+            now_ms = (detector.ring.end / sr) * 1000.0
+            for family in new_families:
+                latency_ms = now_ms - detector.family_end_ms[len(families)]
+                latencies.append(latency_ms)
+                families.append(family)
+                if on_family is not None:
+                    on_family(family, latency_ms)
+
+        wall_start = time.perf_counter()
+        for start in range(0, n_frames, frame_size):
+            frames = read_frames(sound_file, start, min(n_frames, start + frame_size))
+            if speed > 0:
+                # wait until this frame would have been captured
+                delay = (start + frames.shape[1]) / (sr * speed) - (time.perf_counter() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+            t0 = time.perf_counter()
+            new_families = detector.push(frames)
+            push_times.append(time.perf_counter() - t0)
+            emit(new_families)
+        emit(detector.flush())
+
+    push_ms = np.array(push_times) * 1000.0
+    stats = {
+        'frames': len(push_times),
+        'frame_ms': frame_size / sr * 1000.0,
+        'push_ms_mean': float(push_ms.mean()) if len(push_ms) else 0.0,
+        'push_ms_max': float(push_ms.max()) if len(push_ms) else 0.0,
+        'family_latency_ms_max': float(max(latencies)) if latencies else 0.0,
+        'clusters_closed_early': detector.closed_early,
+    }
+    log(f"Replay done: {len(families)} families, {stats}")
+    return families, stats
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python audio_realtime.py <input_file> [speed]")
+        sys.exit(1)
+
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+
+    def print_family(family, latency_ms):
+        # one JSON line per family, as soon as it is emitted
+        sys.stdout.write(json.dumps(ap.convert_numpy_types(family)) + "\n")
+        sys.stdout.flush()
+
+    _, stats = replay_file(sys.argv[1], speed=speed, on_family=print_family)
+    sys.stderr.write(json.dumps(stats) + "\n")
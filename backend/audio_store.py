@@ -0,0 +1,161 @@
+# Local store of decoded recordings and of arrays derived from them.
+# A recording is decoded once and kept as a channel-major float32 .npy,
+# <STORE_DIR>/<digest>/audio.npy, next to meta.json (sample rate, channel
+# count, frames, sha256 of the source bytes). Later runs memory-map it
+# (np.load(mmap_mode='r')) instead of decoding again. Arrays computed from a
+# recording, e.g. its rolling median/MAD, are kept in the same directory as
+# <name>.npy so repeat analyses can skip them.
+# Entries are evicted least-recently-used first once the store is over
+# STORE_MAX_BYTES, and dropped when unused for STORE_MAX_AGE_SEC.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import local_storage
+
+STORE_DIR = local_storage.default_path('AUDIO_STORE_DIR', 'store')
+STORE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+STORE_MAX_AGE_SEC = 7 * 24 * 3600
+# Bump when decoding changes in a way that changes the samples of the same file
+STORE_VERSION = 1
+
+AUDIO_NAME = 'audio'
+META_NAME = 'meta.json'
+
+# Hits and misses of this process (a worker lives across many requests)
+_stats = {'hits': 0, 'misses': 0}
+
+def composite_digest(kind, digests):
+    """
+    Digest of a recording made from other files, e.g. the combination of
+    several mono uploads: kind + the sources' digests, in order.
+    """
+    blob = json.dumps({'kind': kind, 'sources': list(digests)})
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+def entry_dir(digest, store_dir=None):
+    return os.path.join(store_dir or STORE_DIR, f"{digest}-v{STORE_VERSION}")
+
+def _touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def get_audio(digest, store_dir=None):
+    """
+    (audio_data, meta) of a stored recording, audio_data being a read-only
+    memory map of shape (channels, frames); None when it isn't stored.
+    A hit marks the entry as recently used.
+    """
+    path = entry_dir(digest, store_dir)
+    try:
+        with open(os.path.join(path, META_NAME), 'r') as f:
+            meta = json.load(f)
+        audio_data = np.load(os.path.join(path, AUDIO_NAME + '.npy'), mmap_mode='r')
+    except (OSError, ValueError):
+        _stats['misses'] += 1
+        return None
+    if time.time() - os.path.getmtime(path) > STORE_MAX_AGE_SEC:
+        _stats['misses'] += 1
+        return None
+    _touch(path)
+    _stats['hits'] += 1
+    return audio_data, meta
+
+def put_audio(digest, audio_data, sample_rate, store_dir=None, **info):
+    """
+    Store a decoded recording (channels, frames) as float32, then evict down
+    to the limits. The entry appears atomically; when another process
+    stored the same recording first, its copy is kept.
+    info (e.g. source=file name) is copied into meta.json.
+    """
+    store_dir = store_dir or STORE_DIR
+    os.makedirs(store_dir, exist_ok=True)
+    path = entry_dir(digest, store_dir)
+    tmp_path = tempfile.mkdtemp(dir=store_dir, suffix='.tmp')
+    try:
+        audio_data = np.ascontiguousarray(audio_data, dtype=np.float32)
+        np.save(os.path.join(tmp_path, AUDIO_NAME + '.npy'), audio_data)
+        meta = dict(info, sha256=digest, sample_rate=int(sample_rate), channels=audio_data.shape[0],
+                    frames=audio_data.shape[1], dtype='float32', version=STORE_VERSION)
+        with open(os.path.join(tmp_path, META_NAME), 'w') as f:
+            json.dump(meta, f)
+        if os.path.isdir(path):
+            # only derived arrays so far, keep them
+            for name in os.listdir(tmp_path):
+                os.replace(os.path.join(tmp_path, name), os.path.join(path, name))
+        else:
+            os.rename(tmp_path, path)
+    except OSError:
+        if not os.path.exists(os.path.join(path, META_NAME)):
+            raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    evict(store_dir)
+    return meta
+
+def get_array(digest, name, store_dir=None, mmap_mode='r'):
+    """
+    Derived array 'name' of a recording (memory-mapped by default), or None.
+    """
+    path = entry_dir(digest, store_dir)
+    try:
+        array = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+    except (OSError, ValueError):
+        return None
+    _touch(path)
+    return array
+
+def put_array(digest, name, array, store_dir=None):
+    """
+    Store (or replace, atomically) derived array 'name' of a recording.
+    """
+    store_dir = store_dir or STORE_DIR
+    path = entry_dir(digest, store_dir)
+    os.makedirs(path, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, os.path.join(path, name + '.npy'))
+    evict(store_dir)
+
+def _entries(store_dir):
+    entries = []
+    try:
+        names = os.listdir(store_dir)
+    except OSError:
+        return entries
+    for name in names:
+        path = os.path.join(store_dir, name)
+        if name.endswith('.tmp') or not os.path.isdir(path):
+            continue
+        try:
+            mtime = os.stat(path).st_mtime
+            size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+        except OSError:
+            continue
+        entries.append((mtime, size, path))
+    return entries
+
+def evict(store_dir=None, max_bytes=None, max_age_sec=None):
+    """
+    Drop entries unused for max_age_sec, then least recently used entries
+    until the store fits in max_bytes. Returns the number of entries removed.
+    A process still mapping a removed recording keeps reading it.
+    """
+    return local_storage.evict(_entries(store_dir or STORE_DIR), shutil.rmtree,
+                               STORE_MAX_BYTES if max_bytes is None else max_bytes,
+                               STORE_MAX_AGE_SEC if max_age_sec is None else max_age_sec)
+
+def stats(store_dir=None):
+    """
+    Hit/miss counters of this process plus the store's current size.
+    """
+    return local_storage.usage(_stats, _entries(store_dir or STORE_DIR))
@@ -0,0 +1,204 @@
+# Streaming (bounded memory) version of the audio_process.py pipeline.
+# The recording is read in blocks with soundfile instead of being decoded
+# whole, spikes are detected per block and clustered as they arrive, and each
+# family is cross-correlated as soon as its FAMILY_RANGE_MS gap closes.
+# Peak memory depends on STREAM_BLOCK_SEC, not on the recording length, and
+# the families are the same as audio_process.analyze_file produces.
+
+import sys
+import numpy as np
+import soundfile as sf
+from scipy import signal
+
+import audio_process as ap
+from audio_process import log
+from audio_metrics import stage
+
+################################################################################
+# TUNABLE PARAMETERS
+################################################################################
+
+# !!! TUNABLE PARAMETER: seconds of audio analyzed per block
+STREAM_BLOCK_SEC = 10.0
+# !!! TUNABLE PARAMETER: initial extra context (seconds) read on both sides of a block
+STREAM_HALO_SEC = 0.25  # grown automatically when a block edge sits inside a long loud stretch
+
+################################################################################
+# Block reading / detection
+################################################################################
+
+def read_frames(sound_file, start, stop):
+    """
+    Read frames [start, stop) of all channels as float32, shape (channels, frames).
+    """
+    sound_file.seek(start)
+    return sound_file.read(stop - start, dtype='float32', always_2d=True).T
+
+def detect_block_spikes(read_block, n_frames, sr, core_start, core_end, halo, channels=None, open_end=False):
+    """
+    Detect the spikes of every channel (or only 'channels') whose sample
+    index falls in [core_start, core_end), exactly as detect_all_spikes
+    would on the whole recording.
+
+    read_block(start, stop) returns frames [start, stop) of all channels,
+    shape (channels, frames), e.g. from a file (read_frames) or a slice of
+    an array already in memory.
+
+    The block is read with a halo on both sides plus half a rolling window,
+    aligned to the LOCAL_WINDOW_STEP grid, so every threshold in the halo
+    uses the same window as in whole-file mode. A peak's prominence only
+    depends on the signal up to the nearest masked (zero) sample on each
+    side, so as long as the halo contains a zero on both sides, peaks in the
+    core are identical; otherwise the halo is doubled and the block redone.
+
+    open_end: n_frames is only what has arrived so far (live input, see
+    audio_realtime.py). Returns None instead when the halo, or the windows
+    around it, would need frames past n_frames.
+
+    Returns (spikes sorted by time, block audio, read offset of block).
+    """
+    half_win = ap.LOCAL_WINDOW_SIZE // 2
+    step = ap.LOCAL_WINDOW_STEP
+    while True:
+        if open_end and core_end + halo + half_win > n_frames:
+            return None
+        ext_start = max(0, core_start - halo)
+        ext_end = min(n_frames, core_end + halo)
+        first_anchor = (ext_start // step) * step
+        read_start = max(0, ((first_anchor - half_win) // step) * step)
+        read_end = min(n_frames, ext_end + half_win)
+        block = read_block(read_start, read_end)
+
+        lo = core_start - ext_start
+        hi = core_end - ext_start
+        block_spikes = []
+        complete = True
+        for ch in (range(block.shape[0]) if channels is None else channels):
+            masked = ap.masked_local_threshold(
+                block[ch],
+                window_size=ap.LOCAL_WINDOW_SIZE,
+                step=step,
+                factor=ap.MAD_FACTOR,
+                engine=ap.THRESHOLD_ENGINE,
+                lean=ap.LEAN_DETECTION
+            )[ext_start - read_start:ext_end - read_start]
+            if (ext_start > 0 and not np.any(masked[:lo] == 0)) or \
+               (ext_end < n_frames and not np.any(masked[hi:] == 0)):
+                complete = False
+                break
+            peaks, props = signal.find_peaks(masked, prominence=ap.PEAK_PROMINENCE)
+            peaks = peaks[(peaks >= lo) & (peaks < hi)] + ext_start
+            for t_ms in (peaks / sr) * 1000.0:
+                block_spikes.append((ch, t_ms))
+
+        if complete:
+            # same order as detect_all_spikes: by time, channel order on ties
+            block_spikes.sort(key=lambda x: x[1])
+            return block_spikes, block, read_start
+        if ext_start == 0 and ext_end == n_frames:
+            raise RuntimeError("No quiet sample found around block, this should not happen")
+        halo *= 2
+        log(f"Growing stream halo to {halo} samples around block at {core_start}")
+
+################################################################################
+# Families
+################################################################################
+
+def finish_cluster(read_block, n_frames, sr, cluster, family_idx):
+    """
+    Refine one closed cluster and cross-correlate it, reading only the
+    audio its waveforms need with read_block(start, stop).
+    """
+    slice_half = int(sr * ap.SLICE_DURATION_SEC) // 2
+    spike_idx = [int((t_ms/1000.0)*sr) for (_, t_ms) in cluster]
+    seg_start = max(0, min(spike_idx) - slice_half)
+    seg_end = min(n_frames, max(spike_idx) + slice_half + 1)
+    segment = read_block(seg_start, seg_end)
+
+    refined = ap.refine_cluster(cluster, segment, sr, start_sample=seg_start)
+    return ap.process_family(family_idx, refined, segment, sr, start_sample=seg_start)
+
+def analyze_file_streaming(input_file, block_sec=None):
+    """
+    Streaming equivalent of audio_process.analyze_file.
+
+    Returns the crackle families, identical to whole-file mode.
+    """
+    return list(iter_families_streaming(input_file, block_sec=block_sec))
+
+def iter_families_streaming(input_file, block_sec=None):
+    """
+    analyze_file_streaming as a generator: each family is yielded as soon
+    as its FAMILY_RANGE_MS gap closes.
+    """
+    if block_sec is None:
+        block_sec = STREAM_BLOCK_SEC
+    with sf.SoundFile(input_file) as sound_file:
+        sr = sound_file.samplerate
+        n_frames = sound_file.frames
+        num_channels = sound_file.channels
+        log(f"Streaming {input_file}: {num_channels} channels, {n_frames} frames at {sr} Hz")
+
+        read_block = lambda start, stop: read_frames(sound_file, start, stop)
+        block_len = max(1, int(block_sec * sr))
+        halo = int(STREAM_HALO_SEC * sr)
+        channel_req = max(2, int(num_channels * ap.CLUSTER_CHANNEL_FRACTION))
+
+        current = []
+        n_spikes = 0
+        n_clusters = 0
+        n_families = 0
+        max_vals = np.full(num_channels, -np.inf)
+        max_indices = np.zeros(num_channels, dtype=np.int64)
+
+        def close_current():
+            # the finished family, or None when too few channels took part
+            nonlocal n_clusters, n_families
+            n_clusters += 1
+            if len(set(x[0] for x in current)) < channel_req:
+                return None
+            n_families += 1
+            return finish_cluster(read_block, n_frames, sr, current, n_families - 1)
+
+        for core_start in range(0, n_frames, block_len):
+            core_end = min(n_frames, core_start + block_len)
+            with stage('detection', start=core_start, samples=core_end - core_start):
+                block_spikes, block, read_start = detect_block_spikes(
+                    read_block, n_frames, sr, core_start, core_end, halo
+                )
+
+            # running per-channel argmax of |amplitude| for the dummy family
+            core = np.abs(block[:, core_start - read_start:core_end - read_start])
+            core_idx = np.argmax(core, axis=1)
+            core_vals = core[np.arange(num_channels), core_idx]
+            better = core_vals > max_vals
+            max_vals[better] = core_vals[better]
+            max_indices[better] = core_idx[better] + core_start
+            del block, core
+
+            n_spikes += len(block_spikes)
+            for spike in block_spikes:
+                # If gap bigger than FAMILY_RANGE_MS => the open cluster is complete
+                if current and (spike[1] - current[-1][1]) > ap.FAMILY_RANGE_MS:
+                    family = close_current()
+                    if family is not None:
+                        yield family
+                    current = []
+                current.append(spike)
+
+        if current:
+            family = close_current()
+            if family is not None:
+                yield family
+
+    log(f"Streamed {n_spikes} spikes into {n_clusters} clusters, {n_families} families")
+
+    if n_families == 0:
+        yield ap.make_dummy_family(max_indices, sr)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python audio_stream.py <input_file>")
+        sys.exit(1)
+
+    sys.stdout.write(ap.families_to_json(analyze_file_streaming(sys.argv[1])))
@@ -0,0 +1,268 @@
+# Parameter sweeps for the audio_process.py pipeline.
+# Evaluates a grid of TUNABLE PARAMETER sets on the same recordings and
+# writes one results row per (recording, parameter set). Work is shared down
+# the pipeline instead of rerunning it per point:
+#   * decode and |x|                       once per recording
+#   * rolling median/MAD                   once per (LOCAL_WINDOW_SIZE, LOCAL_WINDOW_STEP)
+#   * masking + find_peaks (prominences)   once per MAD_FACTOR, filtered per PEAK_PROMINENCE
+#   * clustering + refinement              per point (cheap, vectorized)
+#   * cross-correlation                    once per distinct refined family, slice and lag bound
+# Every point gives exactly the families a full run with those parameters gives.
+#
+#   python audio_sweep.py rec1.wav [rec2.wav ...] --grid MAD_FACTOR=2,2.5,3 --grid PEAK_PROMINENCE=0.01,0.02
+#                         [--synthetic 10x6 ...] [--output results.csv]
+# A grid entry can also be a JSON list, for values holding commas:
+#   --grid 'BREATH_PHASES=[["inspiration", "expiration"], ["inspiration"], null]'
+# --synthetic adds benchmark.py recordings with known crackles; their rows are scored (precision/recall/F1).
+
+import argparse
+import csv
+import itertools
+import json
+import sys
+import time
+from contextlib import contextmanager
+import numpy as np
+from scipy import signal
+
+import audio_process as ap
+from audio_process import log
+
+# Parameters a grid can vary, in the order results are shared
+SWEEP_PARAMETERS = ap.RESULT_PARAMETERS
+
+################################################################################
+# Grid
+################################################################################
+
+def parameter_grid(grid):
+    """
+    Cartesian product of grid ({name: [values]}), names not in the grid
+    taking their current audio_process value. Ordered so that points
+    sharing a rolling window (then a MAD factor) are next to each other.
+    """
+    for name in grid:
+        if name not in SWEEP_PARAMETERS:
+            raise ValueError(f"Unknown parameter: {name}, expected one of {SWEEP_PARAMETERS}")
+    # only the audio_process globals (not audio_breath's segmentation settings)
+    base = {name: value for name, value in ap.tunable_parameters().items() if name in SWEEP_PARAMETERS}
+    names = [name for name in SWEEP_PARAMETERS if name in grid]
+    points = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        point = dict(base)
+        point.update(zip(names, values))
+        points.append(point)
+    points.sort(key=lambda p: tuple(repr(p[name]) for name in SWEEP_PARAMETERS))
+    return points
+
+@contextmanager
+def _parameters(point):
+    # the clustering/refinement/cross-correlation functions read module globals
+    saved = {name: getattr(ap, name) for name in point}
+    for name, value in point.items():
+        setattr(ap, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(ap, name, value)
+
+################################################################################
+# One recording
+################################################################################
+
+class RecordingSweep:
+    """
+    Intermediate results of one recording, reused across parameter sets.
+    Only the rolling statistics of the current window/step are kept, so
+    memory doesn't grow with the number of window sizes in the grid.
+    """
+
+    def __init__(self, name, audio_data, sample_rate, truth=None):
+        self.name = name
+        self.audio_data = audio_data
+        self.sr = sample_rate
+        self.truth = truth
+        self.abs_data = np.abs(audio_data)
+        self._rolling_key = None
+        self._rolling = None
+        self._peaks = {}
+        self._families = {}
+        self._segments = None
+        self.counts = {'rolling': 0, 'peaks': 0, 'families': 0, 'family_reuse': 0}
+
+    def rolling(self, window_size, step):
+        """Per channel (medians, mads), as in masked_local_threshold."""
+        key = (window_size, step)
+        if self._rolling_key != key:
+            rolling_fn = ap.ROLLING_MEDIAN_MAD_ENGINES[ap.THRESHOLD_ENGINE]
+            self._rolling = [rolling_fn(channel, window_size=window_size, step=step) for channel in self.abs_data]
+            self._rolling_key = key
+            self._peaks = {}
+            self.counts['rolling'] += 1
+        return self._rolling
+
+    def peak_candidates(self, window_size, step, factor):
+        """
+        Per channel (peaks, prominences) of the masked signal, with every
+        local maximum kept: find_peaks(prominence=p) is the subset whose
+        prominence is >= p.
+        """
+        key = (window_size, step, factor)
+        if key not in self._peaks:
+            candidates = []
+            for abs_signal, (medians, mads) in zip(self.abs_data, self.rolling(window_size, step)):
+                local_threshold = medians + (factor*mads)
+                masked_signal = abs_signal.copy()
+                masked_signal[masked_signal < local_threshold] = 0.0
+                peaks, props = signal.find_peaks(masked_signal, prominence=0)
+                candidates.append((peaks, props['prominences']))
+            self._peaks[key] = candidates
+            self.counts['peaks'] += 1
+        return self._peaks[key]
+
+    def segments(self):
+        """Breath segments (audio_breath.py), computed on first use."""
+        if self._segments is None:
+            import audio_breath
+            self._segments = audio_breath.segment_recording(self.audio_data, self.sr)
+        return self._segments
+
+    def spikes(self, point):
+        """Spike table detect_all_spikes gives with these parameters."""
+        candidates = self.peak_candidates(point['LOCAL_WINDOW_SIZE'], point['LOCAL_WINDOW_STEP'], point['MAD_FACTOR'])
+        channels = []
+        times = []
+        for ch, (peaks, prominences) in enumerate(candidates):
+            kept = peaks[prominences >= point['PEAK_PROMINENCE']]
+            channels.append(np.full(len(kept), ch, dtype=np.int64))
+            times.append((kept / self.sr) * 1000.0)
+        all_spikes = np.empty(sum(len(t) for t in times), dtype=ap.SPIKE_DTYPE)
+        all_spikes['channel'] = np.concatenate(channels)
+        all_spikes['time_ms'] = np.concatenate(times)
+        if point.get('BREATH_PHASES') is not None:
+            import audio_breath
+            ranges = audio_breath.phase_ranges(self.segments(), point['BREATH_PHASES'], self.sr,
+                                               self.audio_data.shape[1])
+            samples = np.rint(all_spikes['time_ms'] * self.sr / 1000.0).astype(np.int64)
+            all_spikes = all_spikes[ap.in_ranges(samples, ranges)]
+        return all_spikes[np.argsort(all_spikes['time_ms'], kind='stable')]
+
+    def evaluate(self, point):
+        """
+        Families for one parameter set (no dummy family) and the row stats.
+        """
+        t0 = time.perf_counter()
+        all_spikes = self.spikes(point)
+        with _parameters(point):
+            filtered_clusters = ap.cluster_spikes(all_spikes, self.audio_data.shape[0])
+            crackle_families = ap.refine_clusters(all_spikes, filtered_clusters, self.audio_data, self.sr)
+            families = []
+            for family_idx, cluster_family in enumerate(crackle_families):
+                key = (tuple(cluster_family), point['SLICE_DURATION_SEC'], point['MAX_LAG_MS'])
+                if key in self._families:
+                    self.counts['family_reuse'] += 1
+                else:
+                    self._families[key] = ap.process_family(family_idx, cluster_family, self.audio_data, self.sr)
+                    self.counts['families'] += 1
+                families.append(self._families[key])
+            if point.get('BREATH_PHASES') is not None:
+                import audio_breath
+                # copies, the cached families are shared with ungated points
+                families = [audio_breath.tag_family([dict(entry) for entry in family],
+                                                    audio_breath.family_phase(family, self.segments()))
+                            for family in families]
+
+        row = {'recording': self.name}
+        row.update(point)
+        row['spikes'] = len(all_spikes)
+        row['families'] = len(families)
+        row['channels_per_family'] = float(np.mean([len(f) for f in families])) if families else 0.0
+        if self.truth is not None:
+            from benchmark import score_families
+            scores = score_families(ap.convert_numpy_types(families), self.truth)
+            row.update({k: scores[k] for k in ('precision', 'recall', 'f1', 'tdoa_error_ms')})
+        row['seconds'] = time.perf_counter() - t0
+        return families, row
+
+################################################################################
+# Sweep
+################################################################################
+
+def run_sweep(recordings, points):
+    """
+    recordings: list of (name, audio_data, sample_rate, truth or None).
+    Returns the results rows, recording by recording, in grid order.
+    """
+    rows = []
+    for name, audio_data, sample_rate, truth in recordings:
+        t0 = time.perf_counter()
+        sweep = RecordingSweep(name, audio_data, sample_rate, truth)
+        for point in points:
+            _, row = sweep.evaluate(point)
+            rows.append(row)
+        elapsed = time.perf_counter() - t0
+        log(f"Sweep {name}: {len(points)} points in {elapsed:.2f} s, computed {sweep.counts}")
+        sys.stderr.write(f"{name}: {len(points)} points in {elapsed:.2f} s "
+                         f"({sweep.counts['rolling']} rolling median/MAD, {sweep.counts['peaks']} peak searches, "
+                         f"{sweep.counts['families']} families correlated, {sweep.counts['family_reuse']} reused)\n")
+    return rows
+
+def parse_grid_entry(text):
+    """
+    'NAME=v1,v2,...' -> (NAME, [values]), values parsed as JSON when possible.
+    'NAME=[v1, v2, ...]', a JSON list, for values that hold commas
+    themselves, e.g. BREATH_PHASES=[["inspiration", "expiration"], null].
+    """
+    name, sep, values = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected NAME=v1,v2,... or NAME=[JSON list], got {text}")
+    if values.lstrip().startswith('['):
+        try:
+            parsed = json.loads(values)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(f"{name.strip()}: invalid JSON list {values}: {e}")
+        if not isinstance(parsed, list):
+            raise argparse.ArgumentTypeError(f"{name.strip()}: expected a JSON list, got {values}")
+        return name.strip(), parsed
+    parsed = []
+    for value in values.split(','):
+        try:
+            parsed.append(json.loads(value))
+        except ValueError:
+            parsed.append(value)
+    return name.strip(), parsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate a grid of audio_process.py parameters")
+    parser.add_argument('recordings', nargs='*', help="audio files")
+    parser.add_argument('--grid', type=parse_grid_entry, action='append', default=[],
+                        help="NAME=v1,v2,... for one TUNABLE PARAMETER, repeat for a grid; NAME=[JSON list] "
+                             "for values with commas, e.g. BREATH_PHASES='[[\"inspiration\",\"expiration\"],null]'")
+    parser.add_argument('--synthetic', action='append', default=[],
+                        help="DURATIONxCHANNELS synthetic recording with known crackles (benchmark.py), scored")
+    parser.add_argument('--output', help="CSV file for the results table (default stdout)")
+    args = parser.parse_args()
+
+    recordings = []
+    for path in args.recordings:
+        audio_data, sample_rate = ap.load_audio(path)
+        recordings.append((path, audio_data, sample_rate, None))
+    for spec in args.synthetic:
+        import benchmark
+        duration, channels = spec.lower().split('x')
+        audio_data, truth = benchmark.synthesize_recording(float(duration), int(channels))
+        recordings.append((f"synthetic-{spec}", audio_data, 48000, truth))
+    if not recordings:
+        parser.error("no recordings given")
+
+    points = parameter_grid(dict(args.grid))
+    rows = run_sweep(recordings, points)
+
+    fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = csv.DictWriter(output, fieldnames=fieldnames)
+    writer.writeheader()
+    writer.writerows(rows)
+    if args.output:
+        output.close()
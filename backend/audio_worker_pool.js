@@ -0,0 +1,117 @@
+const { spawn } = require('child_process');
+const path = require('path');
+const readline = require('readline');
+
+// Keeps a few `python3 audio_process.py --worker` processes alive so requests
+// don't pay for interpreter start-up and library imports every time.
+// Jobs are written as one JSON line on the worker's stdin and answered with
+// one JSON line on its stdout (see run_worker in audio_process.py).
+class AudioWorkerPool {
+    constructor({ size = 1, python = 'python3', script = path.join(__dirname, 'audio_process.py'), cwd = process.cwd() } = {}) {
+        this.size = Math.max(1, size);
+        this.python = python;
+        this.script = script;
+        this.cwd = cwd;
+        this.workers = [];
+        this.queue = [];
+        this.nextJobId = 1;
+        this.closed = false;
+    }
+
+    start() {
+        for (let i = 0; i < this.size; i++) {
+            this.workers.push(this.spawnWorker(i));
+        }
+        return this;
+    }
+
+    spawnWorker(index) {
+        const proc = spawn(this.python, [this.script, '--worker'], { cwd: this.cwd });
+        const worker = { index, proc, current: null };
+
+        readline.createInterface({ input: proc.stdout }).on('line', (line) => {
+            let reply;
+            try {
+                reply = JSON.parse(line);
+            } catch (parseError) {
+                console.error(`Worker ${index} sent invalid JSON: ${line}`);
+                return;
+            }
+            const current = worker.current;
+            if (!current || reply.id !== current.id) {
+                console.error(`Worker ${index} replied to unknown job ${reply.id}`);
+                return;
+            }
+            if (reply.partial) {
+                // One family of an 'ndjson' job, the final reply comes later
+                if (current.onPartial) {
+                    current.onPartial(reply);
+                }
+                return;
+            }
+            worker.current = null;
+            if (reply.ok) {
+                current.callback(null, reply);
+            } else {
+                current.callback(new Error(reply.error));
+            }
+            this.dispatch();
+        });
+
+        proc.stderr.on('data', (data) => {
+            console.error(`Worker ${index}: ${data}`);
+        });
+
+        proc.on('exit', (code, signal) => {
+            console.error(`Worker ${index} exited (code ${code}, signal ${signal})`);
+            const current = worker.current;
+            worker.current = null;
+            if (current) {
+                current.callback(new Error(`Python worker exited while processing job ${current.id}`));
+            }
+            if (!this.closed) {
+                // Replace the dead worker and carry on with the queue
+                setTimeout(() => {
+                    this.workers[index] = this.spawnWorker(index);
+                    this.dispatch();
+                }, 1000);
+            }
+        });
+
+        proc.on('error', (err) => {
+            console.error(`Failed to start worker ${index}: ${err}`);
+        });
+
+        return worker;
+    }
+
+    // job: { op, ...fields } as understood by handle_job in audio_process.py
+    // callback(error, reply)
+    // onPartial(message): optional, called for each { partial: true } line
+    // sent before the reply (jobs with format 'ndjson')
+    run(job, callback, onPartial = null) {
+        this.queue.push({ id: this.nextJobId++, job, callback, onPartial });
+        this.dispatch();
+    }
+
+    dispatch() {
+        for (const worker of this.workers) {
+            if (this.queue.length === 0) {
+                return;
+            }
+            if (worker.current || worker.proc.exitCode !== null || !worker.proc.stdin.writable) {
+                continue;
+            }
+            const task = this.queue.shift();
+            worker.current = task;
+            worker.proc.stdin.write(JSON.stringify({ ...task.job, id: task.id }) + '\n');
+        }
+    }
+
+    close() {
+        this.closed = true;
+        this.workers.forEach((worker) => worker.proc.stdin.end());
+    }
+}
+
+module.exports = { AudioWorkerPool };
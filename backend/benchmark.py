@@ -0,0 +1,751 @@
+# Throughput and accuracy benchmark for the audio_process.py pipeline.
+# Synthesizes multi-channel recordings with known crackle times, inter-channel
+# delays and attenuation over breath noise, times every pipeline stage and
+# scores the detected families against the ground truth.
+#
+#   python benchmark.py [--durations 10,60] [--channels 2,6] [--repeat 3] [--convert 3600x6]
+#                       [--lag-bounds 1,2,3] [--breath inspiration] [--realtime 20x6] [--output results.json]
+#
+# The report is JSON (parameters, git commit, one record per case) so runs on
+# different commits can be compared directly.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import soundfile as sf
+from scipy import signal
+
+import audio_process as ap
+
+################################################################################
+# TUNABLE PARAMETERS
+################################################################################
+
+# !!! TUNABLE PARAMETER: crackles per second in synthetic recordings
+SYNTH_CRACKLE_RATE = 3.0
+# !!! TUNABLE PARAMETER: max |inter-channel delay| (ms) of a synthetic crackle
+SYNTH_MAX_DELAY_MS = 3.0  # sound crossing the chest
+# !!! TUNABLE PARAMETER: breath noise level (std of the loudest part of the cycle)
+SYNTH_NOISE_LEVEL = 0.003  # crackles peak at ~0.01-0.4; at 0.01 noise spikes chain families together
+# !!! TUNABLE PARAMETER: a family matches a true crackle within this many ms
+MATCH_TOLERANCE_MS = 5.0
+
+################################################################################
+# Synthetic recordings
+################################################################################
+
+def crackle_waveform(sr, freq_hz, decay_ms, length_ms=8.0):
+    """
+    One crackle: a short, exponentially damped sinusoid.
+    """
+    t = np.arange(int(length_ms / 1000.0 * sr)) / sr
+    return np.exp(-t * 1000.0 / decay_ms) * np.sin(2 * np.pi * freq_hz * t)
+
+def breath_noise(num_channels, n_samples, sr, rng, level, breath_period_sec=4.0):
+    """
+    Low-passed noise whose loudness follows a breathing cycle.
+    """
+    sos = signal.butter(4, 800.0, btype='low', fs=sr, output='sos')
+    noise = signal.sosfilt(sos, rng.standard_normal((num_channels, n_samples)), axis=1)
+    noise /= np.std(noise) or 1.0
+    t = np.arange(n_samples) / sr
+    phase = rng.uniform(0, 2 * np.pi)
+    envelope = 0.3 + 0.7 * np.abs(np.sin(np.pi * t / breath_period_sec + phase))
+    return level * noise * envelope
+
+def synthesize_recording(duration_sec, num_channels, sr=48000, seed=0, crackle_rate=None, noise_level=None):
+    """
+    Multi-channel recording with crackles at known times.
+
+    Every crackle reaches each channel with its own delay (up to
+    SYNTH_MAX_DELAY_MS) and attenuation. Crackles are at least
+    2 * (FAMILY_RANGE_MS + SLICE_DURATION_SEC) apart so each one is
+    its own family.
+
+    Returns (audio_data of shape (num_channels, n_samples) float32, truth)
+    where truth is a list of {'channels': {ch: peak_time_ms}, 'gains': {ch: gain}}.
+    """
+    if crackle_rate is None:
+        crackle_rate = SYNTH_CRACKLE_RATE
+    if noise_level is None:
+        noise_level = SYNTH_NOISE_LEVEL
+    rng = np.random.default_rng(seed)
+    n_samples = int(duration_sec * sr)
+    audio_data = breath_noise(num_channels, n_samples, sr, rng, noise_level)
+    truth = add_crackles(audio_data, sr, rng, crackle_rate)
+    return audio_data.astype(np.float32), truth
+
+def add_crackles(audio_data, sr, rng, crackle_rate):
+    """
+    Add crackles to audio_data (in place) at random times, see
+    synthesize_recording. Returns their truth list.
+    """
+    num_channels, n_samples = audio_data.shape
+    duration_sec = n_samples / sr
+    min_gap_sec = 2 * (ap.FAMILY_RANGE_MS / 1000.0 + ap.SLICE_DURATION_SEC)
+    margin_sec = ap.SLICE_DURATION_SEC + SYNTH_MAX_DELAY_MS / 1000.0
+    truth = []
+    t_sec = margin_sec + rng.exponential(1.0 / crackle_rate)
+    while t_sec < duration_sec - margin_sec:
+        wave = crackle_waveform(sr, freq_hz=rng.uniform(300, 900), decay_ms=rng.uniform(0.8, 2.0))
+        peak_offset = int(np.argmax(np.abs(wave)))
+        amplitude = rng.uniform(0.1, 0.5)
+        crackle = {'channels': {}, 'gains': {}}
+        for ch in range(num_channels):
+            start = int(t_sec * sr) + int(rng.uniform(0, SYNTH_MAX_DELAY_MS) / 1000.0 * sr)
+            gain = rng.uniform(0.2, 1.0)
+            audio_data[ch, start:start + len(wave)] += amplitude * gain * wave
+            crackle['channels'][ch] = (start + peak_offset) / sr * 1000.0
+            crackle['gains'][ch] = gain
+        truth.append(crackle)
+        t_sec += min_gap_sec + rng.exponential(1.0 / crackle_rate)
+    return truth
+
+def synthesize_breathing(duration_sec, num_channels, sr=48000, seed=0, inspiration_sec=1.5, expiration_sec=2.0,
+                         pause_sec=1.0, expiration_level=0.5, gap_sec=0.0, floor_level=0.05, crackle_rate=None,
+                         noise_level=None):
+    """
+    Multi-channel recording of labeled breaths: inspiration at full
+    level, optionally a silent gap, expiration at expiration_level and a
+    pause, each length jittered by +-15%. Levels change over 100 ms ramps
+    (no silence between the phases when gap_sec is 0), and a background
+    of floor_level keeps pauses above zero. Crackles as in
+    synthesize_recording.
+
+    Returns (audio_data float32, truth, segments): the crackle truth and
+    the true segments in the audio_breath.segment_breath format.
+    """
+    import audio_breath
+    if crackle_rate is None:
+        crackle_rate = SYNTH_CRACKLE_RATE
+    if noise_level is None:
+        noise_level = SYNTH_NOISE_LEVEL
+    rng = np.random.default_rng(seed)
+    n_samples = int(duration_sec * sr)
+
+    rows = []
+    position = rng.uniform(0, 1.0) * pause_sec
+    rows.append((0.0, position, audio_breath.PAUSE, 0.0))
+    while position < duration_sec:
+        for phase, length, level in ((audio_breath.INSPIRATION, inspiration_sec, 1.0),
+                                     (audio_breath.PAUSE, gap_sec, 0.0),
+                                     (audio_breath.EXPIRATION, expiration_sec, expiration_level),
+                                     (audio_breath.PAUSE, pause_sec, 0.0)):
+            if length > 0:
+                length *= rng.uniform(0.85, 1.15)
+                rows.append((position, min(duration_sec, position + length), phase, level))
+                position += length
+    rows = [row for row in rows if row[1] > row[0]]
+
+    # per-sample level: the phase levels, linearly ramped across each boundary
+    bounds = np.array([row[1] for row in rows[:-1]])
+    levels = np.array([row[3] for row in rows])
+    ramp_sec = 0.1
+    times = np.concatenate(([0.0], np.repeat(bounds, 2) + np.tile([-ramp_sec / 2, ramp_sec / 2], len(bounds)),
+                            [duration_sec]))
+    envelope = np.interp(np.arange(n_samples) / sr, times, np.repeat(levels, 2))
+
+    sos = signal.butter(4, 800.0, btype='low', fs=sr, output='sos')
+    noise = signal.sosfilt(sos, rng.standard_normal((num_channels, n_samples)), axis=1)
+    noise /= np.std(noise) or 1.0
+    gains = rng.uniform(0.5, 1.5, size=(num_channels, 1))
+    audio_data = noise_level * gains * noise * np.maximum(envelope, floor_level)
+    truth = add_crackles(audio_data, sr, rng, crackle_rate)
+
+    # merge same-phase neighbours (gap pauses next to the pause)
+    merged = []
+    for start, end, phase, _ in rows:
+        if merged and merged[-1][2] == phase:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end, phase])
+    start_ms, end_ms, phase = zip(*merged)
+    segments = {'start_ms': np.array(start_ms) * 1000.0, 'end_ms': np.array(end_ms) * 1000.0,
+                'phase': np.array(phase, dtype=np.int8)}
+    return audio_data.astype(np.float32), truth, segments
+
+################################################################################
+# Accuracy
+################################################################################
+
+def score_families(families, truth, tolerance_ms=None):
+    """
+    Match families to true crackles by median channel time.
+
+    Returns precision/recall/F1 over crackles, the fraction of true
+    channel arrivals found, the mean |time error| of matched channels and
+    the mean error of arrival differences to the family's leader (TDOA).
+    """
+    if tolerance_ms is None:
+        tolerance_ms = MATCH_TOLERANCE_MS
+    truth_centers = np.array([np.median(list(c['channels'].values())) for c in truth])
+    matched_truth = set()
+    time_errors = []
+    tdoa_errors = []
+    channels_found = 0
+    true_positives = 0
+
+    for family in families:
+        if not family or not len(truth_centers):
+            continue
+        center = np.median([entry['time'] for entry in family])
+        order = np.argsort(np.abs(truth_centers - center))
+        k = next((int(k) for k in order if int(k) not in matched_truth), None)
+        if k is None or abs(truth_centers[k] - center) > tolerance_ms:
+            continue
+        matched_truth.add(k)
+        true_positives += 1
+        arrivals = truth[k]['channels']
+        leader = next((e for e in family if e['delay'] == 0.0 and e['transmission_coefficient'] == 1.0), family[0])
+        for entry in family:
+            ch = entry['channel']
+            if ch not in arrivals:
+                continue
+            channels_found += 1
+            time_errors.append(abs(entry['time'] - arrivals[ch]))
+            if ch != leader['channel']:
+                detected = entry['time'] - leader['time']
+                expected = arrivals[ch] - arrivals[leader['channel']]
+                tdoa_errors.append(abs(detected - expected))
+
+    n_families = sum(1 for family in families if family)
+    precision = true_positives / n_families if n_families else 0.0
+    recall = true_positives / len(truth) if truth else 0.0
+    total_arrivals = sum(len(c['channels']) for c in truth)
+    return {
+        'true_crackles': len(truth),
+        'families': n_families,
+        'precision': precision,
+        'recall': recall,
+        'f1': 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        'channel_recall': channels_found / total_arrivals if total_arrivals else 0.0,
+        'time_error_ms': float(np.mean(time_errors)) if time_errors else None,
+        'tdoa_error_ms': float(np.mean(tdoa_errors)) if tdoa_errors else None,
+    }
+
+################################################################################
+# Stage timing
+################################################################################
+
+def run_stages(input_file):
+    """
+    Run the analyze_file pipeline one stage at a time.
+
+    Returns (families, {stage: seconds}). Detection is split into the
+    rolling threshold and find_peaks, both at full rate (check_prescreen
+    times the pre-screened detector); no dummy family is added.
+    """
+    timings = {}
+
+    def timed(stage, fn, *args):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - t0
+        return result
+
+    audio_data, sr = timed('load', ap.load_audio, input_file)
+    num_channels = audio_data.shape[0]
+
+    spikes = []
+    for ch in range(num_channels):
+        masked = timed('threshold', ap.masked_local_threshold, audio_data[ch], ap.LOCAL_WINDOW_SIZE,
+                       ap.LOCAL_WINDOW_STEP, ap.MAD_FACTOR, ap.THRESHOLD_ENGINE)
+        peaks, _ = timed('peaks', lambda x: signal.find_peaks(x, prominence=ap.PEAK_PROMINENCE), masked)
+        spikes.append((peaks, ch))
+
+    def spike_table():
+        all_spikes = np.empty(sum(len(peaks) for peaks, _ in spikes), dtype=ap.SPIKE_DTYPE)
+        all_spikes['channel'] = np.concatenate([np.full(len(peaks), ch) for peaks, ch in spikes])
+        all_spikes['time_ms'] = np.concatenate([(peaks / sr) * 1000.0 for peaks, _ in spikes])
+        return all_spikes[np.argsort(all_spikes['time_ms'], kind='stable')]
+    all_spikes = timed('peaks', spike_table)
+
+    clusters = timed('clustering', ap.cluster_spikes, all_spikes, num_channels)
+    crackle_families = timed('refinement', ap.refine_clusters, all_spikes, clusters, audio_data, sr)
+    families = timed('cross_correlation', lambda: [
+        ap.process_family(i, family, audio_data, sr) for i, family in enumerate(crackle_families)
+    ])
+    families_json = timed('serialization', ap.families_to_json, families)
+    return json.loads(families_json), timings
+
+def check_prescreen(audio_data, sr):
+    """
+    Compare the pre-screened detector with the full-rate one, channel by
+    channel: recall of the full-rate spikes (1.0 by construction), spikes
+    only the pre-screen found, fraction of samples skipped and both times.
+    """
+    params = dict(window_size=ap.LOCAL_WINDOW_SIZE, step=ap.LOCAL_WINDOW_STEP, factor=ap.MAD_FACTOR,
+                  peak_prominence=ap.PEAK_PROMINENCE, engine=ap.THRESHOLD_ENGINE)
+    full_spikes = found = extra = processed = 0
+    full_sec = prescreen_sec = 0.0
+    for channel in audio_data:
+        t0 = time.perf_counter()
+        full = ap.detect_spikes_local_threshold(channel, sr, **params)
+        t1 = time.perf_counter()
+        screened, channel_processed = ap.detect_spikes_prescreened(channel, sr, block=ap.PRESCREEN_BLOCK, **params)
+        t2 = time.perf_counter()
+        full_sec += t1 - t0
+        prescreen_sec += t2 - t1
+        common = len(np.intersect1d(full, screened))
+        full_spikes += len(full)
+        found += common
+        extra += len(screened) - common
+        processed += channel_processed
+    return {
+        'recall': found / full_spikes if full_spikes else 1.0,
+        'extra_spikes': extra,
+        'skipped_fraction': 1.0 - processed / audio_data.size if audio_data.size else 0.0,
+        'full_rate_sec': full_sec,
+        'prescreen_sec': prescreen_sec,
+    }
+
+def check_lean_detection(audio_data, sr):
+    """
+    Compare lean detection (per-step float32 thresholds, in-place mask,
+    chunked find_peaks) with the float64 full-length one on whole channels:
+    identical spikes, peak allocation per channel (tracemalloc) and times.
+    """
+    import tracemalloc
+    params = dict(window_size=ap.LOCAL_WINDOW_SIZE, step=ap.LOCAL_WINDOW_STEP, factor=ap.MAD_FACTOR,
+                  peak_prominence=ap.PEAK_PROMINENCE, engine=ap.THRESHOLD_ENGINE)
+    identical = True
+    peak = {False: 0, True: 0}
+    seconds = {False: 0.0, True: 0.0}
+    for channel in audio_data:
+        spikes = {}
+        for lean in (False, True):
+            tracemalloc.start()
+            try:
+                t0 = time.perf_counter()
+                spikes[lean] = ap.detect_spikes_local_threshold(channel, sr, lean=lean, **params)
+                seconds[lean] += time.perf_counter() - t0
+                peak[lean] = max(peak[lean], tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        identical &= bool(np.array_equal(spikes[False], spikes[True]))
+    return {
+        'identical': identical,
+        'channel_bytes': audio_data[0].nbytes if len(audio_data) else 0,
+        'full_peak_bytes': peak[False],
+        'lean_peak_bytes': peak[True],
+        'full_sec': seconds[False],
+        'lean_sec': seconds[True],
+    }
+
+def benchmark_case(duration_sec, num_channels, sr=48000, seed=0, repeat=1, noise_level=None):
+    """
+    Synthesize one recording, time the pipeline on it (best of 'repeat' per
+    stage) and score the result.
+    """
+    if noise_level is None:
+        noise_level = SYNTH_NOISE_LEVEL
+    audio_data, truth = synthesize_recording(duration_sec, num_channels, sr=sr, seed=seed,
+                                             noise_level=noise_level)
+    fd, path = tempfile.mkstemp(suffix='.wav')
+    os.close(fd)
+    try:
+        sf.write(path, audio_data.T, sr, subtype='FLOAT')
+        best = None
+        for _ in range(max(1, repeat)):
+            families, timings = run_stages(path)
+            best = timings if best is None else {k: min(v, best[k]) for k, v in timings.items()}
+    finally:
+        os.remove(path)
+    prescreen = check_prescreen(audio_data, sr)
+    lean = check_lean_detection(audio_data, sr)
+
+    total = sum(best.values())
+    return {
+        'duration_sec': duration_sec,
+        'channels': num_channels,
+        'sample_rate': sr,
+        'seed': seed,
+        'noise_level': noise_level,
+        'stage_sec': best,
+        'total_sec': total,
+        'realtime_factor': duration_sec / total if total else None,
+        'accuracy': score_families(families, truth),
+        'prescreen': prescreen,
+        'lean_detection': lean,
+    }
+
+def family_concurrency(duration_sec, num_channels, worker_counts, sr=48000, seed=0, repeat=1):
+    """
+    Time the cross-correlation stage serially and on every (executor,
+    workers) combination on one synthetic recording. Every run must give
+    the serial families, in the same order.
+    """
+    from audio_parallel import iter_processed_families
+    audio_data, _ = synthesize_recording(duration_sec, num_channels, sr=sr, seed=seed)
+    all_spikes = ap.detect_all_spikes(audio_data, sr)
+    clusters = ap.cluster_spikes(all_spikes, num_channels)
+    crackle_families = ap.refine_clusters(all_spikes, clusters, audio_data, sr)
+
+    def best_time(run):
+        best = None
+        for _ in range(max(1, repeat)):
+            t0 = time.perf_counter()
+            result = list(run())
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        return result, best
+
+    serial, serial_sec = best_time(lambda: (ap.process_family(i, family, audio_data, sr)
+                                            for i, family in enumerate(crackle_families)))
+    runs = []
+    for executor in ('thread', 'process'):
+        for workers in worker_counts:
+            families, elapsed = best_time(lambda: iter_processed_families(crackle_families, audio_data, sr,
+                                                                          workers=workers, executor=executor))
+            runs.append({
+                'executor': executor,
+                'workers': workers,
+                'seconds': elapsed,
+                'speedup': serial_sec / elapsed if elapsed else None,
+                'identical': ap.families_to_json(families) == ap.families_to_json(serial),
+            })
+            sys.stderr.write(f"{len(crackle_families)} families, {executor} x {workers}: {elapsed:.2f} s "
+                             f"({runs[-1]['speedup']:.2f}x serial)\n")
+    return {
+        'duration_sec': duration_sec,
+        'channels': num_channels,
+        'families': len(crackle_families),
+        'cpu_count': os.cpu_count(),
+        'serial_sec': serial_sec,
+        'runs': runs,
+    }
+
+def lag_search_savings(duration_sec, num_channels, bounds_ms, sr=48000, seed=0, repeat=3):
+    """
+    Time the cross-correlation stage unbounded and with every MAX_LAG_MS in
+    bounds_ms, each bound both with direct dot products and with the
+    batched FFT, on one synthetic recording. Shows what a bound saves and
+    where DIRECT_LAG_SEARCH_MAX should sit (the widest window direct wins).
+    """
+    audio_data, _ = synthesize_recording(duration_sec, num_channels, sr=sr, seed=seed)
+    all_spikes = ap.detect_all_spikes(audio_data, sr)
+    clusters = ap.cluster_spikes(all_spikes, num_channels)
+    crackle_families = ap.refine_clusters(all_spikes, clusters, audio_data, sr)
+
+    def best_time():
+        best = None
+        for _ in range(max(1, repeat)):
+            t0 = time.perf_counter()
+            for family_idx, cluster_family in enumerate(crackle_families):
+                ap.process_family(family_idx, cluster_family, audio_data, sr)
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    saved = ap.MAX_LAG_MS, ap.DIRECT_LAG_SEARCH_MAX
+    runs = []
+    try:
+        ap.MAX_LAG_MS = None
+        unbounded_sec = best_time()
+        for bound_ms in bounds_ms:
+            ap.MAX_LAG_MS = bound_ms
+            lags = 2 * ap.max_lag_samples(sr) + 1
+            timings = {}
+            for method, direct_max in (('direct', lags), ('fft', 0)):
+                ap.DIRECT_LAG_SEARCH_MAX = direct_max
+                timings[method] = best_time()
+            chosen = 'direct' if lags <= saved[1] else 'fft'
+            runs.append({
+                'max_lag_ms': bound_ms,
+                'lags': lags,
+                'direct_sec': timings['direct'],
+                'fft_sec': timings['fft'],
+                'chosen': chosen,
+                'saving': 1.0 - timings[chosen] / unbounded_sec if unbounded_sec else None,
+            })
+            sys.stderr.write(f"MAX_LAG_MS {bound_ms:g} ({lags} lags): direct {timings['direct']:.3f} s, "
+                             f"FFT {timings['fft']:.3f} s, unbounded {unbounded_sec:.3f} s, "
+                             f"{chosen} saves {100.0 * runs[-1]['saving']:.0f}%\n")
+    finally:
+        ap.MAX_LAG_MS, ap.DIRECT_LAG_SEARCH_MAX = saved
+    return {
+        'duration_sec': duration_sec,
+        'channels': num_channels,
+        'families': len(crackle_families),
+        'direct_lag_search_max': saved[1],
+        'unbounded_sec': unbounded_sec,
+        'runs': runs,
+    }
+
+def write_conversion_input(path, kind, duration_sec, num_channels, sr=48000, seed=0, block_sec=10.0):
+    """
+    Write a duration_sec x num_channels noise recording to path, block by
+    block: 'pcm24' as a raw capture, 'flac' / 'wav' as 24-bit files.
+    """
+    from raw_capture import encode_int24
+    rng = np.random.default_rng(seed)
+    n_samples = int(round(duration_sec * sr))
+    block = int(block_sec * sr)
+    out = open(path, 'wb') if kind == 'pcm24' else \
+        sf.SoundFile(path, 'w', samplerate=sr, channels=num_channels, subtype='PCM_24', format=kind.upper())
+    with out:
+        for start in range(0, n_samples, block):
+            audio = breath_noise(num_channels, min(block, n_samples - start), sr, rng, SYNTH_NOISE_LEVEL)
+            if kind == 'pcm24':
+                out.write(encode_int24(audio))
+            else:
+                out.write(audio.T)
+
+def conversion_throughput(duration_sec, num_channels, kinds=('pcm24', 'flac', 'wav'), sr=48000, seed=0):
+    """
+    Time format_converter.convert (with a preview) on a duration_sec x
+    num_channels input of every kind. Peak allocation is traced, so it shows
+    whether memory stays bounded as recordings get longer.
+    """
+    import tracemalloc
+    from format_converter import convert
+    runs = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for kind in kinds:
+            input_path = os.path.join(tmp_dir, f"input.{kind}")
+            output_path = os.path.join(tmp_dir, 'output.wav')
+            write_conversion_input(input_path, kind, duration_sec, num_channels, sr=sr, seed=seed)
+            raw = {'encoding': 'pcm24', 'channels': num_channels, 'sample_rate': sr} if kind == 'pcm24' else None
+            tracemalloc.start()
+            try:
+                summary = convert(input_path, output_path, raw=raw)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            input_bytes = os.path.getsize(input_path)
+            runs.append({
+                'input': kind,
+                'input_bytes': input_bytes,
+                'output_bytes': os.path.getsize(output_path),
+                'output_format': summary['format'],
+                'seconds': summary['seconds'],
+                'input_mb_per_sec': input_bytes / 1e6 / summary['seconds'],
+                'realtime_factor': duration_sec / summary['seconds'],
+                'peak_bytes': peak,
+            })
+            sys.stderr.write(f"convert {kind} {duration_sec:g} s x {num_channels} ch: {summary['seconds']:.2f} s "
+                             f"({runs[-1]['realtime_factor']:.0f}x real time, "
+                             f"{runs[-1]['input_mb_per_sec']:.0f} MB/s in, peak {peak / 1e6:.1f} MB)\n")
+            os.remove(input_path)
+            os.remove(output_path)
+    finally:
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+    return {'duration_sec': duration_sec, 'channels': num_channels, 'sample_rate': sr, 'runs': runs}
+
+# Labeled breathing for breath_gating: continuous breaths (expiration right
+# after inspiration), a quiet expiration behind a short gap, short pauses.
+BREATH_CASES = {
+    'continuous': {'expiration_level': 0.5},
+    'quiet_expiration': {'expiration_level': 0.3, 'gap_sec': 0.2},
+    'short_pause': {'expiration_level': 0.5, 'pause_sec': 0.4},
+}
+BREATH_SCORE_STEP_MS = 10.0
+
+def segmentation_accuracy(found, truth, duration_ms, step_ms=BREATH_SCORE_STEP_MS):
+    """
+    Share of step_ms frames whose found phase is the true one, and the
+    found vs true interval counts per phase.
+    """
+    import audio_breath
+    times = np.arange(0.0, duration_ms, step_ms)
+    hits = np.array(audio_breath.phase_at(found, times)) == np.array(audio_breath.phase_at(truth, times))
+    return {
+        'frame_accuracy': float(np.mean(hits)),
+        'intervals': {phase: {'found': int(np.sum(found['phase'] == code)), 'true': int(np.sum(truth['phase'] == code))}
+                      for code, phase in enumerate(audio_breath.PHASES)},
+    }
+
+def breath_gating(duration_sec, num_channels, phases=('inspiration',), sr=48000, seed=0):
+    """
+    Score the breath segmentation on every BREATH_CASES recording (frame
+    accuracy against the true phases), then time the whole pipeline on the
+    first with and without BREATH_PHASES = phases: the segmentation cost,
+    the share of samples left to analyze, and the family counts per phase.
+    The gated families must be the ungated ones that start in the chosen
+    phases, up to the clustering done on fewer spikes.
+    """
+    import audio_breath
+    cases = {}
+    recordings = {}
+    for name, options in BREATH_CASES.items():
+        audio_data, truth, true_segments = synthesize_breathing(duration_sec, num_channels, sr=sr, seed=seed,
+                                                                **options)
+        t0 = time.perf_counter()
+        segments = audio_breath.segment_recording(audio_data, sr)
+        seconds = time.perf_counter() - t0
+        cases[name] = dict(segmentation_accuracy(segments, true_segments, 1000.0 * duration_sec),
+                           segmentation_sec=seconds)
+        recordings[name] = (audio_data, truth, segments)
+        sys.stderr.write(f"breath segmentation {name}: {100.0 * cases[name]['frame_accuracy']:.1f}% of the frames, "
+                         + ', '.join(f"{phase} {counts['found']}/{counts['true']}"
+                                     for phase, counts in cases[name]['intervals'].items()) + "\n")
+
+    name = next(iter(BREATH_CASES))
+    audio_data, truth, segments = recordings[name]
+    ranges = audio_breath.phase_ranges(segments, phases, sr, audio_data.shape[1])
+    saved = ap.BREATH_PHASES
+    runs = {}
+    try:
+        for run, value in (('ungated', None), ('gated', tuple(phases))):
+            ap.BREATH_PHASES = value
+            t0 = time.perf_counter()
+            families = list(ap.iter_families(audio_data, sr))
+            runs[run] = {'seconds': time.perf_counter() - t0, 'families': len(families),
+                         'per_phase': audio_breath.breath_summary(segments, families)['families']}
+    finally:
+        ap.BREATH_PHASES = saved
+    analyzed = float(np.sum(ranges[:, 1] - ranges[:, 0])) / audio_data.shape[1]
+    sys.stderr.write(f"breath gating {duration_sec:g} s x {num_channels} ch on {', '.join(phases)}: "
+                     f"segmentation {cases[name]['segmentation_sec']:.3f} s, "
+                     f"{100.0 * analyzed:.1f}% of the samples analyzed, "
+                     f"{runs['gated']['seconds']:.2f} s vs {runs['ungated']['seconds']:.2f} s ungated, "
+                     f"{runs['gated']['families']} of {runs['ungated']['families']} families\n")
+    return {
+        'duration_sec': duration_sec,
+        'channels': num_channels,
+        'phases': list(phases),
+        'cases': cases,
+        'timed_case': name,
+        'summary': audio_breath.breath_summary(segments),
+        'segmentation_sec': cases[name]['segmentation_sec'],
+        'analyzed_fraction': analyzed,
+        'crackles': len(truth),
+        'runs': runs,
+    }
+
+# Noise level of realtime_replay's recording: loud enough that noise spikes
+# keep one cluster open for longer than REALTIME_BUFFER_SEC
+REPLAY_NOISE_LEVEL = 0.02
+
+def realtime_replay(duration_sec, num_channels, noise_level=None, sr=48000, seed=0):
+    """
+    Replay a long, noisy synthetic recording through audio_realtime as fast
+    as possible and compare with analyze_file: the live detector must get
+    through it (a cluster outliving the ring buffer is closed early), and
+    emits the batch families when none was. Frame times as in replay_file.
+    """
+    import audio_realtime
+    if noise_level is None:
+        noise_level = REPLAY_NOISE_LEVEL
+    audio_data, _ = synthesize_recording(duration_sec, num_channels, sr=sr, seed=seed, noise_level=noise_level)
+    fd, path = tempfile.mkstemp(suffix='.wav')
+    os.close(fd)
+    try:
+        sf.write(path, audio_data.T, sr, subtype='FLOAT')
+        batch = ap.convert_numpy_types(ap.analyze_file(path))
+        families, stats = audio_realtime.replay_file(path, speed=0)
+    finally:
+        os.remove(path)
+    families = ap.convert_numpy_types(families)
+    spans = [max(entry['time'] for entry in family) - min(entry['time'] for entry in family) for family in batch]
+    identical = families == [family for family in batch if not ap.is_dummy_family(family)]
+    if not stats['clusters_closed_early'] and not identical:
+        raise RuntimeError(f"Real-time replay of {duration_sec:g} s x {num_channels} ch differs from analyze_file")
+    sys.stderr.write(f"real-time replay {duration_sec:g} s x {num_channels} ch, noise {noise_level:g}: "
+                     f"{len(families)} families vs {len(batch)} in batch "
+                     f"(longest {max(spans, default=0.0) / 1000.0:.1f} s), "
+                     f"{stats['clusters_closed_early']} closed early, frames {stats['push_ms_mean']:.1f} ms mean, "
+                     f"{stats['push_ms_max']:.1f} ms max\n")
+    return dict(stats, duration_sec=duration_sec, channels=num_channels, noise_level=noise_level,
+                families=len(families), batch_families=len(batch), identical=identical,
+                longest_batch_family_sec=max(spans, default=0.0) / 1000.0)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(durations, channel_counts, seed=0, repeat=1, noise_level=None):
+    # the first run imports scipy.signal (lazily loaded by audio_process),
+    # keep that out of the first case's timings
+    benchmark_case(1.0, 1)
+    cases = []
+    for duration_sec in durations:
+        for num_channels in channel_counts:
+            case = benchmark_case(duration_sec, num_channels, seed=seed, repeat=repeat, noise_level=noise_level)
+            sys.stderr.write(f"{duration_sec:g} s x {num_channels} ch: {case['total_sec']:.2f} s, "
+                             f"F1 {case['accuracy']['f1']:.3f}, pre-screen skips "
+                             f"{100.0 * case['prescreen']['skipped_fraction']:.1f}% "
+                             f"(recall {case['prescreen']['recall']:.3f}), lean detection peak "
+                             f"{case['lean_detection']['lean_peak_bytes'] / 1e6:.1f} MB vs "
+                             f"{case['lean_detection']['full_peak_bytes'] / 1e6:.1f} MB per channel\n")
+            cases.append(case)
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'parameters': dict(ap.tunable_parameters(), THRESHOLD_ENGINE=ap.THRESHOLD_ENGINE, PRESCREEN=ap.PRESCREEN,
+                           LEAN_DETECTION=ap.LEAN_DETECTION),
+        'cases': cases,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark audio_process.py on synthetic crackle recordings")
+    parser.add_argument('--durations', default='10,60', help="comma-separated recording lengths in seconds")
+    parser.add_argument('--channels', default='2,6', help="comma-separated channel counts")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--noise', type=float, help=f"breath noise level (default {SYNTH_NOISE_LEVEL})")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per case, best time per stage is kept")
+    parser.add_argument('--family-workers',
+                        help="comma-separated worker counts: also time concurrent family processing "
+                             "against the serial loop (longest duration, most channels)")
+    parser.add_argument('--convert', action='append', default=[],
+                        help="DURATIONxCHANNELS: also time format_converter.py on raw, FLAC and WAV inputs "
+                             "of that size (e.g. 3600x6 for an hour-long 6-channel recording)")
+    parser.add_argument('--lag-bounds',
+                        help="comma-separated MAX_LAG_MS values: also time the cross-correlation stage with each "
+                             "bound, direct vs FFT, against the unbounded search (longest duration, most channels)")
+    parser.add_argument('--breath', metavar='PHASES',
+                        help="comma-separated breath phases: also score the breath segmentation on labeled "
+                             "breathing and time the pipeline gated to them (BREATH_PHASES) against the whole "
+                             "recording (longest duration, most channels)")
+    parser.add_argument('--realtime', action='append', default=[],
+                        help="DURATIONxCHANNELS: also replay a noisy recording of that size through "
+                             f"audio_realtime.py (noise {REPLAY_NOISE_LEVEL}) and compare with batch mode, "
+                             "e.g. 20x6")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    durations = [float(d) for d in args.durations.split(',')]
+    channel_counts = [int(c) for c in args.channels.split(',')]
+    report = run_benchmark(durations, channel_counts, seed=args.seed, repeat=args.repeat, noise_level=args.noise)
+    if args.family_workers:
+        report['family_concurrency'] = family_concurrency(
+            max(durations), max(channel_counts), [int(w) for w in args.family_workers.split(',')],
+            seed=args.seed, repeat=args.repeat
+        )
+    if args.lag_bounds:
+        report['lag_search'] = lag_search_savings(max(durations), max(channel_counts),
+                                                  [float(b) for b in args.lag_bounds.split(',')],
+                                                  seed=args.seed, repeat=max(3, args.repeat))
+    if args.breath:
+        report['breath_gating'] = breath_gating(max(durations), max(channel_counts), args.breath.split(','),
+                                                seed=args.seed)
+    if args.convert:
+        report['conversion'] = []
+        for spec in args.convert:
+            duration, channels = spec.lower().split('x')
+            report['conversion'].append(conversion_throughput(float(duration), int(channels), seed=args.seed))
+    if args.realtime:
+        report['realtime_replay'] = []
+        for spec in args.realtime:
+            duration, channels = spec.lower().split('x')
+            report['realtime_replay'].append(realtime_replay(float(duration), int(channels), seed=args.seed))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
@@ -1,90 +1,157 @@
 import sys
+from functools import lru_cache
+from math import gcd
+
 import numpy as np
 import soundfile as sf
-import librosa
-import wave
+
+# Output frames processed per block, memory use doesn't grow with file length
+COMBINE_BLOCK_FRAMES = 1 << 16
+
+@lru_cache(maxsize=None)
+def polyphase_filter(up, down, dtype):
+    """
+    The FIR filter signal.resample_poly designs for (up, down), built once
+    per rate pair instead of once per call.
+    """
+    from scipy import signal  # only needed when resampling, and slow to import
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = signal.firwin(2 * half_len + 1, 1. / max_rate, window=('kaiser', 5.0))
+    return h.astype(dtype)
+
+class MonoInput:
+    """
+    One input file read as mono float32 (like librosa.load(mono=True)) at
+    target_sr, with random access by output frame so inputs can be read
+    block by block and side by side.
+    """
+
+    def __init__(self, path, target_sr):
+        self.sound_file = sf.SoundFile(path)
+        self.sr = self.sound_file.samplerate
+        self.n_in = self.sound_file.frames
+        g = gcd(target_sr, self.sr)
+        self.up = target_sr // g
+        self.down = self.sr // g
+        # same length resample_poly / librosa.resample give
+        self.frames = -(-self.n_in * self.up // self.down)
+        if self.up != 1 or self.down != 1:
+            self.filter = polyphase_filter(self.up, self.down, np.dtype(np.float32))
+            # input context on each side, a multiple of 'down' so segment
+            # outputs stay on the whole-file output grid
+            self.pad = (-(-len(self.filter) // (self.up * self.down)) + 1) * self.down
+
+    def _read_input(self, start, stop):
+        self.sound_file.seek(start)
+        data = self.sound_file.read(stop - start, dtype='float32', always_2d=True)
+        if data.shape[1] == 1:
+            return data[:, 0]
+        return np.mean(data.T, axis=0)
+
+    def read(self, start, stop):
+        """
+        Output frames [start, stop) of this input at the target rate.
+        Resampled blocks are bit-identical to resampling the whole file
+        with signal.resample_poly.
+        """
+        if self.up == 1 and self.down == 1:
+            return self._read_input(start, stop)
+        from scipy import signal
+        seg_start = max(0, (start // self.up) * self.down - self.pad)
+        seg_end = min(self.n_in, -(-stop // self.up) * self.down + self.pad)
+        resampled = signal.resample_poly(self._read_input(seg_start, seg_end), self.up, self.down,
+                                         window=self.filter)
+        offset = seg_start * self.up // self.down
+        return resampled[start - offset:stop - offset]
+
+    def close(self):
+        self.sound_file.close()
+
+def open_inputs(input_paths):
+    """
+    Open every input at a common sample rate (the highest one).
+
+    Returns (inputs, sample_rate, num_frames) where num_frames is the
+    shortest input's length; longer inputs are trimmed to it.
+    """
+    sample_rates = [sf.info(path).samplerate for path in input_paths]
+    sample_rate = max(sample_rates)
+    if len(set(sample_rates)) > 1:
+        print(f"Warning: Input files have different sample rates: {sample_rates}")
+        print("Resampling to the highest sample rate.")
+
+    inputs = [MonoInput(path, sample_rate) for path in input_paths]
+    num_frames = min(inp.frames for inp in inputs)
+    print(f"Minimum file length: {num_frames} samples")
+    for i, inp in enumerate(inputs):
+        if inp.frames > num_frames:
+            print(f"Trimming file {i+1} from {inp.frames} to {num_frames} samples")
+    return inputs, sample_rate, num_frames
+
+def iter_combined_blocks(inputs, num_frames, block_frames=COMBINE_BLOCK_FRAMES):
+    """
+    Yield (start, block) with block of shape (frames, channels), the inputs
+    interleaved block by block.
+    """
+    block = np.empty((min(block_frames, max(num_frames, 1)), len(inputs)), dtype=np.float32)
+    for start in range(0, num_frames, block_frames):
+        stop = min(num_frames, start + block_frames)
+        for ch, inp in enumerate(inputs):
+            block[:stop - start, ch] = inp.read(start, stop)
+        yield start, block[:stop - start]
 
 def combine_wav_files(output_path, input_paths):
     """
     Combine multiple mono WAV files into a single multi-channel WAV file.
-    
+
     Args:
         output_path (str): Path to save the combined WAV file
         input_paths (list): List of paths to the input WAV files
     """
     print(f"Combining {len(input_paths)} WAV files into {output_path}")
-    
-    # Read all input files
-    audio_data = []
-    sample_rates = []
-    
-    for path in input_paths:
-        print(f"Reading file: {path}")
-        data, sr = librosa.load(path, sr=None, mono=True)
-        print(f"File loaded with shape: {data.shape}, sample rate: {sr}")
-        audio_data.append(data)
-        sample_rates.append(sr)
-    
-    # Check if all sample rates are the same
-    if len(set(sample_rates)) > 1:
-        print(f"Warning: Input files have different sample rates: {sample_rates}")
-        print("Resampling to the highest sample rate.")
-        max_sr = max(sample_rates)
-        
-        # Resample all audio to the highest sample rate
-        for i in range(len(audio_data)):
-            if sample_rates[i] != max_sr:
-                audio_data[i] = librosa.resample(audio_data[i], orig_sr=sample_rates[i], target_sr=max_sr)
-        
-        sample_rate = max_sr
-    else:
-        sample_rate = sample_rates[0]
-    
-    # Find the length of the shortest file
-    min_length = min(len(data) for data in audio_data)
-    print(f"Minimum file length: {min_length} samples")
-    
-    # Trim or pad all audio data to the same length
-    for i in range(len(audio_data)):
-        if len(audio_data[i]) > min_length:
-            print(f"Trimming file {i+1} from {len(audio_data[i])} to {min_length} samples")
-            audio_data[i] = audio_data[i][:min_length]
-        elif len(audio_data[i]) < min_length:
-            print(f"Padding file {i+1} from {len(audio_data[i])} to {min_length} samples")
-            padding = np.zeros(min_length - len(audio_data[i]))
-            audio_data[i] = np.concatenate((audio_data[i], padding))
-    
-    # Stack the audio data to create a multi-channel array
-    # Shape should be (num_channels, num_samples)
-    combined = np.vstack(audio_data)
-    print(f"Combined data shape: {combined.shape}")
-    
-    # Verify we have a multi-channel array
-    if combined.ndim != 2:
-        print("Error: Failed to create multi-channel array")
-        return False
-    
-    # Write using soundfile for better multi-channel support
-    # Note: soundfile expects (num_samples, num_channels) so we transpose
-    sf.write(output_path, combined.T, sample_rate)
-    
-    # Double-check that the file was written with correct number of channels
-    with wave.open(output_path, 'rb') as wf:
-        channels = wf.getnchannels()
-        print(f"Successfully wrote file with {channels} channels")
-        if channels != len(input_paths):
-            print("Warning: Number of channels in output file doesn't match number of input files!")
-    
-    print(f"Successfully combined {len(input_paths)} files into a multi-channel WAV file")
+
+    inputs, sample_rate, num_frames = open_inputs(input_paths)
+    try:
+        # soundfile's default WAV subtype (PCM_16), as sf.write used before
+        with sf.SoundFile(output_path, 'w', samplerate=sample_rate, channels=len(inputs)) as out:
+            for _, block in iter_combined_blocks(inputs, num_frames):
+                out.write(block)
+    finally:
+        for inp in inputs:
+            inp.close()
+
+    print(f"Successfully combined {len(input_paths)} files into a {len(input_paths)}-channel WAV file")
     return True
 
+def load_combined(input_paths):
+    """
+    Combine the inputs straight into an array for analysis, without writing
+    a temporary WAV.
+
+    Returns audio_data with shape (num_channels, n_samples) and sample_rate.
+    These are the samples combine_wav_files writes, before the WAV's 16-bit
+    quantization.
+    """
+    inputs, sample_rate, num_frames = open_inputs(input_paths)
+    audio_data = np.empty((len(inputs), num_frames), dtype=np.float32)
+    try:
+        for start in range(0, num_frames, COMBINE_BLOCK_FRAMES):
+            stop = min(num_frames, start + COMBINE_BLOCK_FRAMES)
+            for ch, inp in enumerate(inputs):
+                audio_data[ch, start:stop] = inp.read(start, stop)
+    finally:
+        for inp in inputs:
+            inp.close()
+    return audio_data, sample_rate
+
 if __name__ == "__main__":
     # Check command-line arguments
     if len(sys.argv) < 3:
         print("Usage: python combine_wav.py <output_path> <input_path1> [input_path2] [input_path3] ...")
         sys.exit(1)
-    
+
     output_path = sys.argv[1]
     input_paths = sys.argv[2:]
-    
-    combine_wav_files(output_path, input_paths)
\ No newline at end of file
+
+    combine_wav_files(output_path, input_paths)
@@ -1,2 +1,314 @@
-#TODO: Implement script to convert files to .wav format, then allows the use to save them to their computer
+# Streaming conversion of device exports to analysis-ready WAV.
+# Supported inputs:
+#   * anything libsndfile reads (WAV, FLAC, OGG, AIFF, ...), whatever the
+#     file name says: multer stores every upload as .wav
+#   * headerless PCM: the recorder's raw 24-bit I2S captures (raw_capture.py)
+#     and 16/32-bit integer or float32 dumps, interleaved little-endian
+#   * several mono files, one per channel, combined as /compute-multi does
+#     (combine_wav.py, resampled to the highest rate and trimmed to the
+#     shortest)
+# The input is read, converted and written CONVERT_BLOCK_FRAMES frames at a
+# time, so memory doesn't grow with the recording's length. Integer samples
+# are written back bit-exactly: analyzing the WAV gives the same families as
+# analyzing the raw capture. The same pass can build a min/max envelope per
+# channel (PREVIEW_POINTS buckets) for the frontend to draw.
+#
+#   python format_converter.py output.wav input [input ...] [--raw pcm24 --channels 2 --sample-rate 48000]
+#                              [--subtype PCM_24] [--preview preview.json] [--preview-points 2000]
 
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import soundfile as sf
+
+import raw_capture
+
+################################################################################
+# TUNABLE PARAMETERS
+################################################################################
+
+# !!! TUNABLE PARAMETER: frames converted at once, bounds memory use
+CONVERT_BLOCK_FRAMES = 1 << 16
+# !!! TUNABLE PARAMETER: WAV sample format, None = the input's when WAV has it, else PCM_24
+CONVERT_SUBTYPE = None
+# !!! TUNABLE PARAMETER: min/max pairs per channel in a preview envelope
+PREVIEW_POINTS = 2000
+
+FALLBACK_SUBTYPE = 'PCM_24'
+# Sample formats written as is, with the bytes per sample they take
+WAV_SUBTYPES = {'PCM_16': 2, 'PCM_24': 3, 'PCM_32': 4, 'FLOAT': 4}
+# A plain WAV's sizes are 32-bit, bigger outputs are written as RF64
+WAV_MAX_DATA_BYTES = 0xFFFFFFFF - 1024
+
+# Headerless encodings: numpy dtype (None = 24-bit, see raw_capture), bytes
+# per sample, matching WAV subtype
+RAW_ENCODINGS = {
+    'pcm16': ('<i2', 2, 'PCM_16'),
+    'pcm24': (None, 3, 'PCM_24'),     # the recorder's packed captures
+    'pcm24_32': (None, 4, 'PCM_24'),  # 24-bit in 32-bit I2S slots
+    'pcm32': ('<i4', 4, 'PCM_32'),
+    'float32': ('<f4', 4, 'FLOAT'),
+}
+
+################################################################################
+# Inputs
+################################################################################
+
+class SoundFileInput:
+    """
+    A file libsndfile can read, format detected from its header.
+    """
+
+    def __init__(self, path):
+        self.sound_file = sf.SoundFile(path)
+        self.sample_rate = self.sound_file.samplerate
+        self.channels = self.sound_file.channels
+        self.frames = self.sound_file.frames
+        self.subtype = self.sound_file.subtype
+        self.description = f"{self.sound_file.format}/{self.sound_file.subtype}"
+
+    def blocks(self, block_frames):
+        """Yield (frames, channels) float32 blocks, in order."""
+        for block in self.sound_file.blocks(blocksize=block_frames, dtype='float32', always_2d=True):
+            yield block
+
+    def close(self):
+        self.sound_file.close()
+
+class RawInput:
+    """
+    Headerless interleaved samples in one of RAW_ENCODINGS, memory-mapped.
+    """
+
+    def __init__(self, path, encoding=None, channels=None, sample_rate=None):
+        encoding = encoding or 'pcm24'
+        if encoding not in RAW_ENCODINGS:
+            raise ValueError(f"Unknown raw encoding: {encoding}, expected one of {tuple(RAW_ENCODINGS)}")
+        self.dtype, self.sample_bytes, self.subtype = RAW_ENCODINGS[encoding]
+        self.channels = raw_capture.RAW_CHANNELS if channels is None else int(channels)
+        self.sample_rate = raw_capture.RAW_SAMPLE_RATE if sample_rate is None else int(sample_rate)
+        self.frame_bytes = self.channels * self.sample_bytes
+        self.frames = os.path.getsize(path) // self.frame_bytes
+        self.description = f"raw/{encoding}"
+        self.data = None
+        if self.frames:
+            self.data = np.memmap(path, dtype=np.uint8, mode='r', shape=(self.frames * self.frame_bytes,))
+
+    def _decode(self, raw):
+        if self.dtype is None:
+            samples = raw_capture.decode_int24(raw, self.channels, self.sample_bytes)
+            return samples.astype(np.float32) * np.float32(raw_capture.INT24_SCALE)
+        samples = raw.view(self.dtype).reshape(-1, self.channels)
+        if samples.dtype.kind == 'f':
+            return samples.astype(np.float32)
+        return samples.astype(np.float32) * np.float32(1.0 / (1 << (8 * self.sample_bytes - 1)))
+
+    def blocks(self, block_frames):
+        for start in range(0, self.frames, block_frames):
+            stop = min(self.frames, start + block_frames)
+            yield self._decode(self.data[start * self.frame_bytes:stop * self.frame_bytes])
+
+    def close(self):
+        self.data = None
+
+class CombinedInput:
+    """
+    Mono files as the channels of one recording (combine_wav.open_inputs).
+    """
+
+    def __init__(self, paths):
+        from combine_wav import open_inputs
+        self.inputs, self.sample_rate, self.frames = open_inputs(paths)
+        self.channels = len(self.inputs)
+        self.subtype = None  # mixed down and resampled, no single source format
+        self.description = f"{len(paths)} mono files"
+
+    def blocks(self, block_frames):
+        from combine_wav import iter_combined_blocks
+        for _, block in iter_combined_blocks(self.inputs, self.frames, block_frames):
+            yield block
+
+    def close(self):
+        for inp in self.inputs:
+            inp.close()
+
+def open_input(input_paths, raw=None):
+    """
+    The input reader for one path (or a list of them): RawInput when raw
+    ({ encoding, channels, sample_rate }) is given, CombinedInput for
+    several paths, SoundFileInput otherwise.
+    """
+    if isinstance(input_paths, str):
+        input_paths = [input_paths]
+    if len(input_paths) == 0:
+        raise ValueError("No input files")
+    if raw is not None:
+        if len(input_paths) > 1:
+            raise ValueError("Raw input is a single interleaved file")
+        return RawInput(input_paths[0], **raw)
+    if len(input_paths) > 1:
+        return CombinedInput(input_paths)
+    return SoundFileInput(input_paths[0])
+
+################################################################################
+# Preview
+################################################################################
+
+class PreviewEnvelope:
+    """
+    Per-channel min and max over 'points' equal buckets of the recording,
+    filled block by block, in order. A bucket split between two blocks is
+    started by the first and merged into by the second.
+    """
+
+    def __init__(self, frames, channels, sample_rate, points=None):
+        points = PREVIEW_POINTS if points is None else points
+        self.frames = frames
+        self.sample_rate = sample_rate
+        self.bucket = max(1, -(-frames // max(1, points)))
+        n_buckets = -(-frames // self.bucket)
+        self.mins = np.zeros((channels, n_buckets), dtype=np.float32)
+        self.maxs = np.zeros((channels, n_buckets), dtype=np.float32)
+
+    def update(self, start, block):
+        # rest of the bucket the previous block started
+        head = min(len(block), -start % self.bucket)
+        if head:
+            i = start // self.bucket
+            np.minimum(self.mins[:, i], block[:head].min(axis=0), out=self.mins[:, i])
+            np.maximum(self.maxs[:, i], block[:head].max(axis=0), out=self.maxs[:, i])
+            start += head
+            block = block[head:]
+        first = start // self.bucket
+        full = len(block) // self.bucket
+        if full:
+            buckets = block[:full * self.bucket].reshape(full, self.bucket, -1)
+            self.mins[:, first:first + full] = buckets.min(axis=1).T
+            self.maxs[:, first:first + full] = buckets.max(axis=1).T
+        if len(block) > full * self.bucket:
+            rest = block[full * self.bucket:]
+            self.mins[:, first + full] = rest.min(axis=0)
+            self.maxs[:, first + full] = rest.max(axis=0)
+
+    def to_dict(self, decimals=4):
+        return {
+            'sample_rate': self.sample_rate,
+            'frames': self.frames,
+            'bucket_frames': self.bucket,
+            'min': np.round(self.mins.astype(np.float64), decimals).tolist(),
+            'max': np.round(self.maxs.astype(np.float64), decimals).tolist(),
+        }
+
+################################################################################
+# Conversion
+################################################################################
+
+def output_subtype(source_subtype, subtype=None):
+    """
+    WAV subtype to write: 'subtype', else CONVERT_SUBTYPE, else the
+    source's when WAV stores it as is, else FALLBACK_SUBTYPE.
+    """
+    subtype = subtype or CONVERT_SUBTYPE
+    if subtype is None:
+        subtype = source_subtype if source_subtype in WAV_SUBTYPES else FALLBACK_SUBTYPE
+    if subtype not in WAV_SUBTYPES:
+        raise ValueError(f"Unsupported output subtype: {subtype}, expected one of {tuple(WAV_SUBTYPES)}")
+    return subtype
+
+def quantize(block, subtype):
+    """
+    float32 block -> what to hand soundfile for 'subtype'. Integer subtypes
+    get int32 samples rounded to the subtype's resolution and placed in the
+    top bits, which libsndfile stores without rescaling, so n-bit inputs
+    (read as k / 2^(n-1)) are written back bit-exactly.
+    """
+    if subtype == 'FLOAT':
+        return block
+    bits = 8 * WAV_SUBTYPES[subtype]
+    # float32 holds every 24-bit integer exactly, 32-bit ones need float64
+    dtype = np.float32 if bits <= 24 else np.float64
+    scaled = block.astype(dtype) * dtype(1 << (bits - 1))
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, -(1 << (bits - 1)), (1 << (bits - 1)) - 1, out=scaled)
+    return scaled.astype(np.int32) << (32 - bits)
+
+def convert(input_paths, output_path, raw=None, subtype=None, preview_points=None, block_frames=None):
+    """
+    Convert input_paths (see open_input) to a WAV at output_path, one block
+    at a time. preview_points > 0 also builds a PreviewEnvelope in the same
+    pass (None = PREVIEW_POINTS, 0 = no preview).
+
+    Returns a JSON-ready summary: output, format, subtype, sample_rate,
+    channels, frames, duration_sec, seconds (wall time) and 'preview'.
+    The output appears atomically, a failed conversion leaves nothing.
+    """
+    block_frames = CONVERT_BLOCK_FRAMES if block_frames is None else block_frames
+    preview_points = PREVIEW_POINTS if preview_points is None else preview_points
+    t0 = time.perf_counter()
+    source = open_input(input_paths, raw)
+    try:
+        subtype = output_subtype(source.subtype, subtype)
+        data_bytes = source.frames * source.channels * WAV_SUBTYPES[subtype]
+        file_format = 'RF64' if data_bytes > WAV_MAX_DATA_BYTES else 'WAV'
+        preview = None
+        if preview_points and source.frames:
+            preview = PreviewEnvelope(source.frames, source.channels, source.sample_rate, preview_points)
+
+        tmp_path = output_path + '.tmp'
+        try:
+            with sf.SoundFile(tmp_path, 'w', samplerate=source.sample_rate, channels=source.channels,
+                              subtype=subtype, format=file_format) as out:
+                start = 0
+                for block in source.blocks(block_frames):
+                    if preview is not None:
+                        preview.update(start, block)
+                    out.write(quantize(block, subtype))
+                    start += len(block)
+            os.replace(tmp_path, output_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    finally:
+        source.close()
+
+    return {
+        'output': output_path,
+        'input': source.description,
+        'format': file_format,
+        'subtype': subtype,
+        'sample_rate': source.sample_rate,
+        'channels': source.channels,
+        'frames': source.frames,
+        'duration_sec': source.frames / source.sample_rate if source.sample_rate else 0.0,
+        'seconds': time.perf_counter() - t0,
+        'preview': preview.to_dict() if preview is not None else None,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert recordings to analysis-ready WAV")
+    parser.add_argument('output_path')
+    parser.add_argument('input_paths', nargs='+', help="one file, or one mono file per channel")
+    parser.add_argument('--raw', choices=tuple(RAW_ENCODINGS),
+                        help="the input is headerless interleaved PCM in this encoding")
+    parser.add_argument('--channels', type=int, help="raw input: interleaved channels (default 2)")
+    parser.add_argument('--sample-rate', type=int, help="raw input: sample rate (default 48000)")
+    parser.add_argument('--subtype', choices=tuple(WAV_SUBTYPES), help="output sample format")
+    parser.add_argument('--preview', help="write the min/max preview envelope JSON here")
+    parser.add_argument('--preview-points', type=int, help=f"buckets per channel (default {PREVIEW_POINTS})")
+    args = parser.parse_args()
+
+    raw = None
+    if args.raw:
+        raw = {'encoding': args.raw, 'channels': args.channels, 'sample_rate': args.sample_rate}
+    preview_points = args.preview_points if args.preview else 0
+    summary = convert(args.input_paths, args.output_path, raw=raw, subtype=args.subtype,
+                      preview_points=preview_points)
+    if args.preview:
+        with open(args.preview, 'w') as f:
+            json.dump(summary['preview'], f)
+    sys.stderr.write(f"{summary['input']} -> {summary['output']} ({summary['format']}/{summary['subtype']}, "
+                     f"{summary['channels']} ch, {summary['duration_sec']:.1f} s) in {summary['seconds']:.2f} s\n")
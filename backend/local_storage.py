@@ -0,0 +1,49 @@
+# Shared pieces of the backend's on-disk stores (result_cache.py,
+# audio_store.py, session_store.py): where they live by default and how the
+# size/age limited ones are evicted.
+# Every store defaults to a directory next to this file, deliberately not
+# under public/, which express serves as static files; an environment
+# variable moves it.
+# Only uses the standard library, like the stores that import it.
+
+import os
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.realpath(__file__))
+
+def default_path(env_var, *parts):
+    """
+    The store location: env_var when set, else backend/<parts>.
+    """
+    return os.environ.get(env_var, os.path.join(BACKEND_DIR, *parts))
+
+def evict(entries, remove, max_bytes, max_age_sec):
+    """
+    Drop entries unused for max_age_sec, then least recently used entries
+    until the rest fits in max_bytes.
+
+    entries: (mtime, size, path) of every entry, mtime being its last use.
+    remove(path) deletes one; an OSError leaves it in place.
+    Returns the number of entries removed.
+    """
+    now = time.time()
+    removed = 0
+    entries = sorted(entries)
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if total <= max_bytes and now - mtime <= max_age_sec:
+            continue
+        try:
+            remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+def usage(counters, entries):
+    """
+    A store's stats: this process' hit/miss counters plus its entry count
+    and size.
+    """
+    return dict(counters, entries=len(entries), bytes=sum(size for _, size, _ in entries))
@@ -0,0 +1,102 @@
+# Ingest of raw I2S captures from the ESP32 recorder (esp/esp-lung-detect).
+# The recorder runs the I2S peripheral at 48 kHz with 24-bit samples
+# (I2S_BITS_PER_SAMPLE_24BIT) and both slots of every line
+# (I2S_CHANNEL_FMT_RIGHT_LEFT), so a capture is interleaved frames of
+# 'channels' signed 24-bit little-endian samples, either packed (3 bytes per
+# sample) or in the 32-bit slots the I2S DMA fills (4 bytes, sample in the
+# upper 24 bits).
+#
+# The file is memory-mapped and decoded block by block with vectorized byte
+# shuffling, an arithmetic shift for the sign extension and a transposed
+# scale into the (channels, frames) float32 array analyze_audio takes: no
+# per-sample Python work and no intermediate WAV.
+
+import os
+
+import numpy as np
+
+################################################################################
+# TUNABLE PARAMETERS
+################################################################################
+
+# !!! TUNABLE PARAMETER: sample rate of raw captures (SAMPLE_RATE in lung_detect.c)
+RAW_SAMPLE_RATE = 48000
+# !!! TUNABLE PARAMETER: interleaved channels per frame (2 = one stereo I2S line)
+RAW_CHANNELS = 2
+# !!! TUNABLE PARAMETER: bytes per sample, 3 = packed 24-bit, 4 = 24-bit in 32-bit slots
+RAW_SAMPLE_BYTES = 3
+# Frames decoded at once, bounds the temporary arrays
+RAW_BLOCK_FRAMES = 1 << 18
+
+# Full scale of a signed 24-bit sample, decoded samples are in [-1, 1)
+INT24_SCALE = 1.0 / (1 << 23)
+
+def decode_int24(raw, num_channels, sample_bytes=3):
+    """
+    Interleaved signed 24-bit little-endian samples (bytes, or a uint8
+    array/memmap) -> int32 array of shape (frames, num_channels).
+    A trailing partial frame is ignored.
+
+    Packed samples are moved into the upper three bytes of an int32 and
+    shifted back down, which sign-extends them; 32-bit slots already hold
+    the sample in their upper bytes and only need the shift (a zero-copy
+    view until then).
+    """
+    data = np.frombuffer(raw, dtype=np.uint8) if not isinstance(raw, np.ndarray) else raw
+    frame_bytes = num_channels * sample_bytes
+    n_frames = len(data) // frame_bytes
+    data = data[:n_frames * frame_bytes]
+    if sample_bytes == 4:
+        return data.view('<i4').reshape(n_frames, num_channels) >> 8
+    if sample_bytes != 3:
+        raise ValueError(f"Unsupported sample size: {sample_bytes} bytes, expected 3 or 4")
+    widened = np.zeros((n_frames * num_channels, 4), dtype=np.uint8)
+    widened[:, 1:] = data.reshape(-1, 3)
+    return widened.view('<i4').reshape(n_frames, num_channels) >> 8
+
+def capture_frames(path, num_channels=None, sample_bytes=None):
+    """
+    Number of whole frames in a raw capture file.
+    """
+    num_channels = RAW_CHANNELS if num_channels is None else num_channels
+    sample_bytes = RAW_SAMPLE_BYTES if sample_bytes is None else sample_bytes
+    return os.path.getsize(path) // (num_channels * sample_bytes)
+
+def load_raw_capture(path, channels=None, sample_rate=None, sample_bytes=None, block_frames=None):
+    """
+    Decode a raw capture file like load_audio does a WAV.
+
+    Returns audio_data with shape (channels, n_frames), float32 in [-1, 1),
+    and sample_rate.
+    """
+    num_channels = RAW_CHANNELS if channels is None else channels
+    sample_rate = RAW_SAMPLE_RATE if sample_rate is None else sample_rate
+    sample_bytes = RAW_SAMPLE_BYTES if sample_bytes is None else sample_bytes
+    block_frames = RAW_BLOCK_FRAMES if block_frames is None else block_frames
+
+    n_frames = capture_frames(path, num_channels, sample_bytes)
+    frame_bytes = num_channels * sample_bytes
+    audio_data = np.empty((num_channels, n_frames), dtype=np.float32)
+    if n_frames == 0:
+        return audio_data, sample_rate
+    raw = np.memmap(path, dtype=np.uint8, mode='r', shape=(n_frames * frame_bytes,))
+    try:
+        for start in range(0, n_frames, block_frames):
+            stop = min(n_frames, start + block_frames)
+            samples = decode_int24(raw[start * frame_bytes:stop * frame_bytes], num_channels, sample_bytes)
+            # de-interleave: frames x channels -> channels x frames
+            np.multiply(samples.T, np.float32(INT24_SCALE), out=audio_data[:, start:stop])
+    finally:
+        del raw
+    return audio_data, sample_rate
+
+def encode_int24(audio_data, sample_bytes=3):
+    """
+    Inverse of decode_int24 for (channels, frames) float samples in [-1, 1):
+    the interleaved capture bytes the recorder would produce.
+    """
+    samples = np.clip(np.round(np.asarray(audio_data, dtype=np.float64).T / INT24_SCALE),
+                      -(1 << 23), (1 << 23) - 1).astype('<i4')
+    if sample_bytes == 4:
+        return (samples << 8).tobytes()
+    return np.ascontiguousarray(samples.reshape(-1, 1).view(np.uint8)[:, :3]).tobytes()
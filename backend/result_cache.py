@@ -0,0 +1,106 @@
+# Content-addressed cache of analysis results.
+# Results are keyed on a hash of the uploaded file's bytes plus the tuning
+# parameters that affect the output, and stored as the families JSON on local
+# disk. Entries are evicted least-recently-used first once the cache is over
+# CACHE_MAX_BYTES, and dropped when unused for CACHE_MAX_AGE_SEC.
+# Only uses the standard library, so a hit never needs numpy or librosa.
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import local_storage
+
+CACHE_DIR = local_storage.default_path('AUDIO_CACHE_DIR', 'cache')
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_MAX_AGE_SEC = 7 * 24 * 3600
+# Bump when the pipeline changes in a way that changes results for the same parameters
+CACHE_VERSION = 2  # 2: the placeholder family is marked
+
+# Hits and misses of this process (a worker lives across many requests)
+_stats = {'hits': 0, 'misses': 0}
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    sha256 of a file's bytes, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_key(audio_digest, parameters, mode='families'):
+    """
+    Key for one result: audio content + parameters + result kind.
+    """
+    blob = json.dumps({'audio': audio_digest, 'parameters': parameters, 'mode': mode,
+                       'version': CACHE_VERSION}, sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+def _entry_path(key, cache_dir):
+    return os.path.join(cache_dir, key + '.json')
+
+def get(key, cache_dir=None):
+    """
+    Cached JSON text for key, or None. A hit marks the entry as recently used.
+    """
+    path = _entry_path(key, cache_dir or CACHE_DIR)
+    try:
+        with open(path, 'r') as f:
+            text = f.read()
+    except OSError:
+        _stats['misses'] += 1
+        return None
+    if time.time() - os.path.getmtime(path) > CACHE_MAX_AGE_SEC:
+        _stats['misses'] += 1
+        return None
+    os.utime(path)
+    _stats['hits'] += 1
+    return text
+
+def put(key, text, cache_dir=None):
+    """
+    Store JSON text under key (atomically), then evict down to the limits.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, _entry_path(key, cache_dir))
+    evict(cache_dir)
+
+def _entries(cache_dir):
+    entries = []
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return entries
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+def evict(cache_dir=None, max_bytes=None, max_age_sec=None):
+    """
+    Drop entries unused for max_age_sec, then least recently used entries
+    until the cache fits in max_bytes. Returns the number of entries removed.
+    """
+    return local_storage.evict(_entries(cache_dir or CACHE_DIR), os.remove,
+                               CACHE_MAX_BYTES if max_bytes is None else max_bytes,
+                               CACHE_MAX_AGE_SEC if max_age_sec is None else max_age_sec)
+
+def stats(cache_dir=None):
+    """
+    Hit/miss counters of this process plus the cache's current size.
+    """
+    return local_storage.usage(_stats, _entries(cache_dir or CACHE_DIR))
@@ -1,14 +1,17 @@
 const express = require('express');
 const cors = require('cors');
 const multer = require('multer');
-const { execFile } = require('child_process');
 const fs = require('fs');
 const path = require('path');
 const os = require('os');
+const { AudioWorkerPool } = require('./audio_worker_pool');
 
 const app = express();
 const PORT = 5000;
 
+// Warm Python workers that run audio_process.py jobs (AUDIO_WORKERS to change the count)
+const workerPool = new AudioWorkerPool({ size: parseInt(process.env.AUDIO_WORKERS || '1', 10) }).start();
+
 // Configure multer storage to save files as .wav
 const storage = multer.diskStorage({
     destination: './public/data/uploads/',
@@ -46,27 +49,63 @@ app.post('/compute', upload.single('uploaded_file'), (req, res) => {
 
     const filePath = req.file.path; // Access the uploaded file path
 
-    // Run the Python script with the uploaded file as an argument
-    execFile('python3', ['./audio_process.py', filePath], (error, stdout, stderr) => {
+    // Output format: json (default), ndjson (families streamed as they are found) or npz (columns)
+    const format = req.query.format || 'json';
+
+    // ?input=raw24 for a headerless 24-bit I2S capture straight from the recorder,
+    // optionally with &channels=, &sample_rate= and &sample_bytes= (3 packed, 4 in 32-bit slots)
+    const raw = req.query.input === 'raw24' ? {
+        channels: req.query.channels ? parseInt(req.query.channels, 10) : null,
+        sample_rate: req.query.sample_rate ? parseInt(req.query.sample_rate, 10) : null,
+        sample_bytes: req.query.sample_bytes ? parseInt(req.query.sample_bytes, 10) : null
+    } : undefined;
+
+    // ?session=ID (&patient=ID) also appends the families to that session of the session store
+    const session = req.query.session || undefined;
+    const patient = req.query.patient || undefined;
+
+    if (format === 'ndjson') {
+        res.type('application/x-ndjson');
+        workerPool.run({ op: 'analyze', file: filePath, format, raw, session, patient }, (error, reply) => {
+            if (error) {
+                console.error(`Python worker error: ${error.message}`);
+                // Headers may be sent already, so report the error as a last line
+                if (!res.headersSent) {
+                    return res.status(500).send(`Error executing Python script: ${error.message}`);
+                }
+                return res.end(JSON.stringify({ error: error.message }) + '\n');
+            }
+            console.log(`Streamed ${reply.count} families`);
+            res.end();
+        }, (message) => {
+            res.write(JSON.stringify(message.family) + '\n');
+        });
+        return;
+    }
+
+    if (format === 'npz') {
+        const resultFile = `${filePath}.npz`;
+        workerPool.run({ op: 'analyze', file: filePath, format, raw, session, patient, result_file: resultFile }, (error, reply) => {
+            if (error) {
+                console.error(`Python worker error: ${error.message}`);
+                return res.status(500).send(`Error executing Python script: ${error.message}`);
+            }
+            res.download(path.resolve(reply.result_file), 'families.npz', () => {
+                fs.unlink(reply.result_file, () => {});
+            });
+        });
+        return;
+    }
+
+    // Analyze the uploaded file in one of the warm Python workers
+    workerPool.run({ op: 'analyze', file: filePath, raw, session, patient }, (error, reply) => {
         if (error) {
-            console.error(`Python script error: ${stderr}`);
-            return res.status(500).send(`Error executing Python script: ${stderr}`);
-        }
-    
-        // Log the raw output from Python for debugging
-        console.log("Raw Python output:", stdout);
-    
-        // Remove any unnecessary outer arrays (if present)
-        const cleanedOutput = stdout.replace(/^\[{/, '[').replace(/\}]$/, ']');
-    
-        try {
-            const jsonResponse = JSON.parse(cleanedOutput);
-            console.log("Parsed JSON response:", jsonResponse);
-            res.json(jsonResponse);
-        } catch (parseError) {
-            console.error('Error parsing Python response:', parseError);
-            return res.status(500).send('Error parsing Python response');
+            console.error(`Python worker error: ${error.message}`);
+            return res.status(500).send(`Error executing Python script: ${error.message}`);
         }
+
+        console.log("Parsed JSON response:", reply.families);
+        res.json(reply.families);
     });
 });
 
@@ -90,82 +129,93 @@ app.post('/compute-multi', upload.array('uploaded_files', 6), (req, res) => {
     // Get paths for all uploaded files
     const filePaths = req.files.map(file => file.path);
     
-    // Create a temporary output file path
-    const outputFilePath = path.join('./public/data/uploads/', `combined-${Date.now()}.wav`);
-    
     console.log('Files to combine:', filePaths);
-    console.log('Output path:', outputFilePath);
-    
-    // First, combine the wav files using a Python script
-    execFile('python3', ['./combine_wav.py', outputFilePath, ...filePaths], (error, stdout, stderr) => {
+
+    // Combine the wav files in memory and analyze the result in one worker job,
+    // appending the families to ?session=ID (&patient=ID) when given
+    const session = req.query.session || undefined;
+    const patient = req.query.patient || undefined;
+    workerPool.run({ op: 'combine', inputs: filePaths, session, patient }, (error, reply) => {
         if (error) {
-            console.error(`Error combining wav files: ${stderr}`);
-            console.error(`Python output: ${stdout}`);
-            return res.status(500).send(`Error combining wav files: ${stderr}`);
+            console.error(`Python worker error: ${error.message}`);
+            return res.status(500).send(`Error executing Python script: ${error.message}`);
         }
-        
-        console.log("Files combined successfully. Python output:", stdout);
-        
-        // Now process the combined file with the main audio_process.py script
-        execFile('python3', ['./audio_process.py', outputFilePath], (error, stdout, stderr) => {
-            if (error) {
-                console.error(`Python script error: ${stderr}`);
-                console.error(`Python output: ${stdout}`);
-                
-                // Cleanup the temp file
-                fs.unlink(outputFilePath, (err) => {
-                    if (err) console.error(`Error deleting temporary file: ${err}`);
-                });
-                
-                return res.status(500).send(`Error executing Python script: ${stderr}`);
-            }
-            
-            // Log the raw output from Python for debugging
-            console.log("Raw Python output:", stdout);
-            
-            // Remove any unnecessary outer arrays (if present)
-            const cleanedOutput = stdout.replace(/^\[{/, '[').replace(/\}]$/, ']');
-            
-            try {
-                const jsonResponse = JSON.parse(cleanedOutput);
-                console.log("Parsed JSON response:", jsonResponse);
-                
-                // Cleanup the temp file
-                fs.unlink(outputFilePath, (err) => {
-                    if (err) console.error(`Error deleting temporary file: ${err}`);
-                });
-                
-                res.json(jsonResponse);
-            } catch (parseError) {
-                console.error('Error parsing Python response:', parseError);
-                
-                // Cleanup the temp file
-                fs.unlink(outputFilePath, (err) => {
-                    if (err) console.error(`Error deleting temporary file: ${err}`);
-                });
-                
-                return res.status(500).send('Error parsing Python response');
-            }
-        });
+
+        console.log("Parsed JSON response:", reply.families);
+        res.json(reply.families);
     });
 });
 
-// To process data and convert them to .wav format
-app.post('/convert', upload.single('uploaded_file'), (req, res) => {
+// Convert an upload (any format libsndfile reads, headerless PCM, or one mono file per channel)
+// to an analysis-ready .wav in a worker, with a min/max preview envelope of the waveform
+app.post('/convert', upload.fields([{ name: 'uploaded_file', maxCount: 1 }, { name: 'uploaded_files', maxCount: 6 }]), (req, res) => {
+    const files = (req.files && (req.files.uploaded_file || req.files.uploaded_files)) || [];
     // Check if a file was uploaded
-    if (!req.file) {
+    if (files.length === 0) {
         return res.status(400).send('No file uploaded');
     }
 
-    console.log(`File uploaded: ${req.file.originalname}`);
-    console.log(`File path: ${req.file.path}`);
-    console.log(`File size: ${req.file.size} bytes`);
-    console.log(`File mime type: ${req.file.mimetype}`);
+    files.forEach((file, index) => {
+        console.log(`File ${index + 1}: ${file.originalname}, Size: ${file.size} bytes, Path: ${file.path}`);
+    });
 
-    const filePath = req.file.path; // Access the uploaded file path
+    const inputs = files.map(file => file.path);
+    const output = inputs[0].replace(/\.wav$/, '') + '-converted.wav';
+
+    // ?input=raw24 (&sample_bytes=4 for 32-bit slots) for the recorder's raw captures, or
+    // ?input=pcm16|pcm32|float32 for other headerless dumps, with optional &channels= and &sample_rate=
+    let raw;
+    if (req.query.input) {
+        const encoding = req.query.input === 'raw24'
+            ? (req.query.sample_bytes === '4' ? 'pcm24_32' : 'pcm24')
+            : req.query.input;
+        raw = {
+            encoding,
+            channels: req.query.channels ? parseInt(req.query.channels, 10) : null,
+            sample_rate: req.query.sample_rate ? parseInt(req.query.sample_rate, 10) : null
+        };
+    }
+    // ?preview=N min/max pairs per channel (0 for none), default PREVIEW_POINTS
+    const preview = req.query.preview !== undefined ? parseInt(req.query.preview, 10) : null;
+
+    workerPool.run({ op: 'convert', inputs, output, raw, preview }, (error, reply) => {
+        if (error) {
+            console.error(`Python worker error: ${error.message}`);
+            return res.status(500).send(`Error converting file: ${error.message}`);
+        }
 
-    // Just return success for now since the conversion functionality is not implemented
-    res.json({ success: true, message: 'File uploaded successfully', file: req.file.originalname });
+        const conversion = reply.conversion;
+        console.log(`Converted ${conversion.input} to ${conversion.output} in ${conversion.seconds.toFixed(2)} s`);
+        res.json({
+            success: true,
+            message: 'File converted successfully',
+            file: files[0].originalname,
+            // served by express.static from public/
+            download: '/data/uploads/' + path.basename(conversion.output),
+            ...conversion
+        });
+    });
+});
+
+// Session-level statistics (crackles per minute, leader channel, mean delays per channel)
+// and the per-recording trend, from the session store's running aggregates
+app.get('/sessions/:session', (req, res) => {
+    workerPool.run({ op: 'session_summary', session: req.params.session }, (error, reply) => {
+        if (error) {
+            return res.status(404).send(error.message);
+        }
+        res.json({ ...reply.session, history: reply.recordings });
+    });
+});
+
+// Stored sessions, most recent first (?patient=ID for one patient's)
+app.get('/sessions', (req, res) => {
+    workerPool.run({ op: 'sessions', patient: req.query.patient }, (error, reply) => {
+        if (error) {
+            return res.status(500).send(`Error reading sessions: ${error.message}`);
+        }
+        res.json(reply.sessions);
+    });
 });
 
 // Basic health check endpoint
@@ -0,0 +1,461 @@
+# Per-patient session store: the families of every analyzed recording,
+# appended to a local SQLite database as the recording is analyzed, with the
+# session's running aggregates kept next to them.
+#
+#   sessions       one row per session: recordings, seconds, families
+#   recordings     one row per recording (keyed on its digest, so re-posting
+#                  the same upload doesn't count it twice)
+#   families       every family entry, the session's history
+#   channel_stats  per (session, channel): entries, times it led a family,
+#                  sums of delay, delay^2 and transmission coefficient
+#   phase_stats    per (session, breath phase): families (BREATH_PHASES)
+#
+# add_recording updates the aggregates in the same transaction as the
+# append, so session_summary (crackles per minute, leader channel, mean
+# delays) reads a few precomputed rows however long the session is, instead
+# of reanalyzing past uploads.
+# Only uses the standard library, like result_cache.py.
+#
+#   python session_store.py summary SESSION | recordings SESSION | list [--patient ID] | recount [SESSION]
+#   python session_store.py add SESSION families.json --duration SEC [--patient ID] [--source NAME]
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import sys
+import time
+
+import local_storage
+
+SESSION_DB = local_storage.default_path('AUDIO_SESSION_DB', 'sessions', 'sessions.sqlite')
+# Bump when the schema or what the aggregates hold changes, with a MIGRATIONS
+# step from the previous version: the store is the patients' history and is
+# never emptied by an upgrade
+SESSION_STORE_VERSION = 1
+# Seconds a writer waits for another worker's transaction
+SESSION_DB_TIMEOUT_SEC = 30.0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    patient_id TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    recordings INTEGER NOT NULL DEFAULT 0,
+    duration_sec REAL NOT NULL DEFAULT 0,
+    families INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS sessions_patient ON sessions (patient_id);
+CREATE TABLE IF NOT EXISTS recordings (
+    recording_id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL REFERENCES sessions (session_id),
+    digest TEXT NOT NULL,
+    source TEXT,
+    recorded_at REAL NOT NULL,
+    duration_sec REAL NOT NULL,
+    sample_rate INTEGER,
+    channels INTEGER,
+    families INTEGER NOT NULL,
+    UNIQUE (session_id, digest)
+);
+CREATE TABLE IF NOT EXISTS families (
+    recording_id INTEGER NOT NULL REFERENCES recordings (recording_id),
+    family_id INTEGER NOT NULL,
+    channel INTEGER NOT NULL,
+    time_ms REAL NOT NULL,
+    delay_ms REAL NOT NULL,
+    transmission_coefficient REAL NOT NULL,
+    phase TEXT
+);
+CREATE INDEX IF NOT EXISTS families_recording ON families (recording_id);
+CREATE TABLE IF NOT EXISTS channel_stats (
+    session_id TEXT NOT NULL,
+    channel INTEGER NOT NULL,
+    entries INTEGER NOT NULL,
+    leads INTEGER NOT NULL,
+    delay_sum REAL NOT NULL,
+    delay_sq_sum REAL NOT NULL,
+    transmission_sum REAL NOT NULL,
+    PRIMARY KEY (session_id, channel)
+);
+CREATE TABLE IF NOT EXISTS phase_stats (
+    session_id TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    families INTEGER NOT NULL,
+    PRIMARY KEY (session_id, phase)
+);
+'''
+
+# Tables in drop order, for delete_session
+TABLES = ('families', 'recordings', 'channel_stats', 'phase_stats', 'sessions')
+
+# One connection per database for the life of the process (a worker lives
+# across many requests)
+_connections = {}
+
+def connect(db_path=None):
+    """
+    Connection to the session database, created (with its schema) on first
+    use. A database from an older SESSION_STORE_VERSION is brought up to
+    date by the MIGRATIONS steps, in one transaction; one from a newer
+    version is refused rather than written with the wrong layout.
+    """
+    db_path = db_path or SESSION_DB
+    conn = _connections.get(db_path)
+    if conn is not None:
+        return conn
+    if db_path != ':memory:':
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    # autocommit, transactions are opened explicitly with BEGIN IMMEDIATE
+    conn = sqlite3.connect(db_path, timeout=SESSION_DB_TIMEOUT_SEC, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    if db_path != ':memory:':
+        conn.execute('PRAGMA journal_mode=WAL')  # readers don't block the writing worker
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version > SESSION_STORE_VERSION:
+        conn.close()
+        raise RuntimeError(f"{db_path} is a version {version} session store, this code reads version "
+                           f"{SESSION_STORE_VERSION}")
+    conn.executescript(SCHEMA)
+    if 0 < version < SESSION_STORE_VERSION:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for step in range(version, SESSION_STORE_VERSION):
+                MIGRATIONS[step](conn)
+            conn.execute(f'PRAGMA user_version = {SESSION_STORE_VERSION}')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            conn.close()
+            raise
+    else:
+        conn.execute(f'PRAGMA user_version = {SESSION_STORE_VERSION}')
+    _connections[db_path] = conn
+    return conn
+
+def close(db_path=None):
+    conn = _connections.pop(db_path or SESSION_DB, None)
+    if conn is not None:
+        conn.close()
+
+def family_leader(family):
+    """
+    Channel a family's delays are measured against: the entry
+    compute_final_delays_transmissions writes as delay 0.0 and transmission
+    coefficient 1.0 (another channel's coefficient can be above 1.0, so the
+    largest one isn't necessarily the leader), as in
+    benchmark.score_families. The first entry when none matches.
+    """
+    leader = next((entry for entry in family if entry['delay'] == 0.0 and entry['transmission_coefficient'] == 1.0),
+                  family[0])
+    return leader['channel']
+
+################################################################################
+# Migrations
+################################################################################
+
+def recount_leads(conn, session_id=None):
+    """
+    Recompute channel_stats.leads from the stored families with
+    family_leader, for every session or one. The migration step for a
+    change of the leader rule; the other aggregates don't depend on it.
+    Runs inside the caller's transaction.
+    """
+    query = ('SELECT r.session_id, f.recording_id, f.family_id, f.channel, f.delay_ms, f.transmission_coefficient '
+             'FROM families f JOIN recordings r ON r.recording_id = f.recording_id')
+    args = ()
+    if session_id is not None:
+        query += ' WHERE r.session_id = ?'
+        args = (session_id,)
+    families = {}
+    for row in conn.execute(query + ' ORDER BY f.recording_id, f.family_id, f.rowid', args):
+        families.setdefault((row[0], row[1], row[2]), []).append(
+            {'channel': row[3], 'delay': row[4], 'transmission_coefficient': row[5]})
+    leads = {}
+    for (session, _, _), family in families.items():
+        key = (session, family_leader(family))
+        leads[key] = leads.get(key, 0) + 1
+    if session_id is None:
+        conn.execute('UPDATE channel_stats SET leads = 0')
+    else:
+        conn.execute('UPDATE channel_stats SET leads = 0 WHERE session_id = ?', (session_id,))
+    conn.executemany('UPDATE channel_stats SET leads = ? WHERE session_id = ? AND channel = ?',
+                     [(count, session, channel) for (session, channel), count in leads.items()])
+
+# MIGRATIONS[v] turns a version v store into a version v + 1 one, in place
+# (connect runs them in order). Adding one: bump SESSION_STORE_VERSION and
+# append the step, e.g. recount_leads when family_leader changes.
+MIGRATIONS = {}
+
+def families_digest(families):
+    """
+    Stand-in recording digest for families added without one: the same
+    families give the same digest.
+    """
+    return hashlib.sha256(json.dumps(families, sort_keys=True).encode()).hexdigest()
+
+################################################################################
+# Appending
+################################################################################
+
+def add_recording(session_id, families, duration_sec, digest=None, patient_id=None, source=None,
+                  sample_rate=None, channels=None, recorded_at=None, db_path=None):
+    """
+    Append one analyzed recording's families (the list audio_process
+    returns) to a session, creating the session on first use, and fold them
+    into the session's aggregates. audio_process's placeholder family
+    (entries marked 'placeholder', nothing detected) isn't stored.
+
+    digest: the recording's content digest (audio_process.input_digest); a
+    recording already in the session isn't added again.
+
+    Returns (added, summary): whether the recording was new and the
+    session_summary after it.
+    """
+    conn = connect(db_path)
+    digest = digest or families_digest(families)
+    now = time.time()
+    recorded_at = now if recorded_at is None else recorded_at
+
+    # per-channel and per-phase increments, summed here so the aggregates
+    # cost one upsert per channel whatever the number of families
+    channel_deltas = {}
+    phase_deltas = {}
+    rows = []
+    families = [family for family in families if family and not family[0].get('placeholder', False)]
+    for family_id, family in enumerate(families):
+        leader = family_leader(family)
+        for entry in family:
+            channel = int(entry['channel'])
+            delay = float(entry['delay'])
+            deltas = channel_deltas.setdefault(channel, [0, 0, 0.0, 0.0, 0.0])
+            deltas[0] += 1
+            deltas[1] += channel == leader
+            deltas[2] += delay
+            deltas[3] += delay * delay
+            deltas[4] += float(entry['transmission_coefficient'])
+            rows.append((family_id, channel, float(entry['time']), delay,
+                         float(entry['transmission_coefficient']), entry.get('phase')))
+        if 'phase' in family[0]:
+            phase_deltas[family[0]['phase']] = phase_deltas.get(family[0]['phase'], 0) + 1
+    n_families = len(families)
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('INSERT OR IGNORE INTO sessions (session_id, patient_id, created, updated) VALUES (?, ?, ?, ?)',
+                     (session_id, patient_id, now, now))
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO recordings (session_id, digest, source, recorded_at, duration_sec, sample_rate, '
+            'channels, families) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (session_id, digest, source, recorded_at, float(duration_sec), sample_rate, channels, n_families)
+        )
+        added = cursor.rowcount == 1
+        if added:
+            recording_id = cursor.lastrowid
+            conn.executemany(
+                'INSERT INTO families (recording_id, family_id, channel, time_ms, delay_ms, transmission_coefficient, '
+                'phase) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(recording_id,) + row for row in rows]
+            )
+            conn.execute(
+                'UPDATE sessions SET updated = ?, recordings = recordings + 1, duration_sec = duration_sec + ?, '
+                'families = families + ?, patient_id = COALESCE(patient_id, ?) WHERE session_id = ?',
+                (now, float(duration_sec), n_families, patient_id, session_id)
+            )
+            conn.executemany(
+                'INSERT INTO channel_stats (session_id, channel, entries, leads, delay_sum, delay_sq_sum, '
+                'transmission_sum) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (session_id, channel) DO UPDATE SET entries = entries + excluded.entries, '
+                'leads = leads + excluded.leads, delay_sum = delay_sum + excluded.delay_sum, '
+                'delay_sq_sum = delay_sq_sum + excluded.delay_sq_sum, '
+                'transmission_sum = transmission_sum + excluded.transmission_sum',
+                [(session_id, channel) + tuple(deltas) for channel, deltas in sorted(channel_deltas.items())]
+            )
+            conn.executemany(
+                'INSERT INTO phase_stats (session_id, phase, families) VALUES (?, ?, ?) '
+                'ON CONFLICT (session_id, phase) DO UPDATE SET families = families + excluded.families',
+                [(session_id, phase, count) for phase, count in sorted(phase_deltas.items())]
+            )
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return added, session_summary(session_id, db_path)
+
+def delete_session(session_id, db_path=None):
+    """
+    Drop a session with its recordings, families and aggregates. Returns
+    whether it existed.
+    """
+    conn = connect(db_path)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM families WHERE recording_id IN '
+                     '(SELECT recording_id FROM recordings WHERE session_id = ?)', (session_id,))
+        for table in TABLES[1:]:
+            cursor = conn.execute(f'DELETE FROM {table} WHERE session_id = ?', (session_id,))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return cursor.rowcount > 0
+
+################################################################################
+# Queries
+################################################################################
+
+def session_summary(session_id, db_path=None):
+    """
+    Session-level statistics from the running aggregates, None for an
+    unknown session:
+      recordings, duration_sec, families, crackles_per_min,
+      channels: per channel { entries, leads, mean_delay_ms, delay_std_ms,
+                              mean_transmission },
+      leader_channel: the channel that led the most families,
+      phases: families per breath phase, when they were tagged.
+    """
+    conn = connect(db_path)
+    session = conn.execute('SELECT * FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+    if session is None:
+        return None
+    minutes = session['duration_sec'] / 60.0
+    summary = {
+        'session': session['session_id'],
+        'patient': session['patient_id'],
+        'created': session['created'],
+        'updated': session['updated'],
+        'recordings': session['recordings'],
+        'duration_sec': session['duration_sec'],
+        'families': session['families'],
+        'crackles_per_min': session['families'] / minutes if minutes > 0 else 0.0,
+        'channels': {},
+        'leader_channel': None,
+    }
+    leads = -1
+    for row in conn.execute('SELECT * FROM channel_stats WHERE session_id = ? ORDER BY channel', (session_id,)):
+        entries = row['entries']
+        mean_delay = row['delay_sum'] / entries
+        summary['channels'][str(row['channel'])] = {
+            'entries': entries,
+            'leads': row['leads'],
+            'mean_delay_ms': mean_delay,
+            'delay_std_ms': math.sqrt(max(0.0, row['delay_sq_sum'] / entries - mean_delay * mean_delay)),
+            'mean_transmission': row['transmission_sum'] / entries,
+        }
+        if row['leads'] > leads:
+            summary['leader_channel'], leads = row['channel'], row['leads']
+    phases = conn.execute('SELECT phase, families FROM phase_stats WHERE session_id = ? ORDER BY phase',
+                          (session_id,)).fetchall()
+    if phases:
+        summary['phases'] = {row['phase']: row['families'] for row in phases}
+    return summary
+
+def session_recordings(session_id, db_path=None):
+    """
+    The session's recordings in the order they were recorded, each with its
+    own crackles per minute: the trend over the session.
+    """
+    conn = connect(db_path)
+    recordings = []
+    for row in conn.execute('SELECT * FROM recordings WHERE session_id = ? ORDER BY recorded_at, recording_id',
+                            (session_id,)):
+        recording = {name: row[name] for name in ('recording_id', 'digest', 'source', 'recorded_at', 'duration_sec',
+                                                  'sample_rate', 'channels', 'families')}
+        minutes = row['duration_sec'] / 60.0
+        recording['crackles_per_min'] = row['families'] / minutes if minutes > 0 else 0.0
+        recordings.append(recording)
+    return recordings
+
+def recording_families(recording_id, db_path=None):
+    """
+    A stored recording's families, in the audio_process format.
+    """
+    conn = connect(db_path)
+    families = []
+    current = None
+    for row in conn.execute('SELECT * FROM families WHERE recording_id = ? ORDER BY family_id, rowid',
+                            (recording_id,)):
+        if row['family_id'] != current:
+            families.append([])
+            current = row['family_id']
+        entry = {'channel': row['channel'], 'delay': row['delay_ms'],
+                 'transmission_coefficient': row['transmission_coefficient'], 'time': row['time_ms']}
+        if row['phase'] is not None:
+            entry['phase'] = row['phase']
+        families[-1].append(entry)
+    return families
+
+def list_sessions(patient_id=None, db_path=None):
+    """
+    (session, patient, recordings, families, updated) of every session,
+    most recently updated first, optionally only one patient's.
+    """
+    conn = connect(db_path)
+    query = 'SELECT session_id, patient_id, recordings, families, updated FROM sessions'
+    args = ()
+    if patient_id is not None:
+        query += ' WHERE patient_id = ?'
+        args = (patient_id,)
+    return [{'session': row['session_id'], 'patient': row['patient_id'], 'recordings': row['recordings'],
+             'families': row['families'], 'updated': row['updated']}
+            for row in conn.execute(query + ' ORDER BY updated DESC', args)]
+
+def stats(db_path=None):
+    """
+    Sessions, recordings and family entries stored, and the database size.
+    """
+    db_path = db_path or SESSION_DB
+    conn = connect(db_path)
+    counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in ('sessions', 'recordings', 'families')}
+    counts['bytes'] = sum(os.path.getsize(path) for path in (db_path, db_path + '-wal') if os.path.exists(path))
+    return counts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query or fill the per-patient session store")
+    commands = parser.add_subparsers(dest='command', required=True)
+    summary_parser = commands.add_parser('summary', help="session-level statistics")
+    summary_parser.add_argument('session')
+    recordings_parser = commands.add_parser('recordings', help="per-recording rows of a session")
+    recordings_parser.add_argument('session')
+    list_parser = commands.add_parser('list', help="stored sessions")
+    list_parser.add_argument('--patient')
+    recount_parser = commands.add_parser('recount', help="recompute the leads from the stored families")
+    recount_parser.add_argument('session', nargs='?', help="only this session (default: all)")
+    add_parser = commands.add_parser('add', help="append a families JSON file (audio_process.py output)")
+    add_parser.add_argument('session')
+    add_parser.add_argument('families_file')
+    add_parser.add_argument('--duration', type=float, required=True, help="recording length in seconds")
+    add_parser.add_argument('--patient')
+    add_parser.add_argument('--source')
+    args = parser.parse_args()
+
+    if args.command == 'summary':
+        result = session_summary(args.session)
+        if result is None:
+            sys.exit(f"Unknown session: {args.session}")
+    elif args.command == 'recordings':
+        result = session_recordings(args.session)
+    elif args.command == 'list':
+        result = list_sessions(args.patient)
+    elif args.command == 'recount':
+        conn = connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            recount_leads(conn, args.session)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        result = session_summary(args.session) if args.session else list_sessions()
+    else:
+        with open(args.families_file, 'r') as f:
+            families = json.load(f)
+        added, result = add_recording(args.session, families, args.duration, patient_id=args.patient,
+                                      source=args.source or os.path.basename(args.families_file))
+        if not added:
+            sys.stderr.write(f"{args.families_file} is already in session {args.session}\n")
+    sys.stdout.write(json.dumps(result, indent=2) + "\n")
@@ -0,0 +1,82 @@
+# Start-up cost of every Python entry point of the backend.
+# Each module is imported in a fresh interpreter (so nothing is cached in
+# sys.modules) and the report gives the import wall time, the slowest
+# modules it pulled in (python -X importtime) and whether any of the heavy
+# optional libraries got loaded.
+#
+#   python startup_benchmark.py [--repeat 3] [--output startup.json]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ENTRY_POINTS = (
+    'audio_process', 'audio_stream', 'audio_parallel', 'audio_realtime', 'audio_batch',
+    'audio_sweep', 'combine_wav', 'result_cache', 'raw_capture', 'format_converter', 'audio_breath',
+    'session_store', 'benchmark',
+)
+# should only be imported by the features that need them
+HEAVY_MODULES = ('librosa', 'matplotlib', 'numba', 'sklearn', 'scipy.io.wavfile')
+
+_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t0
+print(json.dumps({{'seconds': elapsed, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+def _top_imports(stderr, top):
+    """
+    The 'top' slowest modules of a -X importtime report, by self time.
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line[len('import time:'):].split('|'))
+        rows.append((int(self_us), int(cumulative_us), name.strip()))
+    rows.sort(reverse=True)
+    return [{'module': name, 'self_ms': self_us / 1000.0, 'cumulative_ms': cumulative_us / 1000.0}
+            for self_us, cumulative_us, name in rows[:top]]
+
+def measure_import(module, repeat=3, top=5):
+    """
+    Best import time of 'module' over 'repeat' fresh interpreters.
+    """
+    backend_dir = os.path.dirname(os.path.realpath(__file__))
+    best = None
+    for _ in range(max(1, repeat)):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                              cwd=backend_dir, capture_output=True, text=True)
+        if proc.returncode != 0:
+            return {'module': module, 'error': proc.stderr.strip().splitlines()[-1]}
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = dict(result, module=module, slowest_imports=_top_imports(proc.stderr, top))
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the import time of each backend entry point")
+    parser.add_argument('--repeat', type=int, default=3, help="fresh interpreters per module, best time is kept")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = []
+    for module in ENTRY_POINTS:
+        result = measure_import(module, repeat=args.repeat)
+        report.append(result)
+        if 'error' in result:
+            sys.stderr.write(f"{module:16s} failed: {result['error']}\n")
+        else:
+            heavy = f"  (loads {', '.join(result['heavy'])})" if result['heavy'] else ''
+            sys.stderr.write(f"{module:16s} {result['seconds'] * 1000.0:8.1f} ms{heavy}\n")
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")